@@ -1,11 +1,16 @@
 from tslearn.clustering import TimeSeriesKMeans
 import csv
+import argparse
 import numpy as np
 import glob
+from resample import resample_batch
+import instrument
+import dtwdistance
+import os
 from tslearn.utils import to_time_series_dataset
 import matplotlib.pyplot as plt
 from sklearn.metrics import silhouette_samples, silhouette_score
-from tslearn.metrics import cdist_soft_dtw, cdist_dtw
+from scipy.spatial.distance import squareform
 import matplotlib.cm as cm
 
 def getAlt(filename):
@@ -18,26 +23,88 @@ def getAlt(filename):
     return alt
 
 
-rs = np.random.seed(1266)
+def getTimeAlt(filename):
+    time = []
+    alt = []
+    with open(filename, 'r') as file:
+        csvreader = csv.reader(file)
+        next(csvreader)
+        for row in csvreader:
+            time.append(float(row[0]))
+            alt.append(float(row[3]))
+    return time, alt
+
+
+# -data selects the flight files, -points resamples every flight to the same number of evenly spaced points
+# so the series have a fixed length instead of being padded with NaN to the longest flight
+#           python3 ClusterEval.py -data "Data/*" -points 300
+# --profile times the reading, distance matrix, prediction, silhouette and plotting stages (see instrument.py)
+#           python3 ClusterEval.py -data "Data/*" --profile
+# The DTW distance matrix driving the silhouettes is saved as float32 in -cache (see dtwdistance.py) and mapped again by
+# the next runs on the same flights and settings. -constraint keeps the warping path in a Sakoe-Chiba band of -radius
+# points or an Itakura parallelogram of maximum -slope, which makes every pair far cheaper than the unconstrained DTW
+#           python3 ClusterEval.py -data "Data/*" -points 300 -constraint sakoe_chiba -radius 15 -j 4
+# -representatives prints the flights nearest to every cluster center, found with LB_Kim / LB_Keogh pruning
+#           python3 ClusterEval.py -data "Data/*" -points 300 -representatives 3
+parser = argparse.ArgumentParser()
+parser.add_argument('-data', metavar="PATTERN", default="Data/*", help="glob pattern of the flight files")
+parser.add_argument('-points', metavar="POINTS", type=int, help="resample every flight to this many points")
+parser.add_argument('-constraint', choices=dtwdistance.CONSTRAINTS, default="none", help="global constraint of the DTW warping path")
+parser.add_argument('-radius', metavar="POINTS", type=int, default=dtwdistance.SAKOE_CHIBA_RADIUS, help="radius of the sakoe_chiba band")
+parser.add_argument('-slope', metavar="SLOPE", type=float, default=dtwdistance.ITAKURA_SLOPE, help="maximum slope of the itakura parallelogram")
+parser.add_argument('-cache', metavar="DIRECTORY", default="dtw-cache", help="directory of the saved distance matrices")
+parser.add_argument('-representatives', metavar="FLIGHTS", type=int, default=0, help="print this many flights nearest to every cluster center")
+parser.add_argument('-j', '--workers', metavar="WORKERS", type=int, default=1, help="number of parallel jobs of the distance matrix, 0 uses every core")
+instrument.add_arguments(parser)
+args = vars(parser.parse_args())
+instrument.start(args['profile'], args['profile_calls'])
+workers = args['workers'] if args['workers'] > 0 else os.cpu_count()
+dtwSettings = (args['constraint'], args['radius'], args['slope'])
 
-dat = glob.glob("Data/*")
+rs = np.random.seed(1266)
 
-flightAlts = []
-for flight in dat:
-    flightAlts.append(getAlt(flight))
-flightAlts = to_time_series_dataset(flightAlts)
+dat = glob.glob(args['data'])
+
+if args['points']:
+    flightTimes = []
+    flightAlts = []
+    for flight in dat:
+        with instrument.stage("read"):
+            time, alt = getTimeAlt(flight)
+        flightTimes.append(time)
+        flightAlts.append(alt)
+        instrument.count("rows", len(alt))
+    with instrument.stage("resample"):
+        flightAlts = to_time_series_dataset(resample_batch(flightTimes, flightAlts, args['points']))
+else:
+    flightAlts = []
+    for flight in dat:
+        with instrument.stage("read"):
+            flightAlts.append(getAlt(flight))
+        instrument.count("rows", len(flightAlts[-1]))
+    flightAlts = to_time_series_dataset(flightAlts)
+instrument.count("files", len(dat))
 
 clusters = [2, 3, 4, 5, 6]
 inertia = []
 
-cdist = cdist_dtw(flightAlts)
+with instrument.stage("distance matrix"):
+    matrixPath = dtwdistance.matrix_path(args['cache'], dtwdistance.input_key(dat, args['points'], *dtwSettings))
+    cdist = squareform(dtwdistance.condensed_dtw(flightAlts, *dtwSettings, workers, matrixPath))
 
 for i in clusters:
-    sdtw = TimeSeriesKMeans.from_pickle(str(i) + "_cluster.pickle")
-    y_pred = sdtw.predict(flightAlts)
+    with instrument.stage("predict"):
+        sdtw = TimeSeriesKMeans.from_pickle(str(i) + "_cluster.pickle")
+        y_pred = sdtw.predict(flightAlts)
     inertia.append(sdtw.inertia_)
     print(y_pred)
 
+    if args['representatives']:
+        with instrument.stage("representatives"):
+            nearest, distances = dtwdistance.nearest(flightAlts, sdtw.cluster_centers_, args['representatives'], *dtwSettings)
+        for yi in range(i):
+            print("Cluster", yi + 1, "nearest flights:", ", ".join(os.path.basename(dat[idx]) + " (" + format(distance, ".1f") + ")" for idx, distance in zip(nearest[yi], distances[yi])))
+
     # Create data visualization
     plt.figure(figsize=(4 * i, 6), dpi=80)
     for yi in range(i):
@@ -49,13 +116,15 @@ for i in clusters:
         plt.xlim(0, 400)
         plt.ylim(0, 2200)
         plt.title(str(i) + " Cluster $k$-means: Cluster " + str(yi + 1))
-    plt.savefig(str(i) + "_clusterGraph.png")
+    with instrument.stage("plot"):
+        plt.savefig(str(i) + "_clusterGraph.png")
 
 
     # Silhouette Plot
-    avg_score = silhouette_score(cdist, y_pred)
+    with instrument.stage("silhouette"):
+        avg_score = silhouette_score(cdist, y_pred, metric="precomputed")
+        silVals = silhouette_samples(cdist, y_pred, metric="precomputed")
     print("Average silhouette score for", i, "clusters is: ", avg_score)
-    silVals = silhouette_samples(cdist, y_pred)
     # print(silVals)
     fig, ax = plt.subplots()
     y_lower = 5
@@ -81,7 +150,8 @@ for i in clusters:
         ax.set_ylabel("Cluster")
         ax.set_yticks([])
 
-    plt.savefig(str(i)+ "_clusterSilhouette.png")
+    with instrument.stage("plot"):
+        plt.savefig(str(i)+ "_clusterSilhouette.png")
 
 
 
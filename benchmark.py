@@ -0,0 +1,254 @@
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import trajstore
+import instrument
+
+# ------------------------------------------------------------------------------------------------------------
+# End-to-end benchmark of the pipeline on synthetic trajectories (see synthetic.py)
+#
+# For every scale (number of trajectories) the stages run one after the other, each as its own process exactly like
+# from the command line, and every stage is measured on its own:
+#   seconds       - wall time
+#   peakRssMB     - peak resident memory of the stage and of its worker processes
+#   throughput    - trajectories (and rows) per second
+# The results are written to a JSON file, which a later run compares against with -baseline.
+#
+# Stages: generate   synthetic.py writes the raw recordings (or a store straight away when 'process' is not run)
+#         process    flightprocess.py pre-processes them into a trajectory store
+#         polycoef, sigmoid, piecewise   fit every trajectory of the store
+#         kmeans, meanshift              cluster the polycoef.py coefficients
+# ------------------------------------------------------------------------------------------------------------
+# Run every stage at 10, 100 and 1000 trajectories and save the results:
+#           python3 benchmark.py -out ./benchmark.json
+# --------------------------------------------------------------------------------------------------------------
+# Compare a change against the saved results (stages more than -tolerance percent slower, and stages of the saved
+# results that are missing or failed, are reported):
+#           python3 benchmark.py -baseline ./benchmark.json -out ./benchmark-new.json
+# --------------------------------------------------------------------------------------------------------------
+# Large scales, fitting stages only, 8 workers (the store is generated directly):
+#           python3 benchmark.py -scales 100000 1000000 -stages generate polycoef sigmoid -j 8
+# --------------------------------------------------------------------------------------------------------------
+# Run every stage with --profile and add its own stage timers and counters (see instrument.py) to the results:
+#           python3 benchmark.py -scales 1000 -stage-profiles -out ./benchmark.json
+# --------------------------------------------------------------------------------------------------------------
+
+STAGES = ["generate", "process", "polycoef", "sigmoid", "piecewise", "kmeans", "meanshift"]
+
+# Default number of trajectories of each run
+SCALES = [10, 100, 1000]
+
+# Clusters of the kmeans stage
+CLUSTERS = 3
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def script(name):
+    return os.path.join(HERE, name)
+
+
+def stage_command(stage, directory, count, workers, seed, stages):
+    """
+    Command line of a stage
+
+    :param stage: Stage name
+    :param directory: Working directory of the scale
+    :param count: Number of trajectories
+    :param workers: Number of worker processes
+    :param seed: Seed of the synthetic trajectories
+    :param stages: Stages of the run
+    :return: Argument list, or None if the stage cannot run (its input was not produced)
+    """
+    raw = os.path.join(directory, "input")
+    output = os.path.join(directory, "output")
+    store = os.path.join(output, "trajectories")
+    fits = os.path.join(directory, "fits")
+    python = sys.executable
+
+    if stage == "generate":
+        if "process" in stages:
+            return [python, script("synthetic.py"), "-n", str(count), "-out", raw, "-seed", str(seed), "-j", str(workers)]
+        return [python, script("synthetic.py"), "-n", str(count), "-out", store, "-format", "store", "-seed", str(seed)]
+    if stage == "process":
+        return [python, script("flightprocess.py"), "-in", raw, "-out", output, "-format", "store", "-force", "-j", str(workers)]
+    if stage in ("polycoef", "sigmoid", "piecewise"):
+        if not trajstore.is_store(store):
+            return None
+        return [python, script(stage + ".py"), "-in", store, "-out", os.path.join(fits, stage), "-j", str(workers)]
+
+    # Clustering stages read the newest polycoef.py output, not the files the clustering scripts write next to it
+    outputs = sorted(glob.glob(os.path.join(fits, "polycoef", "polycoef-*[0-9].csv")))
+    if not outputs:
+        return None
+    if stage == "kmeans":
+        return [python, script("kmeans.py"), "-cc", str(CLUSTERS), outputs[-1]]
+    return [python, script("meanshift.py"), outputs[-1]]
+
+
+def peak_rss_mb(usage):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_stage(command, logPath):
+    """
+    Runs a stage in its own process and measures it
+
+    :param command: Argument list
+    :param logPath: File receiving the output of the stage
+    :return: Wall time (s), peak RSS (MB) of the stage and its worker processes & exit code
+    """
+    env = dict(os.environ, MPLBACKEND="Agg")
+    with open(logPath, "w") as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=env, cwd=HERE)
+        # wait4 gives the resource usage of this process alone (its waited-for workers included)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return seconds, peak_rss_mb(usage), process.returncode
+
+
+def store_rows(directory):
+    store = os.path.join(directory, "output", "trajectories")
+    return trajstore.TrajectoryStore(store).rows if trajstore.is_store(store) else None
+
+
+def read_profile(path):
+    """
+    Stage timers & counters of a stage run with --profile
+
+    :param path: Report written by the stage
+    :return: Dictionary, or None if the stage wrote no report
+    """
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        report = json.load(f)
+    return {key: report[key] for key in ("stages", "workerStages", "counters", "cpuSeconds", "childCpuSeconds")}
+
+
+def run(scales, stages, workers=1, seed=0, workDirectory=None, stageProfiles=False):
+    """
+    Runs the stages at every scale
+
+    :param scales: List of numbers of trajectories
+    :param stages: List of stage names, run in the order of STAGES
+    :param workers: Number of worker processes of every stage
+    :param seed: Seed of the synthetic trajectories
+    :param workDirectory: Directory of the generated files (a temporary directory removed at the end if None)
+    :param stageProfiles: Run every stage with --profile and add its report to its result
+    :return: List of result dictionaries, one per scale and stage
+    """
+    stages = [stage for stage in STAGES if stage in stages]
+    temporary = workDirectory is None
+    # The stages run from the repository folder, their paths must not depend on the current directory
+    workDirectory = tempfile.mkdtemp(prefix="flightbench-") if temporary else os.path.abspath(workDirectory)
+    results = []
+    try:
+        for count in scales:
+            directory = os.path.join(workDirectory, str(count))
+            shutil.rmtree(directory, ignore_errors=True)
+            os.makedirs(directory)
+            for stage in stages:
+                command = stage_command(stage, directory, count, workers, seed, stages)
+                if command is None:
+                    print(f"{count:>9} {stage:<10} skipped, its input was not produced by an earlier stage")
+                    continue
+                profilePath = os.path.join(directory, stage + "-profile.json")
+                if stageProfiles:
+                    command.append("--profile=" + profilePath)
+                seconds, rss, code = run_stage(command, os.path.join(directory, stage + ".log"))
+                rows = store_rows(directory)
+                result = {"scale": count, "stage": stage, "trajectories": count, "rows": rows, "seconds": round(seconds, 4),
+                          "peakRssMB": round(rss, 1), "trajectoriesPerSecond": round(count / seconds, 2),
+                          "rowsPerSecond": round(rows / seconds, 1) if rows else None, "exitCode": code}
+                if stageProfiles:
+                    result["profile"] = read_profile(profilePath)
+                results.append(result)
+                print(f"{count:>9} {stage:<10} {seconds:10.2f} s {rss:9.1f} MB {count / seconds:12.1f} trajectories/s"
+                      + ("" if code == 0 else f"  FAILED ({code}), see {os.path.join(directory, stage + '.log')}"))
+    finally:
+        if temporary:
+            shutil.rmtree(workDirectory, ignore_errors=True)
+    return results
+
+
+def environment(workers):
+    import pandas
+    return {"platform": platform.platform(), "python": platform.python_version(), "numpy": np.__version__,
+            "pandas": pandas.__version__, "cpus": os.cpu_count(), "workers": workers}
+
+
+def compare(results, baseline, tolerance=10.0):
+    """
+    Prints the change of every stage against a baseline run. A stage of the baseline that is missing from this run or
+    failed in it is reported as a regression
+
+    :param results: Results of this run
+    :param baseline: Results of the baseline run
+    :param tolerance: Percentage of extra wall time or memory reported as a regression
+    :return: Number of regressions
+    """
+    current = {(result["scale"], result["stage"]): result for result in results}
+    previous = {(result["scale"], result["stage"]): result for result in baseline}
+    regressions = 0
+    print(f"{'scale':>9} {'stage':<10} {'time':>8} {'memory':>8}")
+    for key, before in previous.items():
+        if key not in current and before["exitCode"] == 0:
+            regressions += 1
+            print(f"{key[0]:>9} {key[1]:<10} {'':>8} {'':>8}  MISSING from this run")
+    for result in results:
+        before = previous.get((result["scale"], result["stage"]))
+        if before is None or before["exitCode"] != 0:
+            continue
+        if result["exitCode"] != 0:
+            regressions += 1
+            print(f"{result['scale']:>9} {result['stage']:<10} {'':>8} {'':>8}  FAILED ({result['exitCode']})")
+            continue
+        timeChange = 100 * (result["seconds"] / before["seconds"] - 1)
+        memoryChange = 100 * (result["peakRssMB"] / before["peakRssMB"] - 1)
+        slower = timeChange > tolerance or memoryChange > tolerance
+        regressions += slower
+        print(f"{result['scale']:>9} {result['stage']:<10} {timeChange:+7.1f}% {memoryChange:+7.1f}%" + ("  REGRESSION" if slower else ""))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Times every stage of the pipeline on synthetic trajectories")
+
+    parser.add_argument('-scales', metavar="COUNT", type=int, nargs="+", default=SCALES, help="Numbers of trajectories, 10 to 1000000")
+    parser.add_argument('-stages', metavar="STAGE", nargs="+", choices=STAGES, default=STAGES, help="Stages to run")
+    parser.add_argument('-j', '--workers', metavar="WORKERS", type=int, default=1, help="Number of worker processes of every stage, 0 uses every core")
+    parser.add_argument('-seed', metavar="SEED", type=int, default=0, help="Seed of the synthetic trajectories")
+    parser.add_argument('-work', metavar="DIRECTORY", help="Keep the generated files in this directory (a temporary directory is removed otherwise)")
+    parser.add_argument('-out', metavar="FILE", help="Write the results to this JSON file")
+    parser.add_argument('-baseline', metavar="FILE", help="Compare the results with a JSON file written by an earlier run")
+    parser.add_argument('-tolerance', metavar="PERCENT", type=float, default=10.0, help="Extra time or memory reported as a regression")
+    parser.add_argument('-stage-profiles', action="store_true", help="Run every stage with --profile and add its stage timers and counters to the results")
+    instrument.add_arguments(parser)
+
+    args = vars(parser.parse_args())
+    instrument.start(args['profile'], args['profile_calls'])
+    workers = args['workers'] if args['workers'] > 0 else os.cpu_count()
+
+    results = run(args['scales'], args['stages'], workers, args['seed'], args['work'], args['stage_profiles'])
+
+    if args['out']:
+        with open(args['out'], "w") as f:
+            json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "environment": environment(workers), "seed": args['seed'],
+                       "results": results}, f, indent=2)
+
+    if args['baseline']:
+        with open(args['baseline']) as f:
+            regressions = compare(results, json.load(f)["results"], args['tolerance'])
+        sys.exit(1 if regressions else 0)
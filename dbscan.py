@@ -0,0 +1,237 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import features
+import instrument
+import matplotlib.pyplot as plt
+from sklearn.neighbors import NearestNeighbors
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+# ------------------------------------------------------------------------------------------------------------
+# DBSCAN clustering of the trajectories of a coefficient file (polycoef.py, sigmoid.py ...), writes <input>_dbscan.csv
+# with a 'Cluster_ID' column (-1 for noise) and prints the trajectories of every cluster like meanshift.py
+#           python3 dbscan.py ./output/polycoef-20260101-120000.csv
+# --------------------------------------------------------------------------------------------------------------
+# The points are indexed once in a KD tree (or ball tree) and the radius-neighbor graph is built once at the largest eps.
+# Every eps / min_samples of a grid is then answered from that graph: the edges up to eps give the core points and the
+# clusters are the connected components of the core points, without searching the neighbors again. A grid writes one
+# 'Cluster_ID eps=... min_samples=...' column per setting and prints the clusters & noise of each
+#           python3 dbscan.py ./output/polycoef-20260101-120000.csv -eps 20 40 80 -min-samples 3 5 10
+# --------------------------------------------------------------------------------------------------------------
+# Without -eps, eps is the knee of the k-distance graph (distance of every point to its (min_samples - 1)th nearest
+# neighbor, sorted), which is shown for every min_samples with the eps values used
+#           python3 dbscan.py ./output/polycoef-20260101-120000.csv -min-samples 4 -algorithm ball_tree
+# --------------------------------------------------------------------------------------------------------------
+
+# Smallest number of points (the point itself included) within eps of a core point
+MIN_SAMPLES = 5
+
+# Points per leaf of the tree
+LEAF_SIZE = 30
+
+
+def k_distances(index, points, ks):
+    """
+    Distance of every point to its kth nearest neighbor (the point itself left out) for several k, from one query
+
+    :param index: Fitted NearestNeighbors
+    :param points: Points (n, d)
+    :param ks: Values of k
+    :return: Dictionary of k to the distances (n,) sorted in decreasing order
+    """
+    largest = min(max(ks), len(points) - 1)
+    if largest < 1:
+        return {k: np.zeros(len(points)) for k in ks}
+    # The first neighbor of every point is itself
+    distances, _ = index.kneighbors(points, n_neighbors=largest + 1)
+    return {k: np.sort(distances[:, min(k, largest)])[::-1] for k in ks}
+
+
+def knee(sortedDistances):
+    """
+    Knee of a decreasing k-distance curve: the point farthest from the line joining its first and last points
+
+    :param sortedDistances: Distances sorted in decreasing order
+    :return: Distance at the knee
+    """
+    n = len(sortedDistances)
+    if n < 3:
+        return float(sortedDistances[-1]) if n else 0.0
+    x = np.linspace(0, 1, n)
+    span = sortedDistances[0] - sortedDistances[-1]
+    y = (sortedDistances - sortedDistances[-1]) / span if span > 0 else np.zeros(n)
+    # Distance to the chord from (0, 1) to (1, 0), up to a constant factor
+    return float(sortedDistances[np.argmax(np.abs(x + y - 1))])
+
+
+def radius_graph(index, points, radius):
+    """
+    Neighbors of every point within the largest eps, computed once for the whole grid
+
+    :param index: Fitted NearestNeighbors
+    :param points: Points (n, d)
+    :param radius: Largest eps
+    :return: CSR matrix of the distances to the neighbors (the point itself left out), sorted by distance in every row
+    """
+    distances, neighbors = index.radius_neighbors(points, radius=radius, sort_results=True)
+    lengths = np.array([len(row) for row in neighbors])
+    rows = np.repeat(np.arange(len(points)), lengths)
+    columns = np.concatenate(neighbors) if len(points) else np.empty(0, dtype=int)
+    values = np.concatenate(distances) if len(points) else np.empty(0)
+    other = columns != rows
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows[other], minlength=len(points)))])
+    return csr_matrix((values[other], columns[other], indptr), shape=(len(points), len(points)))
+
+
+def within(graph, eps):
+    """
+    Edges of the radius graph up to eps
+
+    :param graph: Radius graph (rows sorted by distance)
+    :param eps: Radius
+    :return: CSR matrix of the neighbors within eps
+    """
+    keep = graph.data <= eps
+    counts = np.add.reduceat(np.append(keep, False).astype(np.int64), graph.indptr[:-1]) if graph.shape[0] else np.empty(0, dtype=np.int64)
+    # reduceat gives the value at the start of an empty row instead of 0
+    counts[np.diff(graph.indptr) == 0] = 0
+    indptr = np.concatenate([[0], np.cumsum(counts)])
+    return csr_matrix((graph.data[keep], graph.indices[keep], indptr), shape=graph.shape)
+
+
+def dbscan_labels(neighbors, minSamples):
+    """
+    DBSCAN labels from the neighbors within eps. Core points have at least minSamples points within eps (themselves
+    included), the clusters are the connected components of the core points and every other point within eps of a core
+    point joins the cluster of its nearest core point. The clusters are the same as sklearn's DBSCAN, a border point
+    within eps of two clusters may be given to the other one
+
+    :param neighbors: CSR matrix of the neighbors within eps (rows sorted by distance)
+    :param minSamples: Smallest number of points within eps of a core point
+    :return: Cluster of every point, -1 for noise
+    """
+    n = neighbors.shape[0]
+    core = np.diff(neighbors.indptr) + 1 >= minSamples
+    labels = np.full(n, -1)
+    if not core.any():
+        return labels
+
+    coreIdx = np.flatnonzero(core)
+    coreGraph = neighbors[coreIdx][:, coreIdx]
+    _, components = connected_components(coreGraph, directed=False)
+    labels[coreIdx] = components
+
+    # Border points: the first core neighbor of the row is the nearest one
+    rows = np.repeat(np.arange(n), np.diff(neighbors.indptr))
+    coreEdge = core[neighbors.indices] & ~core[rows]
+    borderRows, first = np.unique(rows[coreEdge], return_index=True)
+    labels[borderRows] = labels[neighbors.indices[coreEdge][first]]
+    return labels
+
+
+def dbscan_grid(index, points, epsValues, minSamplesValues):
+    """
+    DBSCAN labels for every eps & min_samples, from a single radius-neighbor graph built at the largest eps
+
+    :param index: NearestNeighbors fitted on points (KD tree or ball tree)
+    :param points: Points (n, d)
+    :param epsValues: Values of eps
+    :param minSamplesValues: Values of min_samples
+    :return: Dictionary of (eps, min_samples) to labels
+    """
+    with instrument.stage("radius graph"):
+        graph = radius_graph(index, points, max(epsValues))
+    instrument.count("neighbor pairs", graph.nnz)
+
+    results = {}
+    for eps in sorted(epsValues):
+        neighbors = within(graph, eps)
+        for minSamples in minSamplesValues:
+            with instrument.stage("labels"):
+                results[(eps, minSamples)] = dbscan_labels(neighbors, minSamples)
+    return results
+
+
+def grid_column(eps, minSamples):
+    return f"Cluster_ID eps={eps:g} min_samples={minSamples}"
+
+
+def draw_k_distances(curves, epsValues):
+    """
+    k-distance graph of every min_samples, with the eps values used
+
+    :param curves: Dictionary of min_samples to the sorted k-distances
+    :param epsValues: Values of eps
+    """
+    fig, ax = plt.subplots()
+    for minSamples, distances in curves.items():
+        ax.plot(np.arange(1, len(distances) + 1), distances, label=f"min_samples={minSamples}")
+    for eps in epsValues:
+        ax.axhline(eps, color="red", linestyle="--", linewidth=0.8)
+    ax.set_xlabel("Trajectories sorted by distance")
+    ax.set_ylabel("Distance to the (min_samples - 1)th neighbor")
+    ax.set_title("DBSCAN k-distance Graph")
+    ax.legend()
+
+
+if __name__ == '__main__':
+    #parsing of arguments
+    parser = argparse.ArgumentParser(description="DBSCAN clustering of the trajectories of a coefficient file")
+    parser.add_argument('input', metavar="INPUT", help="Coefficient file (e.g. polycoef-<time>.csv)")
+    parser.add_argument('-eps', metavar="EPS", type=float, nargs="+", help="Neighborhood radius, several values answer a grid (default: knee of the k-distance graph)")
+    parser.add_argument('-min-samples', metavar="POINTS", type=int, nargs="+", default=[MIN_SAMPLES], help="Points within eps of a core point, itself included")
+    parser.add_argument('-algorithm', choices=["kd_tree", "ball_tree"], default="kd_tree", help="Index of the neighbor searches")
+    parser.add_argument('-leaf-size', metavar="POINTS", type=int, default=LEAF_SIZE, help="Points per leaf of the index")
+    instrument.add_arguments(parser)
+    args = vars(parser.parse_args())
+    instrument.start(args['profile'], args['profile_calls'])
+
+    if os.path.exists(args['input']) == False:
+        print("Given dataset file does not exists")
+        raise SystemExit(0)
+
+    inputFile = args['input'] #getting input file
+    outputFile = inputFile.replace(".csv","_dbscan.csv") #renaming input file to output file
+    minSamplesValues = sorted(set(max(1, m) for m in args['min_samples']))
+
+    #dataset reading, the coefficients are loaded as a float matrix (from the .npz saved next to the csv when there is one)
+    with instrument.stage("load"):
+        dataset, trajectory, points = features.load_features(inputFile)
+    instrument.count("trajectories", len(points))
+
+    #the index is built once and answers both the k-distance graph and the radius graph
+    with instrument.stage("index"):
+        index = NearestNeighbors(algorithm=args['algorithm'], leaf_size=args['leaf_size']).fit(points)
+
+    #k-distance graph of every min_samples, its knee is the default eps
+    with instrument.stage("k-distance"):
+        curves = k_distances(index, points, [m - 1 for m in minSamplesValues])
+    curves = {m: curves[m - 1] for m in minSamplesValues}
+    epsValues = sorted(set(args['eps'])) if args['eps'] else [knee(curves[minSamplesValues[0]])]
+    if not args['eps']:
+        print(f"eps from the k-distance graph: {epsValues[0]:g}")
+
+    with instrument.stage("dbscan"):
+        results = dbscan_grid(index, points, epsValues, minSamplesValues)
+
+    print("\nDBSCAN Clustering Output\n")
+    if len(results) == 1:
+        labels = next(iter(results.values()))
+        dataset['Cluster_ID'] = pd.Series(labels, index=dataset.index)
+        for i in range(0,labels.max()+1):
+            output = dataset.loc[dataset['Cluster_ID'] == i, 'Trajectories']
+            print(str(i)+" : "+str(', '.join(output.tolist()))+"\n")
+        output = dataset.loc[dataset['Cluster_ID'] == -1, 'Trajectories']
+        print("noise : "+str(', '.join(output.tolist()))+"\n")
+    else:
+        print(f"{'eps':>12} {'min_samples':>12} {'clusters':>9} {'noise':>7}")
+        for (eps, minSamples), labels in results.items():
+            dataset[grid_column(eps, minSamples)] = pd.Series(labels, index=dataset.index)
+            print(f"{eps:>12g} {minSamples:>12} {labels.max() + 1:>9} {100 * (labels == -1).mean():>6.1f}%")
+    with instrument.stage("write"):
+        dataset.to_csv(outputFile,index=False)
+
+    draw_k_distances(curves, epsValues)
+    plt.show()
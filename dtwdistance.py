@@ -0,0 +1,237 @@
+import os
+import json
+import hashlib
+import numpy as np
+import instrument
+from tslearn.metrics import cdist_dtw, lb_envelope, sakoe_chiba_mask, itakura_mask
+
+# ------------------------------------------------------------------------------------------------------------
+# DTW distances between flights used by ClusterEval.py
+#
+#   condensed_dtw - every pair of flights (the upper triangle of the matrix, in scipy's condensed order) as float32,
+#                   written to a memory-mapped file keyed by the input files and the settings, so that a later run on
+#                   the same flights maps the file instead of computing the matrix again
+#   nearest       - nearest flights of a few query series (cluster centers ...) without the whole matrix: the flights
+#                   are visited in order of their LB_Kim / LB_Keogh lower bound and the exact DTW is only computed
+#                   while a bound is below the distance of the kth flight found so far
+#
+# The warping path can be kept in a global constraint:
+#   none        - any path, O(L^2) per pair
+#   sakoe_chiba - |i - j| <= radius, O(L * radius) per pair
+#   itakura     - parallelogram of the given maximum slope
+# Series padded with NaN (flights of different lengths) are compared on their own points.
+# ------------------------------------------------------------------------------------------------------------
+
+CONSTRAINTS = ["none", "sakoe_chiba", "itakura"]
+
+# Points the warping path may stray from the diagonal with sakoe_chiba
+SAKOE_CHIBA_RADIUS = 10
+
+# Maximum slope of the itakura parallelogram
+ITAKURA_SLOPE = 2.0
+
+# Flights (rows of the matrix) computed at a time
+BLOCK_ROWS = 256
+
+# Flights whose exact distance to a query is computed at a time by nearest, in the order of their lower bound
+NEIGHBOR_BATCH = 32
+
+
+def constraint_args(constraint, radius=SAKOE_CHIBA_RADIUS, slope=ITAKURA_SLOPE):
+    """
+    Keyword arguments of the tslearn DTW functions for a global constraint
+
+    :param constraint: 'none', 'sakoe_chiba' or 'itakura'
+    :param radius: Radius of sakoe_chiba
+    :param slope: Maximum slope of itakura
+    :return: Dictionary
+    """
+    if constraint == "sakoe_chiba":
+        return {"global_constraint": "sakoe_chiba", "sakoe_chiba_radius": radius}
+    if constraint == "itakura":
+        return {"global_constraint": "itakura", "itakura_max_slope": slope}
+    return {}
+
+
+def band_radius(size1, size2, constraint, radius=SAKOE_CHIBA_RADIUS, slope=ITAKURA_SLOPE):
+    """
+    Farthest a warping path allowed by the constraint goes from the diagonal, the radius of the LB_Keogh envelope
+
+    :param size1: Length of the first series
+    :param size2: Length of the second series
+    :param constraint: 'none', 'sakoe_chiba' or 'itakura'
+    :param radius: Radius of sakoe_chiba
+    :param slope: Maximum slope of itakura
+    :return: Largest |i - j| of the cells the path may go through
+    """
+    if constraint == "sakoe_chiba":
+        mask = sakoe_chiba_mask(size1, size2, radius)
+    elif constraint == "itakura":
+        mask = itakura_mask(size1, size2, slope)
+    else:
+        return max(size1, size2) - 1
+    i, j = np.nonzero(mask)
+    return int(np.abs(i - j).max()) if len(i) else 0
+
+
+def input_key(paths, points, constraint, radius=SAKOE_CHIBA_RADIUS, slope=ITAKURA_SLOPE):
+    """
+    Key of a distance matrix: the input files (path, size & modification time, in the order of the rows) and the settings
+
+    :param paths: Flight files, one per row
+    :param points: Points every flight was resampled to, None if they were not
+    :param constraint: 'none', 'sakoe_chiba' or 'itakura'
+    :param radius: Radius of sakoe_chiba
+    :param slope: Maximum slope of itakura
+    :return: Hex digest
+    """
+    files = []
+    for path in paths:
+        info = os.stat(path)
+        files.append([os.path.abspath(path), info.st_size, info.st_mtime_ns])
+    settings = {"points": points, "constraint": constraint, **constraint_args(constraint, radius, slope)}
+    return hashlib.sha256(json.dumps([files, settings], sort_keys=True).encode()).hexdigest()
+
+
+def series_sizes(series):
+    """
+    Length of every series of a NaN padded dataset (tslearn's ts_size is slow on numpy arrays)
+
+    :param series: Time series dataset (n, L, 1)
+    :return: Lengths (n,)
+    """
+    present = ~np.isnan(series[:, :, 0])
+    return series.shape[1] - np.argmax(present[:, ::-1], axis=1)
+
+
+def matrix_path(directory, key):
+    return os.path.join(directory, f"dtw-{key[:32]}.f32")
+
+
+def condensed_dtw(series, constraint="none", radius=SAKOE_CHIBA_RADIUS, slope=ITAKURA_SLOPE, workers=1, path=None):
+    """
+    DTW distance of every pair of series, in the order of scipy.spatial.distance.squareform
+
+    :param series: Time series dataset (n, L, 1), NaN padded
+    :param constraint: 'none', 'sakoe_chiba' or 'itakura'
+    :param radius: Radius of sakoe_chiba
+    :param slope: Maximum slope of itakura
+    :param workers: Number of parallel jobs
+    :param path: Memory-mapped file of the result, mapped if it was already written (None keeps it in memory)
+    :return: float32 array (n * (n - 1) / 2,)
+    """
+    n = len(series)
+    pairs = n * (n - 1) // 2
+    if path is not None and os.path.isfile(path) and os.path.getsize(path) == pairs * 4:
+        instrument.count("dtw matrix cache hits")
+        return np.memmap(path, dtype=np.float32, mode="r", shape=(pairs,))
+
+    if path is None:
+        condensed = np.empty(pairs, dtype=np.float32)
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        condensed = np.memmap(path + ".tmp", dtype=np.float32, mode="w+", shape=(pairs,))
+    kwargs = constraint_args(constraint, radius, slope)
+    for start in range(0, n - 1, BLOCK_ROWS):
+        stop = min(start + BLOCK_ROWS, n - 1)
+        # Rows start ... stop - 1 against every later series, the block's own lower triangle is computed but dropped
+        block = cdist_dtw(series[start:stop], series[start:], n_jobs=workers, **kwargs)
+        for i in range(start, stop):
+            offset = i * n - i * (i + 1) // 2
+            condensed[offset:offset + n - i - 1] = block[i - start, i - start + 1:]
+        instrument.count("dtw pairs", (stop - start) * (n - start) - (stop - start) * (stop - start + 1) // 2)
+
+    if path is None:
+        return condensed
+    condensed.flush()
+    del condensed
+    os.replace(path + ".tmp", path)
+    return np.memmap(path, dtype=np.float32, mode="r", shape=(pairs,))
+
+
+def lb_kim(query, firsts, lasts, sizes):
+    """
+    LB_Kim of a query against every series: every warping path matches the first points together and the last points
+    together
+
+    :param query: Query series (its own points, no padding)
+    :param firsts: First value of every series
+    :param lasts: Last value of every series
+    :param sizes: Length of every series
+    :return: Lower bounds (n,)
+    """
+    first = (query[0] - firsts) ** 2
+    last = (query[-1] - lasts) ** 2
+    # A series of one point against a query of one point only has one cell
+    last[(sizes == 1) & (len(query) == 1)] = 0
+    return np.sqrt(first + last)
+
+
+def lb_keogh(query, values, radius):
+    """
+    LB_Keogh of a query against series of its own length: every point of a series is matched to a point of the query
+    at most radius away, so the distance to the query's running min/max envelope is a lower bound
+
+    :param query: Query series (L,)
+    :param values: Series (n, L)
+    :param radius: Envelope radius, see band_radius
+    :return: Lower bounds (n,)
+    """
+    lower, upper = lb_envelope(query.reshape(-1, 1), radius=radius)
+    lower, upper = lower.ravel(), upper.ravel()
+    above = np.clip(values - upper, 0, None)
+    below = np.clip(lower - values, 0, None)
+    return np.sqrt((above ** 2 + below ** 2).sum(axis=1))
+
+
+def nearest(series, queries, k=1, constraint="none", radius=SAKOE_CHIBA_RADIUS, slope=ITAKURA_SLOPE):
+    """
+    k nearest series of every query by DTW, pruned with LB_Kim and, for series of the query's length, LB_Keogh
+
+    :param series: Time series dataset (n, L, 1), NaN padded
+    :param queries: Query series (m, L', 1), NaN padded
+    :param k: Number of neighbors
+    :param constraint: 'none', 'sakoe_chiba' or 'itakura'
+    :param radius: Radius of sakoe_chiba
+    :param slope: Maximum slope of itakura
+    :return: Indices (m, k) & distances (m, k) of the neighbors, nearest first
+    """
+    n = len(series)
+    k = min(k, n)
+    sizes = series_sizes(series)
+    values = series[:, :, 0]
+    firsts = values[:, 0]
+    lasts = values[np.arange(n), sizes - 1]
+    kwargs = constraint_args(constraint, radius, slope)
+
+    indices = np.empty((len(queries), k), dtype=int)
+    distances = np.empty((len(queries), k))
+    for q, (query, size) in enumerate(zip(queries, series_sizes(queries))):
+        query = query[:size, 0]
+        bounds = lb_kim(query, firsts, lasts, sizes)
+        same = sizes == len(query)
+        if same.any():
+            envelope = band_radius(len(query), len(query), constraint, radius, slope)
+            bounds[same] = np.maximum(bounds[same], lb_keogh(query, values[same, :len(query)], envelope))
+
+        order = np.argsort(bounds, kind="stable")
+        found = np.empty(0, dtype=int)
+        foundDistances = np.empty(0)
+        computed = 0
+        # The exact distances are computed a batch at a time (one tslearn call per pair costs more than the pair itself)
+        while computed < n:
+            # Every later series has a bound at least as large
+            if len(found) == k and bounds[order[computed]] >= foundDistances[-1]:
+                break
+            batch = order[computed:computed + NEIGHBOR_BATCH]
+            computed += len(batch)
+            batchDistances = cdist_dtw(query.reshape(1, -1, 1), series[batch], **kwargs)[0]
+            found = np.concatenate([found, batch])
+            foundDistances = np.concatenate([foundDistances, batchDistances])
+            keep = np.argsort(foundDistances, kind="stable")[:k]
+            found, foundDistances = found[keep], foundDistances[keep]
+        instrument.count("dtw computed", computed)
+        instrument.count("dtw pruned", n - computed)
+        indices[q] = found
+        distances[q] = foundDistances
+    return indices, distances
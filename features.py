@@ -0,0 +1,181 @@
+import os
+import numpy as np
+import pandas as pd
+import trajstore
+from resample import resample_batch
+
+# ------------------------------------------------------------------------------------------------------------
+# Numeric coefficient (feature) matrices written by polycoef.py and sigmoid.py and read by the clustering scripts
+#
+# Every coefficient is its own float column of the output csv, named '<group> <coefficient>' (e.g. 'Degree=3 x^2' or
+# 'Coefficient a'). The same values are saved next to the csv in a .npz sidecar (same name, .npz extension) holding:
+#   names     - trajectory names, one per row
+#   columns   - name of every feature column
+#   features  - float64 matrix of shape (trajectories, columns)
+#
+# load_features reads the sidecar when it exists, the numeric csv columns otherwise, and still understands the older
+# csv files holding every coefficient of a group as a single comma separated string.
+#
+# iter_features reads the same rows a chunk at a time, and iter_resampled turns the trajectories of a folder or store into
+# resampled altitude profiles a chunk at a time, so a clustering pass over millions of trajectories (kmeans.py
+# -minibatch) never holds the whole matrix.
+# ------------------------------------------------------------------------------------------------------------
+
+SIDECAR_EXTENSION = ".npz"
+
+# Rows read at a time by iter_features & iter_resampled
+CHUNK_ROWS = 10000
+
+
+def sidecar_path(csvPath):
+    """
+    Path of the .npz sidecar of an output csv
+
+    :param csvPath: Path of the csv file
+    :return: Path of the sidecar
+    """
+    return os.path.splitext(str(csvPath))[0] + SIDECAR_EXTENSION
+
+
+def group_of(column):
+    """
+    Group of a feature column, everything before its last space ('Degree=3 x^2' -> 'Degree=3')
+
+    :param column: Column name
+    :return: Group name
+    """
+    return column.rsplit(" ", 1)[0]
+
+
+def save_features(csvPath, names, features, columns):
+    """
+    Writes the sidecar of an output csv
+
+    :param csvPath: Path of the csv file the features were written to
+    :param names: Trajectory names, one per row of features
+    :param features: Matrix of shape (trajectories, columns)
+    :param columns: Name of every feature column
+    :return: Path of the sidecar
+    """
+    path = sidecar_path(csvPath)
+    np.savez(path, names=np.asarray(names, dtype=str), columns=np.asarray(columns, dtype=str),
+             features=np.ascontiguousarray(features, dtype=np.float64))
+    return path
+
+
+def parse_coefficient_strings(values):
+    """
+    Parses a column of comma separated coefficient strings (older output files) in one pass
+
+    :param values: Array of strings, all with the same number of coefficients
+    :return: Float matrix with one row per string
+    """
+    split = pd.Series(values, dtype=str).str.split(",", expand=True)
+    return np.ascontiguousarray(split.apply(lambda column: column.str.strip()).astype(float).to_numpy())
+
+
+def load_features(csvPath, group=None):
+    """
+    Loads the feature matrix of a polycoef.py or sigmoid.py output file.
+    Only rows with a trajectory name and finite features are kept (the Mean-MSR row of polycoef.py and the failed fits of
+    sigmoid.py are left out)
+
+    :param csvPath: Path of the csv file
+    :param group: Group of coefficients to use (e.g. 'Degree=3'), the first group of the file if None
+    :return: Dataset (the csv rows kept), trajectory names and contiguous float64 feature matrix
+    """
+    dataset = pd.read_csv(csvPath)
+    named = dataset["Trajectories"].notna().to_numpy()
+
+    sidecar = sidecar_path(csvPath)
+    features = None
+    if os.path.isfile(sidecar):
+        with np.load(sidecar) as data:
+            columns = list(data["columns"])
+            # The sidecar has one row per named csv row, it is ignored if the csv was changed since
+            if len(data["names"]) == named.sum() and (data["names"] == dataset["Trajectories"][named].astype(str).to_numpy()).all():
+                features = np.full((len(dataset), len(columns)), np.nan)
+                features[named] = data["features"]
+
+    if features is None:
+        columns = [column for column in dataset.columns[1:] if pd.api.types.is_numeric_dtype(dataset[column]) and " " in column]
+        if columns:
+            features = dataset[columns].to_numpy(dtype=float)
+        else:
+            # Older files: every coefficient of the first group in column 1 as a single string
+            values = dataset.iloc[:, 1]
+            present = values.notna().to_numpy()
+            parsed = parse_coefficient_strings(values[present].to_numpy())
+            features = np.full((len(dataset), parsed.shape[1]), np.nan)
+            features[present] = parsed
+            columns = [f"{group_of(dataset.columns[1])} {idx}" for idx in range(parsed.shape[1])]
+
+    if group is None:
+        group = group_of(columns[0])
+    selected = [idx for idx, column in enumerate(columns) if group_of(column) == group]
+    if not selected:
+        raise ValueError(f"No coefficients of group '{group}' in {csvPath}")
+
+    points = features[:, selected]
+    keep = named & np.isfinite(points).all(axis=1)
+    dataset = dataset[keep].reset_index(drop=True)
+    return dataset, dataset["Trajectories"].to_numpy(), np.ascontiguousarray(points[keep])
+
+
+def iter_features(csvPath, group=None, chunkRows=CHUNK_ROWS):
+    """
+    Reads the rows & features of a polycoef.py or sigmoid.py output file a chunk of rows at a time, the same rows and
+    features as load_features. Only the column names are read from the sidecar, every value comes from the csv
+
+    :param csvPath: Path of the csv file
+    :param group: Group of coefficients to use (e.g. 'Degree=3'), the first group of the file if None
+    :param chunkRows: Number of csv rows read at a time
+    :return: Generator of (dataset rows kept, trajectory names, contiguous float64 feature matrix) per chunk
+    """
+    columns = None
+    sidecar = sidecar_path(csvPath)
+    if os.path.isfile(sidecar):
+        with np.load(sidecar) as data:
+            columns = list(data["columns"])
+
+    with pd.read_csv(csvPath, chunksize=chunkRows, float_precision="round_trip") as chunks:
+        for dataset in chunks:
+            if columns is None:
+                columns = [column for column in dataset.columns[1:] if pd.api.types.is_numeric_dtype(dataset[column]) and " " in column]
+                if not columns:
+                    raise ValueError(f"{csvPath} has no float coefficient columns, load it with load_features")
+            if group is None:
+                group = group_of(columns[0])
+            selected = [column for column in columns if group_of(column) == group]
+            if not selected:
+                raise ValueError(f"No coefficients of group '{group}' in {csvPath}")
+
+            points = dataset[selected].to_numpy(dtype=float)
+            keep = dataset["Trajectories"].notna().to_numpy() & np.isfinite(points).all(axis=1)
+            dataset = dataset[keep]
+            yield dataset, dataset["Trajectories"].to_numpy(), np.ascontiguousarray(points[keep])
+
+
+def iter_resampled(path, points, chunkRows=CHUNK_ROWS, column="Alt - Ground Level"):
+    """
+    Resamples every trajectory of a folder of out*.csv files or of a store to the same number of points on its 'Time'
+    column (see resample.resample_batch), a chunk of trajectories at a time
+
+    :param path: Folder or store path
+    :param points: Number of points of every trajectory
+    :param chunkRows: Number of trajectories resampled at a time
+    :param column: Column resampled
+    :return: Generator of (dataframe of the trajectory names, names, float64 matrix (trajectories, points)) per chunk
+    """
+    count = trajstore.count_trajectories(path)
+    for start in range(0, count, chunkRows):
+        names = []
+        times = []
+        values = []
+        for name, data in trajstore.iter_trajectories(path, start, min(start + chunkRows, count)):
+            if len(data["Time"]):
+                names.append(name)
+                times.append(data["Time"])
+                values.append(data[column])
+        names = np.asarray(names, dtype=object)
+        yield pd.DataFrame({"Trajectories": names}), names, resample_batch(times, values, points)
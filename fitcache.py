@@ -0,0 +1,264 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import numpy as np
+import trajstore
+import instrument
+from manifest import file_digest
+
+# ------------------------------------------------------------------------------------------------------------
+# On-disk cache of fit results, shared by polycoef.py and sigmoid.py (-cache)
+#
+# Every trajectory's result is stored under a key made of the model name, its parameters (degree range, solver
+# settings ...) and the content hash of the trajectory: the SHA-256 of the out*.csv file, or of the fitted columns for a
+# trajectory of a store. A trajectory that did not change since a previous run with the same parameters is never read
+# or fitted again. The cache is a single SQLite file:
+#   fits   - key, result (float64 vector), note (e.g. the status of a sigmoid fit), size in bytes & last use
+# Once it holds more than its size limit, the entries used least recently are removed.
+#
+# A model whose fits warm start from the previous trajectories (sigmoid.py) caches whole ranges instead (wholeRange):
+# the key of every trajectory also covers the hashes of the other trajectories of its range, and a range is fitted again
+# as a whole as soon as one of its results is missing, so a cached run gives the same results as an uncached one.
+#
+# Worker processes only read the cache (cached_range); the main process records the new results and the uses, so there
+# is a single writer.
+# ------------------------------------------------------------------------------------------------------------
+
+CACHE_NAME = "fitcache.sqlite"
+
+# Size limit in MB
+MAX_MB = 512
+
+# Columns a model fits, the content hash of a store trajectory covers these columns only
+FIT_COLUMNS = ["Distance From Start (nmi)", "Alt - Ground Level"]
+
+
+def trajectory_key(model, params, digest):
+    """
+    Cache key of a trajectory's fit
+
+    :param model: Model name (e.g. 'polycoef')
+    :param params: Dictionary of the model parameters, anything that changes the result
+    :param digest: Content hash of the trajectory
+    :return: Hex key
+    """
+    return hashlib.sha256(json.dumps([model, params, digest], sort_keys=True).encode()).hexdigest()
+
+
+def trajectory_digests(path, start, stop, columns=FIT_COLUMNS):
+    """
+    Content hashes of the trajectories start to stop - 1 of a folder or store, csv files are hashed without being parsed
+
+    :param path: Folder of out*.csv files or trajectory store
+    :param start: Index of the first trajectory
+    :param stop: Index after the last trajectory
+    :param columns: Columns hashed for a store trajectory
+    :return: Names & hex digests of the trajectories
+    """
+    if trajstore.is_store(path):
+        store = trajstore.TrajectoryStore(path)
+        names = store.names[start:stop]
+        digests = []
+        for idx in range(start, start + len(names)):
+            digest = hashlib.sha256()
+            for column in columns:
+                digest.update(column.encode())
+                digest.update(np.ascontiguousarray(store.column(column, idx)).tobytes())
+            digests.append(digest.hexdigest())
+        return names, digests
+    files = trajstore.list_csv_trajectories(path)[start:stop]
+    return [name for name, _ in files], [file_digest(file) for _, file in files]
+
+
+def range_digests(digests):
+    """
+    Content hashes of the trajectories of a range that also cover the whole range and the position in it
+
+    :param digests: Hex digests of the trajectories of the range, in order
+    :return: Hex digests
+    """
+    rangeDigest = hashlib.sha256("".join(digests).encode()).hexdigest()
+    return [hashlib.sha256(f"{rangeDigest}:{idx}:{digest}".encode()).hexdigest() for idx, digest in enumerate(digests)]
+
+
+def cached_range(inputDirectory, start, stop, cachePath, model, params, fit, wholeRange=False):
+    """
+    Results of the trajectories start to stop - 1 of a folder or store, run by each worker process.
+    Cached results are read from the cache, only the other trajectories are read & fitted (every trajectory of the range
+    as soon as one is missing with wholeRange)
+
+    :param inputDirectory: Folder of out*.csv files or trajectory store
+    :param start: Index of the first trajectory
+    :param stop: Index after the last trajectory
+    :param cachePath: Path of the cache file
+    :param model: Model name
+    :param params: Model parameters
+    :param fit: Function fitting a list of (name, trajectory), returns a matrix with one result vector per trajectory
+                & a list of notes (or None), must be defined at the top level of a module
+    :param wholeRange: Results depend on the other trajectories of the range (warm starts), the range is cached as a whole
+    :return: Names, results (trajectories, width), notes, keys & whether each trajectory was found in the cache
+    """
+    with instrument.stage("hash"):
+        names, digests = trajectory_digests(inputDirectory, start, stop)
+        if wholeRange:
+            digests = range_digests(digests)
+        keys = [trajectory_key(model, params, digest) for digest in digests]
+    with instrument.stage("cache lookup"):
+        found = FitCache.lookup(cachePath, keys)
+
+    hits = [key in found for key in keys]
+    # Some results of the range were evicted, the others are fitted again from the same warm starts
+    if wholeRange and not all(hits):
+        hits = [False] * len(keys)
+    missing = [idx for idx, hit in enumerate(hits) if not hit]
+    fitted, fittedNotes = None, None
+    if missing:
+        with instrument.stage("read"):
+            batch = list(trajstore.read_trajectories(inputDirectory, [start + idx for idx in missing]))
+        fitted, fittedNotes = fit(batch)
+
+    results = []
+    notes = []
+    fittedIndex = {idx: k for k, idx in enumerate(missing)}
+    for idx, key in enumerate(keys):
+        if hits[idx]:
+            result, note = found[key]
+        else:
+            result = fitted[fittedIndex[idx]]
+            note = fittedNotes[fittedIndex[idx]] if fittedNotes is not None else None
+        results.append(result)
+        notes.append(note)
+    return names, np.array(results), notes, keys, hits
+
+
+def map_cached(cache, inputDirectory, workers, batchSize, model, params, fit, fixedRanges=False, wholeRange=False):
+    """
+    Runs cached_range over every trajectory like trajstore.map_trajectories and records the results of every range
+
+    :param cache: FitCache of the run
+    :param inputDirectory: Folder of out*.csv files or trajectory store
+    :param workers: Number of worker processes
+    :param batchSize: Largest number of trajectories in a range
+    :param model: Model name
+    :param params: Model parameters
+    :param fit: Function fitting a list of trajectories, see cached_range
+    :param fixedRanges: Ranges of batchSize whatever the number of workers, see trajstore.map_trajectories
+    :param wholeRange: Cache every range as a whole, see cached_range (needs fixedRanges)
+    :return: Generator of (start, (names, results, notes)) in completion order
+    """
+    for start, (names, results, notes, keys, hits) in trajstore.map_trajectories(inputDirectory, cached_range, workers, batchSize,
+                                                                                 cache.path, model, params, fit, wholeRange,
+                                                                                 fixedRanges=fixedRanges):
+        with instrument.stage("cache record"):
+            cache.record(keys, results, notes, hits)
+        yield start, (names, results, notes)
+
+
+class FitCache:
+    """
+    Cache file opened by the main process, records new results and uses and evicts the least recently used entries
+    """
+
+    def __init__(self, path, maxBytes=MAX_MB * 1024 * 1024):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        # Write-ahead log, workers keep reading while new results are written
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS fits (key TEXT PRIMARY KEY, result BLOB, note TEXT, size INTEGER, used REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS fits_used ON fits (used)")
+        self.connection.commit()
+
+    @staticmethod
+    def lookup(path, keys):
+        """
+        Reads cached results without writing to the cache (used by the worker processes)
+
+        :param path: Path of the cache file
+        :param keys: Keys looked up
+        :return: Dictionary of key to (result vector, note) of the keys found
+        """
+        if not os.path.isfile(path):
+            return {}
+        found = {}
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            # SQLite limits the number of parameters of a query
+            for first in range(0, len(keys), 500):
+                part = keys[first:first + 500]
+                rows = connection.execute(f"SELECT key, result, note FROM fits WHERE key IN ({','.join('?' * len(part))})", part)
+                for key, result, note in rows:
+                    found[key] = (np.frombuffer(result, dtype=np.float64), note)
+        finally:
+            connection.close()
+        return found
+
+    def record(self, keys, results, notes, hits):
+        """
+        Stores the results of the trajectories that were fitted and marks the cached ones as used
+
+        :param keys: Keys of a range of trajectories
+        :param results: Result vectors
+        :param notes: Notes (None entries are stored as NULL)
+        :param hits: Whether each result was read from the cache
+        """
+        now = time.time()
+        used = [(now, key) for key, hit in zip(keys, hits) if hit]
+        new = [(key, np.ascontiguousarray(result, dtype=np.float64).tobytes(), note, int(np.asarray(result).size * 8), now)
+               for key, result, note, hit in zip(keys, results, notes, hits) if not hit]
+        self.connection.executemany("UPDATE fits SET used = ? WHERE key = ?", used)
+        self.connection.executemany("INSERT OR REPLACE INTO fits VALUES (?, ?, ?, ?, ?)", new)
+        self.connection.commit()
+        self.hits += len(used)
+        self.misses += len(new)
+        instrument.count("cache hits", len(used))
+        instrument.count("cache misses", len(new))
+
+    def size(self):
+        """
+        Bytes of results held
+
+        :return: Total size
+        """
+        return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM fits").fetchone()[0]
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is within its size limit
+        """
+        excess = self.size() - self.maxBytes
+        if excess <= 0:
+            return
+        removed = []
+        for key, size in self.connection.execute("SELECT key, size FROM fits ORDER BY used"):
+            removed.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.connection.executemany("DELETE FROM fits WHERE key = ?", removed)
+        self.connection.commit()
+        self.evicted += len(removed)
+
+    def summary(self):
+        """
+        Hit & miss statistics of the run
+
+        :return: One line summary
+        """
+        total = self.hits + self.misses
+        rate = 100 * self.hits / total if total else 0
+        return (f"Fit cache: {self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate), {self.evicted} evicted, "
+                f"{self.size() / (1024 * 1024):.2f} of {self.maxBytes / (1024 * 1024):g} MB used")
+
+    def close(self):
+        """
+        Closes the cache file
+        """
+        self.connection.close()
@@ -2,13 +2,28 @@
 
 import enum
 import os
+import time
+import socket
+import asyncio
 import math
+import shutil
 import pandas as pd
 import argparse
 import matplotlib.pyplot as plt
+import matplotlib.colors as mcolors
+from matplotlib.collections import LineCollection
 import numpy as np;
+from datetime import datetime
+from scipy.spatial import cKDTree
 import geopy
 from geopy import distance
+import geodistance
+import trajstore
+import resample
+import representative
+import instrument
+from manifest import Manifest
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # This program can be run multiple ways
 # ---------------------------------------
@@ -30,6 +45,39 @@ from geopy import distance
 #
 # Accept custom coordinates (lat, long, alt) for an airport other than the default: Logan Airport - Boston:
 #           python3 flightprocess.py -in input.csv -out ./output -rlat xxx -rlong xxx -alt xxx -slat xxx -slong xxx
+#
+# Choose the distance engine (default: vincenty, vectorized ellipsoidal; haversine is faster; geopy is the original per-row call):
+#           python3 flightprocess.py -in ./input -out ./output -distance haversine
+#
+# Spread the files across a pool of worker processes (-j 0 uses every core):
+#           python3 flightprocess.py -in ./input -out ./output -j 8
+#
+# Write all trajectories to a single columnar binary store (./output/trajectories) instead of one csv per file.
+# polycoef.py, sigmoid.py and -v read the store directly:
+#           python3 flightprocess.py -in ./input -out ./output -format store
+#
+# Files that were already processed with the same content and parameters (recorded in ./output/manifest.json) are skipped.
+# Force every file to be processed again:
+#           python3 flightprocess.py -in ./input -out ./output -force
+#
+# Stream very large recordings in chunks of a fixed number of rows so memory use stays bounded (works with both output formats):
+#           python3 flightprocess.py -in ./input -out ./output -chunksize 100000
+#
+# Resample every file to a given data collection frequency (in Hz) on its 'Time' column:
+#           python3 flightprocess.py -in ./input -out ./output -hz 2
+#
+# Time the reading, distance and writing stages and write a JSON report (see instrument.py, every script takes --profile):
+#           python3 flightprocess.py -in ./input -out ./output --profile
+# ---------------
+# LIVE DATA: Record landings while the aircraft flies, from FlightGear's generic protocol over UDP
+# ----------------
+# Copy flightgear/flightlog.xml to FlightGear's Protocol folder and start FlightGear with:
+#           fgfs --generic=socket,out,10,127.0.0.1,5500,udp,flightlog
+# Every landing is appended to the store ./output/live (with the two new columns and the rotated top-down coordinates),
+# a landing ends when the simulator is reset or after -idle seconds without data:
+#           python3 flightprocess.py -listen 5500 -out ./output
+# Without a simulator, flightreplay.py streams the recorded input files at any speed-up:
+#           python3 flightreplay.py -in ./input -port 5500 -speed 10
 # ---------------
 # VISUALIZE DATA: Turn newly created data from above into two different landing pattern graphs
 # ----------------
@@ -40,6 +88,16 @@ from geopy import distance
 # Accept a combined list of directories and files:
 #           python3 flightprocess.py -v ./output output1.csv, output2.csv
 #           python3 flightprocess.py -v output1.csv, output2.csv, output3.csv
+#
+# Write both graphs to image files instead of opening windows (no display needed). Every trajectory is downsampled to the
+# resolution of the image, -render-points sets the number of points kept per trajectory:
+#           python3 flightprocess.py -v ./output -render-to ./plots
+#           python3 flightprocess.py -v ./output/trajectories -render-to ./plots -render-format png svg
+#
+# Both graphs show the median line and the 10th-90th percentile band of the trajectories (see representative.py). Save them
+# for reuse, or draw the ones saved from a larger set over a few new trajectories:
+#           python3 flightprocess.py -v ./output/trajectories -render-to ./plots -save-representative ./output/representative.npz
+#           python3 flightprocess.py -v ./new -representative ./output/representative.npz
 
 # These coordinates below can be changed manually when running the program, however all 5 attributes must be changed to ensure the program runs correctly.
 # Default for Boston Logan International
@@ -57,6 +115,9 @@ alt = 16
 # Default (Logan airport runway 33L): Degrees: 53.13358686          Radians: 0.927356
 angle = np.arctan(abs(rLong - startLong)/abs(rLat-startLat))
 
+# Name of the columnar trajectory store written in the output folder with -format store
+STORE_NAME = 'trajectories'
+
 # Used to calculate the distance between the runway and each point in the csv file, currently in miles
 def calc_distance(row):
     startPoint = (startLat, startLong)
@@ -67,209 +128,510 @@ def calc_distance(row):
     d = (geopy.distance.distance(startPoint, point).nm)
     return(d)
 
-# Process function to create the two new columns in the csv files
-def flight_process(input, output):
+# Adds the two new columns to a dataframe read from a flight data csv file
+def add_columns(reader, method="vincenty"):
+    # The reader creates a new data column for ground level altitude which is calculated by subtracting the given altitude from the sea level altitude in column 'Alt'
+    # Runway 33L is 16ft above sea level
+    instrument.count("rows", len(reader))
+    reader['Alt - Ground Level'] = reader['Alt'] - float(alt)
 
-    # input variable will be a list of 1 or more files and directories to pre-process
-    for inp in input:
+    # The reader creates a new data column for distance between the lat/long positions in the csv file and the starting point
+    # The geopy method calls calc_distance row by row, the other methods compute the whole column at once
+    with instrument.stage("distance"):
+        if method == "geopy":
+            reader['Distance From Start (nmi)'] = reader.apply(calc_distance, axis=1)
+        else:
+            reader['Distance From Start (nmi)'] = geodistance.distance_nm(startLat, startLong, reader['Lat'].to_numpy(), reader['Long'].to_numpy(), method)
+    return reader
+
+# Returns the current runway/starting point parameters so they can be handed to worker processes
+def runway_parameters():
+    return {'rLat': rLat, 'rLong': rLong, 'startLat': startLat, 'startLong': startLong, 'alt': alt}
 
+# Sets the runway/starting point parameters, used as the initializer of every worker process
+# Worker processes do not always inherit the values given on the command line (e.g. spawn on macOS/Windows)
+def set_runway_parameters(params):
+    global rLat, rLong, startLat, startLong, alt, angle
+    rLat, rLong = params['rLat'], params['rLong']
+    startLat, startLong = params['startLat'], params['startLong']
+    alt = params['alt']
+    angle = np.arctan(abs(rLong - startLong)/abs(rLat-startLat))
+
+# Lists every file to pre-process from a list of 1 or more files and directories
+def list_input_files(input):
+    paths = []
+    for inp in input:
         if(os.path.isdir(inp)):
-            # This loop runs for all files in the directory
+            # This loop runs for all files in the directory, sorted so every run sees the files in the same order
             for subdir, dirs, files in os.walk(inp):
-                for file in files:
+                dirs.sort()
+                for file in sorted(files):
                     # If statement included, due to accessing hidden Mac files
                     if file == '.DS_Store':
                         pass
                     else:
-                        # Here the reader variable will read each .csv file placed in the input folder
-                        fileName = os.path.basename(file)
-                        reader = pd.read_csv(inp + "/" + file, encoding="Latin-1", engine='python')
-                        
-                        # The reader creates a new data column for ground level altitude which is calculated by subtracting 16 from the sea level altitude in column 'Alt'
-                        # Runway 33L is 16ft above sea level
-                        reader['Alt - Ground Level'] = reader['Alt'] - int(alt)
-                        
-                        # The reader creates a new data column for distance between the lat/long positions in the csv file and the runway
-                        reader['Distance From Start (nmi)'] = reader.apply(calc_distance, axis=1)
-                        
-                        # The reader outputs the new .csv file to the output folder and adds 'out' to the file name to further differentiate
-                        reader.to_csv(output+'/out'+fileName, index=False)
+                        paths.append(os.path.join(subdir, file))
 
         if(os.path.isfile(inp)):
-            # Here the reader variable will read each .csv file placed in the input folder
-            fileName = os.path.basename(inp)
-            reader = pd.read_csv(inp, encoding="Latin-1", engine='python')
-            
-            # The reader creates a new data column for ground level altitude which is calculated by subtracting the given altitude from the sea level altitude in column 'Alt'
-            reader['Alt - Ground Level'] = reader['Alt'] - alt
-            
-            # The reader creates a new data column for distance between the lat/long positions in the csv file and the runway
-            reader['Distance From Start (nmi)'] = reader.apply(calc_distance, axis=1)
-            
-            # The reader outputs the new .csv file to the output folder and adds 'out' to the file name to further differentiate
-            reader.to_csv(output+'/out'+fileName, index=False)
+            paths.append(inp)
+    return paths
 
-    
+# Reads a single file and adds the two new columns
+# With hz the file is first resampled to that data collection frequency, so the distance is only computed for the kept rows
+def read_file(path, method="vincenty", hz=None):
+    # Here the reader variable will read the .csv file
+    with instrument.stage("read"):
+        reader = pd.read_csv(path, encoding="Latin-1", engine='python')
+    if hz:
+        with instrument.stage("resample"):
+            reader = resample.resample_frame(reader, hz)
+    return add_columns(reader, method)
 
-# Visualize function to take the processed files and turn them into graphs
-def visualize(input):
+# Name of a pre-processed trajectory, 'out' is added to the file name to further differentiate
+def output_name(path):
+    return 'out' + os.path.splitext(os.path.basename(path))[0]
 
-    # The following functions are used to update the annotations for each line on the two different plots
-    # Function used to update annotation lines for plot 1 (Horizontal View)
-    # It reads the data from the line and using that index it matches it with the file used and it's dataframe from the dataframes variable.
-    # Then each x/y position will match with a row on the dataframe in order to pull the other needed information for the annotations   
-    def update_annot_d1(line, idx):
-        posx, posy = [line.get_xdata()[idx], line.get_ydata()[idx]]
-        annot1.xy = (posx, posy)
-        index = lines1.index(line)
-        text = 'Altitude: ' + str(posy) + '\n' + 'Distance traveled: ' + str(posx) + '\n' + 'Airspeed-kt: ' + str(dataframes[index].loc[dataframes[index]['Alt - Ground Level'] == posy, 'Airspeed-kt'].item()) + '\n' + 'Vertical-Speed-FPS: ' +  str(dataframes[index].loc[dataframes[index]['Alt - Ground Level'] == posy, 'Vert-Speed-FPS'].item()) + '\n' + 'Landing Angle: ' + str(np.rad2deg(np.arctan(posy/(30380.58 - (posx * 6076.115))))) + '\n' + 'Time Elapsed (s): ' + str(dataframes[index].loc[dataframes[index]['Alt - Ground Level'] == posy, 'Time'].item()) 
-        annot1.set_text(text)
-        annot1.get_bbox_patch().set_alpha(0.4)
-
-    # Hover function to allow the annotation functions to annotate when hovering over each line for plot 1 (Horizontal View)
-    def hover_d1(event):
-        vis = annot1.get_visible()
-        if event.inaxes == ax1:
-            for line in lines1:
-                cont, ind = line.contains(event)
-                if cont:
-                    update_annot_d1(line, ind['ind'][0])
-                    annot1.set_visible(True)
-                    fig1.canvas.draw_idle()
-                else:
-                    if vis:
-                        annot1.set_visible(False)
-                        fig1.canvas.draw_idle()
-
-    # Function used to update annotation lines for plot 2 (Top-Down View)
-    # It reads the data from the line and using that index it matches it with the file used and it's dataframe from the dataframes variable.
-    # Then each x/y position will match with a row on the dataframe in order to pull the other needed information for the annotations   
-    def update_annot_d2(line, idx):
-        posx, posy = [line.get_xdata()[idx], line.get_ydata()[idx]]
-        annot2.xy = (posx, posy)
-        index = lines2.index(line)
-
-        # The Top-Down View graph is rotated in order to show a straight horizontal line
-        # Below will convert the points on the graph back into the Latitude form to match up with the dataframes/csv files
-        lY = (posy - (dataframes[index]['Lat'] * (np.sin(angle))))/np.cos(angle)
-
-        text = 'Altitude: ' + str(dataframes[index].loc[dataframes[index]['Long'] == lY , 'Alt - Ground Level'].item()) + '\n' + 'Distance traveled: ' + str(dataframes[index].loc[dataframes[index]['Long'] == lY, 'Distance From Start (nmi)'].item()) + '\n' + 'Airspeed-kt: ' + str(dataframes[index].loc[dataframes[index]['Long'] == lY, 'Airspeed-kt'].item()) + '\n' + 'Vertical-Speed-FPS: ' +  str(dataframes[index].loc[dataframes[index]['Long'] == lY, 'Vert-Speed-FPS'].item()) + '\n' + 'Landing Angle: ' + str(np.rad2deg(np.arctan(dataframes[index].loc[dataframes[index]['Long'] == lY, 'Alt - Ground Level'].item()/(30380.58 - (dataframes[index].loc[dataframes[index]['Long'] == lY, 'Distance From Start (nmi)'].item() * 6076.115))))) + '\n' + 'Time Elapsed (s): ' + str(dataframes[index].loc[dataframes[index]['Long'] == lY, 'Time'].item()) 
-        annot2.set_text(text)
-        annot2.get_bbox_patch().set_alpha(0.4)
-
-    # Hover function to allow the annotation functions to annotate when hovering over each line for plot 2 (Top-Down View)
-    def hover_d2(event):
-        vis = annot2.get_visible()
-        if event.inaxes == ax2:
-            for line in lines2:
-                cont, ind = line.contains(event)
-                if cont:
-                    update_annot_d2(line, ind['ind'][0])
-                    annot2.set_visible(True)
-                    fig2.canvas.draw_idle()
-                else:
-                    if vis:
-                        annot2.set_visible(False)
-                        fig2.canvas.draw_idle()
-
-    # Creating first plot
-    fig1, ax1 = plt.subplots()
+# Reads a single file in chunks of a fixed number of rows and adds the two new columns to each chunk
+# Only one chunk is held in memory at a time. The C parser with round_trip precision reads the same values as the python parser
+# Every column is read as a float, otherwise a chunk where a column only holds whole numbers (e.g. Throttle at 0) would be written as integers
+def read_file_chunks(path, method="vincenty", chunksize=100000, hz=None):
+    resampler = resample.Resampler(hz) if hz else None
+    with pd.read_csv(path, encoding="Latin-1", chunksize=chunksize, float_precision='round_trip', dtype=float) as chunks:
+        for chunk in instrument.iterate(chunks, "read"):
+            if resampler is not None:
+                with instrument.stage("resample"):
+                    chunk = resampler.push(chunk)
+            yield add_columns(chunk, method)
 
-    # Variables used for annotations
-    # lines will hold an array of each line on plot 1 which represents each file
-    # dataframes will hold an array of each csv file as a data frame
-    lines1 = []
-    dataframes = []
+# Pre-processes a single file and writes it to the output folder, returns the path of the new file
+# With a chunksize the file is streamed chunk by chunk, the written file is the same as without it
+def process_file(path, output, method="vincenty", chunksize=None, hz=None):
+    # The reader outputs the new .csv file to the output folder and adds 'out' to the file name to further differentiate
+    outPath = output+'/out'+os.path.basename(path)
 
-    # Reference line for a proper landing
-    ref1X = np.array([0, 1, 3, 5])
-    ref1Y = np.array([1200, 1200, 600, 0])
-    ax1.plot(ref1X,ref1Y, 'r-', label='Reference Line')     
-    
-    # input variable is a list of 1 or more files or directories that we need to iterate through
-    for inp in input:
-        
-        # checks if item in input list is a file or directory
-        if(os.path.isdir(inp)):
+    if chunksize:
+        header = True
+        for chunk in read_file_chunks(path, method, chunksize, hz):
+            with instrument.stage("write"):
+                chunk.to_csv(outPath, index=False, header=header, mode='w' if header else 'a')
+            header = False
+        return outPath
 
-            for subdir, dirs, files in os.walk(inp):
-                # loop through all csv files in directory
-                for file in files:
-                    # Checks for .ds_Store (Mac issue)
-                    if file == '.DS_Store':
-                        pass
-                    else:
-                        df = pd.read_csv(inp+"/"+file, encoding="Latin-1", engine='python')
-                        dataframes.append(df)
-
-                        # X axis will be distance traveled from start
-                        distX = df['Distance From Start (nmi)']
-                        # Y axis will be altitude from ground
-                        altY = df['Alt - Ground Level']
-                        
-                        # plot the line on the graph and add to array of all lines. Each file will be represented by 1 line
-                        l, = ax1.plot(distX,altY)
-                        lines1.append(l)
-                        
-                        # Create placeholder invisible annotations
-                        annot1 = ax1.annotate("", xy=(0, 0), xytext=(20, 20), textcoords="offset points",
-                                            bbox=dict(boxstyle="round", fc="w"),
-                                            arrowprops=dict(arrowstyle="->"))
-                        annot1.set_visible(False)
+    reader = read_file(path, method, hz)
+    with instrument.stage("write"):
+        reader.to_csv(outPath, index=False)
+    return outPath
 
-        if(os.path.isfile(inp)):
-            # checsk for .DS_Store (mac issue)
-            if inp == '.DS_Store':
-                        pass
-            else:
-                df = pd.read_csv(inp, encoding="Latin-1", engine='python')
-                dataframes.append(df)
-                names = np.array(list("ABCDEFGHIJKLMNO"))
-
-                # X axis will be distance traveled from start
-                distX = df['Distance From Start (nmi)']
-                # Y axis will be altitude from ground
-                altY = df['Alt - Ground Level']
-                
-                # plot the line on the graph and add to array of all lines. Each file will be represented by a line.
-                l, = ax1.plot(distX,altY)
-                lines1.append(l)
-                
-                #Create placeholder invisible annotations
-                annot1 = ax1.annotate("", xy=(0, 0), xytext=(20, 20), textcoords="offset points",
-                                    bbox=dict(boxstyle="round", fc="w"),
-                                    arrowprops=dict(arrowstyle="->"))
-                annot1.set_visible(False)
+# Streams a single file chunk by chunk into a temporary store holding only that trajectory, returns the path of the temporary store
+# The main process then copies it into the output store, so no process ever holds a whole recording in memory
+def process_file_to_store(path, output, method="vincenty", chunksize=100000, hz=None):
+    tmpPath = output + '/.' + output_name(path) + '.tmp'
+    with trajstore.TrajectoryStoreWriter(tmpPath) as tmpStore:
+        tmpStore.begin(output_name(path))
+        for chunk in read_file_chunks(path, method, chunksize, hz):
+            with instrument.stage("write"):
+                tmpStore.extend(chunk)
+        tmpStore.end()
+    return tmpPath
 
-    
+# Process function to create the two new columns in the csv files
+# With workers > 1 the files are spread across a process pool. Each file is written by exactly one worker with the same
+# code as the serial path, so the output is identical. A failing file is reported and skipped, the rest of the batch still runs
+# With fmt == 'store' every trajectory is appended (in input order) to a single columnar store in the output folder instead
+# A manifest in the output folder records the content hash and parameters of every processed file, files that have not
+# changed since the last run are skipped unless force is set
+# With a chunksize every file is streamed in chunks of that many rows, so memory use does not depend on the size of the recordings
+# With hz every file is resampled to that data collection frequency (in Hz) on its 'Time' column
+def flight_process(input, output, method="vincenty", workers=1, fmt="csv", force=False, chunksize=None, hz=None):
 
+    # input variable will be a list of 1 or more files and directories to pre-process
+    allPaths = list_input_files(input)
+    errors = []
 
-    # Last changes to the first figure before showing it
-    fig1.canvas.mpl_connect("motion_notify_event", hover_d1)
+    # A file is processed again when its content or any of these parameters change
+    params = dict(runway_parameters(), distance=method, format=fmt, hz=hz)
+    fileManifest = Manifest(output)
+    with instrument.stage("hash"):
+        digests = {path: fileManifest.digest(path) for path in allPaths}
+    if force:
+        paths = allPaths
+    else:
+        paths = [path for path in allPaths if not fileManifest.is_current(path, digests[path], params)]
 
+    store = None
+    if fmt == "store":
+        storePath = output + '/' + STORE_NAME
+        # New files are appended to the existing store, it is only rebuilt from every input when a file already in it changed
+        rebuild = force or not trajstore.is_store(storePath) or any(fileManifest.is_recorded(path) for path in paths)
+        if rebuild:
+            paths = allPaths
+        if paths:
+            store = trajstore.TrajectoryStoreWriter(storePath, append=not rebuild)
+        if chunksize:
+            task = process_file_to_store
+            taskArgs = (output, method, chunksize, hz)
+        else:
+            task = read_file
+            taskArgs = (method, hz)
+    else:
+        task = process_file
+        taskArgs = (output, method, chunksize, hz)
 
-        
-    plt.title("Horizontal View")
-    plt.xlabel("Distance from start (nm)")
-    plt.ylabel("Altitude (ft)")
-    plt.xlim([0,6])
-    plt.ylim([-10,2000])
+    if len(paths) < len(allPaths):
+        print(f"Skipping {len(allPaths) - len(paths)} unchanged files")
 
+    # Results for the store are kept until every earlier file is done so the store order never depends on scheduling
+    pending = {}
+    nextIdx = 0
 
-    plt.legend()
+    def report(count, idx, result, error):
+        nonlocal nextIdx
+        path = paths[idx]
+        if error is None:
+            print(f"[{count}/{len(paths)}] {path}")
+            # Files of the store are counted & recorded once their trajectory is appended, see below
+            if store is None:
+                instrument.count("files")
+                fileManifest.record(path, digests[path], params, result)
+        else:
+            errors.append((path, error))
+            instrument.count("failures")
+            print(f"[{count}/{len(paths)}] {path} FAILED: {type(error).__name__}: {error}")
 
+        if store is not None:
+            pending[idx] = result if error is None else None
+            while nextIdx in pending:
+                result = pending.pop(nextIdx)
+                done = paths[nextIdx]
+                nextIdx += 1
+                if result is None:
+                    continue
+                # Streamed files come back as a temporary store, others as a dataframe. A failed append leaves the store
+                # as it was before it and the file is not recorded, so the next run processes it again
+                try:
+                    with instrument.stage("store"):
+                        if isinstance(result, str):
+                            store.append_store(result, chunksize)
+                        else:
+                            store.append(output_name(done), result)
+                except Exception as e:
+                    errors.append((done, e))
+                    instrument.count("failures")
+                    print(f"{done} FAILED to append to the store: {type(e).__name__}: {e}")
+                    continue
+                finally:
+                    if isinstance(result, str):
+                        shutil.rmtree(result, ignore_errors=True)
+                instrument.count("files")
+                fileManifest.record(done, digests[done], params, storePath, trajectory=output_name(done))
 
-    # Beginning of figure 2's creation: Top-Down View
-    fig2, ax2 = plt.subplots()
-    lines2 = []
+    # The manifest is saved even if the run is interrupted, so the files already done are not processed again
+    try:
+        if workers > 1 and len(paths) > 1:
+            # With --profile the workers send their stages & counters back with every result
+            workerTask = instrument.worker_task(task)
+            with ProcessPoolExecutor(max_workers=workers, initializer=set_runway_parameters, initargs=(runway_parameters(),)) as executor:
+                futures = {executor.submit(workerTask, path, *taskArgs): idx for idx, path in enumerate(paths)}
+                for count, future in enumerate(as_completed(futures), 1):
+                    error = future.exception()
+                    report(count, futures[future], None if error else instrument.unwrap(future.result()), error)
+        else:
+            for idx, path in enumerate(paths):
+                try:
+                    with instrument.stage("process"):
+                        result = task(path, *taskArgs)
+                except Exception as e:
+                    report(idx + 1, idx, None, e)
+                    continue
+                report(idx + 1, idx, result, None)
+    finally:
+        if store is not None:
+            store.close()
+        fileManifest.save()
+
+    if errors:
+        print(f"{len(errors)} of {len(paths)} files failed:")
+        for path, error in errors:
+            print(f"    {path}: {type(error).__name__}: {error}")
+    return errors
+
+# Name of the trajectory store written in the output folder by -listen
+LIVE_STORE_NAME = 'live'
+
+# Values sent by FlightGear's generic protocol (flightgear/flightlog.xml), in the same order as the recorded csv files
+LIVE_FIELDS = ['Time', 'Lat', 'Long', 'Alt', 'Throttle', 'Rudder', 'Ailerons', 'Airspeed-kt', 'Vert-Speed-FPS']
+# Columns of the live store: the received values, the two new columns and the rotated top-down coordinates
+LIVE_COLUMNS = LIVE_FIELDS + ['Alt - Ground Level', 'Distance From Start (nmi)', 'Top Down X', 'Top Down Y']
+
+# Receives FlightGear's generic protocol over UDP and appends every landing to a trajectory store while the aircraft flies
+# Every datagram holds one or more lines of comma separated values. Datagrams are queued as they arrive and processed together
+# on the next turn of the event loop, so each packet is handled as soon as it arrives when the stream is slow and packets are
+# batched automatically when it is fast. The two new columns and the rotated top-down coordinates are computed for every
+# processed batch and written to the store, a trajectory becomes visible to readers of the store when it ends
+# A trajectory ends when 'Time' goes backwards (the simulator was reset) or when no packet arrived for idle seconds
+# A line with one more value than LIVE_FIELDS carries the time it was sent (flightreplay.py), used to report the end-to-end latency
+class LiveIngest(asyncio.DatagramProtocol):
+    def __init__(self, storePath, method="vincenty", idle=10, flushRows=1000, reportEvery=5):
+        self.store = trajstore.TrajectoryStoreWriter(storePath, append=trajstore.is_store(storePath))
+        self.method = method
+        self.idle = idle
+        self.flushRows = flushRows
+        self.reportEvery = reportEvery
+        self.pending = []
+        self.scheduled = False
+        self.lastTime = None
+        self.lastPacket = 0
+        self.buffer = []
+        self.bufferRows = 0
+        self.trajectories = 0
+        self.reset_stats(time.perf_counter())
+
+    # Counters reported every reportEvery seconds and reset after each report
+    def reset_stats(self, now):
+        self.stats = {'packets': 0, 'rows': 0, 'bad': 0, 'latency': 0.0, 'maxLatency': 0.0, 'sendLatency': 0.0, 'stamped': 0}
+        self.reportStart = now
+
+    def connection_made(self, transport):
+        self.loop = asyncio.get_running_loop()
+        self.timer = self.loop.call_later(1, self.tick)
+
+    def datagram_received(self, data, addr):
+        self.pending.append((time.perf_counter(), data))
+        if not self.scheduled:
+            self.scheduled = True
+            self.loop.call_soon(self.process)
+
+    # Parses and processes every datagram received since the last call
+    def process(self):
+        self.scheduled = False
+        pending, self.pending = self.pending, []
+        rows = []
+        stamps = []
+        for received, data in pending:
+            for line in data.decode('ascii', 'replace').splitlines():
+                values = line.strip().split(',')
+                try:
+                    if len(values) == len(LIVE_FIELDS):
+                        rows.append([float(v) for v in values])
+                    elif len(values) == len(LIVE_FIELDS) + 1:
+                        rows.append([float(v) for v in values[:-1]])
+                        stamps.append(float(values[-1]))
+                    elif line.strip():
+                        self.stats['bad'] += 1
+                except ValueError:
+                    self.stats['bad'] += 1
+        if rows:
+            self.lastPacket = time.perf_counter()
+            values = np.array(rows)
+
+            # A new trajectory starts wherever 'Time' goes backwards
+            t = values[:, 0]
+            previous = np.concatenate([[self.lastTime if self.lastTime is not None else -np.inf], t[:-1]])
+            starts = np.flatnonzero(t < previous)
+            for segment in np.split(np.arange(len(t)), starts):
+                if len(segment) == 0:
+                    continue
+                if segment[0] in starts:
+                    self.end_trajectory()
+                self.add_rows(values[segment])
+            self.lastTime = t[-1]
+
+        done = time.perf_counter()
+        self.stats['packets'] += len(pending)
+        self.stats['rows'] += len(rows)
+        for received, data in pending:
+            self.stats['latency'] += done - received
+            self.stats['maxLatency'] = max(self.stats['maxLatency'], done - received)
+        if stamps:
+            self.stats['sendLatency'] += time.time() * len(stamps) - sum(stamps)
+            self.stats['stamped'] += len(stamps)
+
+    # Adds the new columns to rows of the current trajectory and buffers them until enough rows are waiting to be written
+    def add_rows(self, values):
+        if self.store.current is None:
+            name = 'outLive-' + datetime.now().strftime('%Y%m%d-%H%M%S')
+            if name in self.store.names:
+                name += '-' + str(len(self.store.names))
+            self.store.begin(name)
+            print(f"Recording {name}")
+        # Same values as add_columns, computed on the arrays directly since building a dataframe for every packet costs more
+        # than the computation itself
+        lat, long = values[:, 1], values[:, 2]
+        self.buffer.append(np.column_stack([values, values[:, 3] - float(alt),
+                                            geodistance.distance_nm(startLat, startLong, lat, long, self.method), *rotate(lat, long)]))
+        self.bufferRows += len(values)
+        if self.bufferRows >= self.flushRows:
+            self.write_buffer()
+
+    def write_buffer(self):
+        if self.buffer:
+            self.store.extend(pd.DataFrame(np.concatenate(self.buffer), columns=LIVE_COLUMNS))
+            self.buffer = []
+            self.bufferRows = 0
+
+    # Writes the rest of the current trajectory and makes it visible to readers of the store
+    def end_trajectory(self):
+        if self.store.current is None:
+            return
+        self.write_buffer()
+        name = self.store.current
+        self.store.end()
+        self.store.flush()
+        self.trajectories += 1
+        self.lastTime = None
+        print(f"Saved {name} ({self.store.offsets[-1] - self.store.offsets[-2]} rows)")
+
+    # Runs every second: ends an idle trajectory, writes buffered rows and prints the throughput and latency
+    def tick(self):
+        now = time.perf_counter()
+        if self.store.current is not None and now - self.lastPacket > self.idle:
+            self.end_trajectory()
+        else:
+            self.write_buffer()
+        if now - self.reportStart >= self.reportEvery:
+            self.report(now)
+        self.timer = self.loop.call_later(1, self.tick)
+
+    def report(self, now):
+        s = self.stats
+        if s['packets']:
+            message = (f"{s['packets']} packets, {s['rows'] / (now - self.reportStart):.0f} rows/s, "
+                       f"processing latency {1000 * s['latency'] / s['packets']:.2f} ms mean / {1000 * s['maxLatency']:.2f} ms max")
+            if s['stamped']:
+                message += f", end-to-end {1000 * s['sendLatency'] / s['stamped']:.2f} ms mean"
+            if s['bad']:
+                message += f", {s['bad']} unreadable lines"
+            print(message)
+        self.reset_stats(now)
+
+    def close(self):
+        self.timer.cancel()
+        if self.pending:
+            self.process()
+        self.end_trajectory()
+        self.store.close()
+
+# Listens for FlightGear's generic protocol on a UDP port and appends every landing to the store output/live until interrupted
+# FlightGear is started with the protocol file in its Protocol folder:
+#           fgfs --generic=socket,out,10,127.0.0.1,5500,udp,flightlog
+def listen(output, host="127.0.0.1", port=5500, method="vincenty", idle=10):
+    async def run():
+        # A large receive buffer keeps bursts of packets from being dropped while a batch is written
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        sock.bind((host, port))
+        loop = asyncio.get_running_loop()
+        transport, ingest = await loop.create_datagram_endpoint(
+            lambda: LiveIngest(output + '/' + LIVE_STORE_NAME, method, idle), sock=sock)
+        print(f"Listening on {host}:{port}, writing to {output + '/' + LIVE_STORE_NAME} (Ctrl+C to stop)")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            transport.close()
+            ingest.close()
+            print(f"{ingest.trajectories} trajectories recorded")
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+# Reads every processed trajectory from a list of 1 or more files, directories or trajectory stores
+# Each trajectory is indexed by column name: a dictionary of arrays for a store, a dataframe (only the given columns) for a csv file
+def load_frames(input, columns=None):
+    for inp in input:
+        if trajstore.is_store(inp):
+            store = trajstore.TrajectoryStore(inp)
+            for idx in range(len(store)):
+                yield store.arrays(idx)
+        else:
+            # Only the csv files, an output folder also holds the manifest (and the store of a -format store run)
+            for path in list_input_files([inp]):
+                if os.path.splitext(path)[1].lower() == ".csv":
+                    yield trajstore.read_csv_trajectory(path, columns)
+
+# Columns shown in the annotation when hovering over a point of either plot
+ANNOTATION_COLUMNS = ['Alt - Ground Level', 'Distance From Start (nmi)', 'Airspeed-kt', 'Vert-Speed-FPS', 'Time']
+
+# Builds the annotation text of one row of a trajectory from its annotation columns
+def annotation_text(rows, row):
+    altitude = rows['Alt - Ground Level'][row]
+    distanceTraveled = rows['Distance From Start (nmi)'][row]
+    return ('Altitude: ' + str(altitude) + '\n' + 'Distance traveled: ' + str(distanceTraveled) + '\n' +
+            'Airspeed-kt: ' + str(rows['Airspeed-kt'][row]) + '\n' + 'Vertical-Speed-FPS: ' + str(rows['Vert-Speed-FPS'][row]) + '\n' +
+            'Landing Angle: ' + str(np.rad2deg(np.arctan(altitude/(30380.58 - (distanceTraveled * 6076.115))))) + '\n' +
+            'Time Elapsed (s): ' + str(rows['Time'][row]))
+
+# Spatial index over every point plotted on an axes, used by the hover functions
+# The points are indexed in screen (pixel) coordinates so the hover radius is the same in every direction. The index is only
+# rebuilt when the view changes (zoom, pan, resize), every mouse move is a single nearest neighbour query
+class HoverIndex:
+    def __init__(self, ax, xs, ys, radius=5):
+        self.ax = ax
+        self.radius = radius
+        lengths = [len(x) for x in xs]
+        # For every point: the trajectory it belongs to and its row in that trajectory
+        self.index = np.repeat(np.arange(len(lengths)), lengths)
+        self.row = np.concatenate([np.arange(n) for n in lengths]) if lengths else np.empty(0, dtype=int)
+        self.points = np.column_stack([np.concatenate(xs), np.concatenate(ys)]) if lengths else np.empty((0, 2))
+        self.tree = None
+        self.view = None
+
+    def query(self, event):
+        if len(self.points) == 0:
+            return None
+        view = (tuple(self.ax.viewLim.bounds), tuple(self.ax.bbox.bounds))
+        if view != self.view:
+            self.tree = cKDTree(self.ax.transData.transform(self.points))
+            self.view = view
+        dist, i = self.tree.query([event.x, event.y], distance_upper_bound=self.radius)
+        if not np.isfinite(dist):
+            return None
+        return self.index[i], self.row[i], self.points[i, 0], self.points[i, 1]
 
+# Rotates lat/long positions along the angle between the start and runway, used for the top-down graph
+def rotate(lat, long):
+    return (lat * (np.cos(angle)) - (long * (np.sin(angle)))), (long * (np.cos(angle)) + lat * (np.sin(angle)))
+
+# Loads every trajectory once into memory, keeping only the arrays the two plots and their annotations need
+# Both figures are drawn from this cache, so each file is read a single time
+def load_trajectories(input):
+    trajectories = []
+    for df in load_frames(input, ANNOTATION_COLUMNS + ['Lat', 'Long']):
+        columns = {column: np.asarray(df[column]) for column in ANNOTATION_COLUMNS}
+        columns['Top Down X'], columns['Top Down Y'] = rotate(np.asarray(df['Lat']), np.asarray(df['Long']))
+        trajectories.append(columns)
+    return trajectories
+
+# One color per trajectory, following the default color cycle like separate ax.plot calls would
+def trajectory_colors(count):
+    cycle = mcolors.to_rgba_array(plt.rcParams['axes.prop_cycle'].by_key()['color'])
+    return cycle[np.arange(count) % len(cycle)]
+
+# Draws plot 1 (Horizontal View): the reference line and every trajectory as a single LineCollection
+def draw_horizontal_view(ax, trajectories):
+    # Reference line for a proper landing
+    ref1X = np.array([0, 1, 3, 5])
+    ref1Y = np.array([1200, 1200, 600, 0])
+    ax.plot(ref1X,ref1Y, 'r-', label='Reference Line')
+
+    # X axis will be distance traveled from start, Y axis will be altitude from ground. Each file will be represented by 1 line
+    segments = [np.column_stack((t['Distance From Start (nmi)'], t['Alt - Ground Level'])) for t in trajectories]
+    ax.add_collection(LineCollection(segments, colors=trajectory_colors(len(trajectories))))
+
+    ax.set_title("Horizontal View")
+    ax.set_xlabel("Distance from start (nm)")
+    ax.set_ylabel("Altitude (ft)")
+    ax.set_xlim([0,6])
+    ax.set_ylim([-10,2000])
+    ax.legend()
+
+# Draws plot 2 (Top-Down View): the runway, the reference line and every trajectory point as a single PathCollection
+def draw_top_down_view(ax, trajectories):
     # Creating the reference line
     # In order to make this line horizontal, we need to rotate it based on the angle between the start and runway created at the top of this page
-    rX = (rLat * (np.cos(angle))) - (rLong * (np.sin(angle)))
-    rY = (rLong * (np.cos(angle))) + rLat * (np.sin(angle))
-    sX = (startLat * (np.cos(angle))) - (startLong * np.sin(angle))
-    sY = (startLong * (np.cos(angle))) + startLat * (np.sin(angle))
-
+    rX, rY = rotate(rLat, rLong)
+    sX, sY = rotate(startLat, startLong)
 
     ref2X = np.array([rX,sX])
     ref2Y = np.array([rY,sY])
@@ -278,79 +640,292 @@ def visualize(input):
     runwayX = np.array([rX, rX, rX + 0.015, rX + 0.015, rX ])
     runwayY = np.array([rY + 0.0003, rY - 0.0003, rY - 0.0003, rY + 0.0003, rY + 0.0003])
 
+    ax.plot(runwayX, runwayY, 'g-', label="Runway")
+    ax.plot(ref2X, ref2Y, 'r-', label='Reference Line')
 
-    ax2.plot(runwayX, runwayY, 'g-', label="Runway")
-    ax2.plot(ref2X, ref2Y, 'r-', label='Reference Line')
+    # Each file is a dotted line from start to runway to show how straight the landing pattern was
+    if trajectories:
+        lengths = [len(t['Top Down X']) for t in trajectories]
+        pointColors = np.repeat(trajectory_colors(len(trajectories)), lengths, axis=0)
+        ax.scatter(np.concatenate([t['Top Down X'] for t in trajectories]), np.concatenate([t['Top Down Y'] for t in trajectories]),
+                   c=pointColors, marker='.', s=plt.rcParams['lines.markersize'] ** 2)
 
+    ax.set_xlim([ref2X[0] - 0.1, ref2X[1] + 0.115])
+    ax.set_ylim([ref2Y[0] - 0.005, ref2Y[1] + 0.005])
+    ax.set_xticks([])
+    ax.set_yticks([])
+    ax.set_title('Top Down View')
+    ax.legend()
 
-    # input variable is a list of 1 or more files and directories that we need to iterate through
-    for inp in input:
-        # check if item in input list is a directory
-        if(os.path.isdir(inp)):    
-            for subdir, dirs, files in os.walk(inp):
-                # loop through all csv files in directory
-                for file in files:
-                    if file == '.DS_Store':
-                        pass
-                    else:
-                        # Here we read each file in the directory and create a dotted line from start to runway to show how straight the landing pattern was
-                        df = pd.read_csv(inp+"/"+file, encoding="Latin-1", engine='python')
-                        names = np.array(list("ABCDEFGHIJKLMNO"))
-
-                        latX = df['Lat']
-                        longY = df['Long']
-
-                        # Rotate each line along the angle between the start and runway to create a top-down graph
-                        newX = (latX * (np.cos(angle)) - (longY * (np.sin(angle))))
-                        newY = (longY * (np.cos(angle)) + latX * (np.sin(angle)))
-
-                        l, = ax2.plot(newX, newY, '.')
-                        lines2.append(l)
-                        
-                        # Create invisible placeholder annotations
-                        annot2 = ax2.annotate("", xy=(0, 0), xytext=(20, 20), textcoords="offset points",
-                                            bbox=dict(boxstyle="round", fc="w"),
-                                            arrowprops=dict(arrowstyle="->"))
-                        annot2.set_visible(False)
+# Columns of the representative trajectory: the altitude profile of the horizontal view and the position of the top-down view
+REPRESENTATIVE_COLUMNS = ['Alt - Ground Level', 'Top Down X', 'Top Down Y']
 
-        if(os.path.isfile(inp)):
-            if inp == '.DS_Store':
-                        pass
-            else:
-                # Here we read each file in the input list and create a dotted line from start to runway to show how straight the landing pattern was
-                df = pd.read_csv(inp, encoding="Latin-1", engine='python')
-
-                latX = df['Lat']
-                longY = df['Long']
-
-                # Rotate each line along the angle between the start and runway to create a top-down graph
-                newX = (latX * (np.cos(angle)) - (longY * (np.sin(angle))))
-                newY = (longY * (np.cos(angle)) + latX * (np.sin(angle)))
-
-                l, = ax2.plot(newX, newY, '.')
-                lines2.append(l)
-                
-                # Create invisible placeholder annotations
-                annot = ax2.annotate("", xy=(0, 0), xytext=(20, 20), textcoords="offset points",
-                                    bbox=dict(boxstyle="round", fc="w"),
-                                    arrowprops=dict(arrowstyle="->"))
+# Draws the median line and percentile band of a summary (see representative.py) over both views
+# The horizontal view shows the altitude band along the distance grid, the top-down view the lateral band around the median position
+def draw_representative(ax1, ax2, summary):
+    quantiles = summary['quantiles']
+    bandLabel = f"{quantiles[0] * 100:g}th-{quantiles[-1] * 100:g}th percentile"
+
+    low, median, high = representative.band(summary, 'Alt - Ground Level')
+    ax1.fill_between(summary['grid'], low, high, color='k', alpha=0.2, linewidth=0, zorder=3, label=bandLabel)
+    ax1.plot(summary['grid'], median, 'k--', zorder=4, label='Median')
+    ax1.legend()
+
+    _, medianX, _ = representative.band(summary, 'Top Down X')
+    lowY, medianY, highY = representative.band(summary, 'Top Down Y')
+    ax2.fill_between(medianX, lowY, highY, color='k', alpha=0.2, linewidth=0, zorder=3, label=bandLabel)
+    ax2.plot(medianX, medianY, 'k--', zorder=4, label='Median')
+    ax2.legend()
+
+# Loads a saved summary, or starts one that the trajectories are added to while they are read
+def representative_summary(path=None):
+    if path is not None:
+        return representative.load(path), None
+    return None, representative.RepresentativeTrajectory(REPRESENTATIVE_COLUMNS)
+
+# Visualize function to take the processed files and turn them into graphs
+# summaryPath draws a saved representative trajectory instead of the one of the input, savePath saves the one of the input
+def visualize(input, summaryPath=None, savePath=None):
+
+    # The following functions are used to update the annotations for each line on the two different plots
+    # Every plotted point is in a spatial index (see HoverIndex), so one query gives the trajectory and row under the mouse.
+    # The annotation fields are then read by row number from the cached arrays of that trajectory, no dataframe is searched
+    def update_annot(annot, index, row):
+        annot.set_text(annotation_text(trajectories[index], row))
+        annot.get_bbox_patch().set_alpha(0.4)
+
+    # Hover function shared by both plots, shows the annotation of the point under the mouse and hides it otherwise
+    def hover(event, fig, ax, annot, hoverIndex):
+        vis = annot.get_visible()
+        if event.inaxes == ax:
+            found = hoverIndex.query(event)
+            if found is not None:
+                index, row, posx, posy = found
+                annot.xy = (posx, posy)
+                update_annot(annot, index, row)
+                annot.set_visible(True)
+                fig.canvas.draw_idle()
+            elif vis:
                 annot.set_visible(False)
-    
-    # Last updates to the plot before showing it
-    fig2.canvas.mpl_connect("motion_notify_event", hover_d2)
-
-    plt.xlim([ref2X[0] - 0.1, ref2X[1] + 0.115])
-    plt.ylim([ref2Y[0] - 0.005, ref2Y[1] + 0.005])
-    plt.xticks([])
-    plt.yticks([])
-    plt.title('Top Down View')
-    plt.legend()
+                fig.canvas.draw_idle()
+
+    # Creates a placeholder invisible annotation
+    def create_annotation(ax):
+        annot = ax.annotate("", xy=(0, 0), xytext=(20, 20), textcoords="offset points",
+                            bbox=dict(boxstyle="round", fc="w"),
+                            arrowprops=dict(arrowstyle="->"))
+        annot.set_visible(False)
+        return annot
+
+    # input variable is a list of 1 or more files, directories or trajectory stores, each trajectory is read once
+    with instrument.stage("load"):
+        trajectories = load_trajectories(input)
+    instrument.count("trajectories", len(trajectories))
+
+    # Median line and percentile band of the trajectories, or the saved ones
+    summary, builder = representative_summary(summaryPath)
+    if builder is not None:
+        with instrument.stage("representative"):
+            for t in trajectories:
+                builder.add(t['Distance From Start (nmi)'], t)
+            summary = builder.summary()
+    if savePath is not None:
+        representative.save(savePath, summary)
+
+    # Creating first plot: Horizontal View
+    fig1, ax1 = plt.subplots()
+    draw_horizontal_view(ax1, trajectories)
+    annot1 = create_annotation(ax1)
+    hoverIndex1 = HoverIndex(ax1, [t['Distance From Start (nmi)'] for t in trajectories], [t['Alt - Ground Level'] for t in trajectories])
+    fig1.canvas.mpl_connect("motion_notify_event", lambda event: hover(event, fig1, ax1, annot1, hoverIndex1))
+
+    # Beginning of figure 2's creation: Top-Down View
+    fig2, ax2 = plt.subplots()
+    draw_top_down_view(ax2, trajectories)
+    annot2 = create_annotation(ax2)
+    hoverIndex2 = HoverIndex(ax2, [t['Top Down X'] for t in trajectories], [t['Top Down Y'] for t in trajectories])
+    fig2.canvas.mpl_connect("motion_notify_event", lambda event: hover(event, fig2, ax2, annot2, hoverIndex2))
+
+    draw_representative(ax1, ax2, summary)
+
     plt.show()
-          
+
+
+# Rasterizes trajectories straight into a pixel buffer the size of an axes, used by render()
+# Drawing thousands of lines or hundreds of thousands of markers through matplotlib takes minutes, filling a numpy buffer takes
+# seconds. Every pixel keeps the trajectory drawn last over it, so the image looks like the one drawn by visualize(); the buffer
+# is drawn on the axes with imshow, under the same title, labels, limits and legend
+class TrajectoryRaster:
+    def __init__(self, ax):
+        bbox = ax.get_window_extent()
+        self.ax = ax
+        self.width = max(int(round(bbox.width)), 1)
+        self.height = max(int(round(bbox.height)), 1)
+        self.xlim = ax.get_xlim()
+        self.ylim = ax.get_ylim()
+        self.pointsToPixels = ax.figure.dpi / 72
+        # Index of the trajectory drawn on each pixel, -1 for none. The margin lets a pixel near the edge be stamped without
+        # clipping its neighbours, it is cropped when the buffer is drawn
+        self.margin = 8
+        self.owner = np.full((self.height + 2 * self.margin, self.width + 2 * self.margin), -1, dtype=np.int32)
+
+    # Converts data coordinates to pixel coordinates of the buffer
+    def to_pixels(self, x, y):
+        px = (np.asarray(x, dtype=float) - self.xlim[0]) / (self.xlim[1] - self.xlim[0]) * self.width
+        py = (np.asarray(y, dtype=float) - self.ylim[0]) / (self.ylim[1] - self.ylim[0]) * self.height
+        return px, py
+
+    # Marks a square of size x size pixels around every given pixel with its trajectory index
+    def stamp(self, px, py, owner, size):
+        keep = (px >= 0) & (px < self.width) & (py >= 0) & (py < self.height)
+        stride = self.owner.shape[1]
+        flat = (np.floor(py[keep]).astype(np.int64) + self.margin) * stride + np.floor(px[keep]).astype(np.int64) + self.margin
+        owner = owner[keep]
+        pixels = self.owner.reshape(-1)
+        size = min(size, self.margin)
+        for dy in range(-(size // 2), size - size // 2):
+            for dx in range(-(size // 2), size - size // 2):
+                pixels[flat + dy * stride + dx] = owner
+
+    # Draws every trajectory as a line, first is the index of the first trajectory (it selects the color)
+    def add_lines(self, xs, ys, first, linewidth=None):
+        if linewidth is None:
+            linewidth = plt.rcParams['lines.linewidth']
+        lengths = np.array([len(x) for x in xs])
+        if lengths.sum() == 0:
+            return
+        px, py = self.to_pixels(np.concatenate(xs), np.concatenate(ys))
+        line = np.repeat(np.arange(first, first + len(xs), dtype=np.int32), lengths)
+
+        # Segments between consecutive points of the same line, segments with a missing value are skipped
+        start = np.flatnonzero(line[:-1] == line[1:])
+        x0, y0, x1, y1 = px[start], py[start], px[start + 1], py[start + 1]
+        finite = np.isfinite(x0) & np.isfinite(y0) & np.isfinite(x1) & np.isfinite(y1)
+        x0, y0, x1, y1, owner = x0[finite], y0[finite], x1[finite], y1[finite], line[start][finite]
+
+        # Clips the segments to the buffer (Liang-Barsky) so a segment leaving the view never costs more than the visible part
+        dx, dy = x1 - x0, y1 - y0
+        tLow = np.zeros(len(x0))
+        tHigh = np.ones(len(x0))
+        for p, d, limit in [(x0, dx, self.width), (y0, dy, self.height)]:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ta = -p / d
+                tb = (limit - p) / d
+            inside = (p >= 0) & (p <= limit)
+            tLow = np.maximum(tLow, np.where(d != 0, np.minimum(ta, tb), np.where(inside, -np.inf, np.inf)))
+            tHigh = np.minimum(tHigh, np.where(d != 0, np.maximum(ta, tb), np.where(inside, np.inf, -np.inf)))
+        visible = tLow <= tHigh
+        x0, y0, dx, dy, owner = x0[visible], y0[visible], dx[visible], dy[visible], owner[visible]
+        tLow, tHigh = tLow[visible], tHigh[visible]
+        x0, y0 = x0 + tLow * dx, y0 + tLow * dy
+        dx, dy = dx * (tHigh - tLow), dy * (tHigh - tLow)
+
+        # One sample per pixel along each segment
+        samples = np.ceil(np.maximum(np.abs(dx), np.abs(dy))).astype(np.int64) + 1
+        segment = np.repeat(np.arange(len(samples)), samples)
+        step = np.arange(samples.sum()) - np.repeat(np.cumsum(samples) - samples, samples)
+        t = step / np.maximum(samples - 1, 1)[segment]
+        size = max(int(round(linewidth * self.pointsToPixels)), 1)
+        self.stamp(x0[segment] + t * dx[segment], y0[segment] + t * dy[segment], owner[segment], size)
+
+    # Draws every point of every trajectory as a dot, first is the index of the first trajectory (it selects the color)
+    def add_points(self, xs, ys, first, markersize=None):
+        if markersize is None:
+            markersize = plt.rcParams['lines.markersize']
+        lengths = [len(x) for x in xs]
+        if sum(lengths) == 0:
+            return
+        px, py = self.to_pixels(np.concatenate(xs), np.concatenate(ys))
+        # The '.' marker is drawn at half the marker size
+        size = max(int(round(markersize / 2 * self.pointsToPixels)), 1)
+        self.stamp(px, py, np.repeat(np.arange(first, first + len(xs), dtype=np.int32), lengths), size)
+
+    # Draws the buffer on the axes, above the reference lines like the trajectories drawn by visualize()
+    def draw(self, count):
+        owner = self.owner[self.margin:self.margin + self.height, self.margin:self.margin + self.width]
+        image = np.zeros((self.height, self.width, 4))
+        drawn = owner >= 0
+        image[drawn] = trajectory_colors(count)[owner[drawn]]
+        self.ax.imshow(image, extent=(*self.xlim, *self.ylim), origin='lower', interpolation='nearest', aspect='auto', zorder=2)
+        self.ax.set_xlim(self.xlim)
+        self.ax.set_ylim(self.ylim)
+
+
+# Renders both views to image files without opening a window (e.g. on a headless server)
+# Trajectories are read in batches, each one is downsampled with LTTB to the pixel width of the figure and rasterized (see
+# TrajectoryRaster) before the next batch is read, so memory use depends on the batch and image sizes only
+# The representative trajectory is built while the batches are read (or loaded from summaryPath) and drawn over the images
+def render(input, directory, formats=("png",), points=None, batchSize=1000, summaryPath=None, savePath=None):
+    plt.switch_backend("Agg")
+    os.makedirs(directory, exist_ok=True)
+
+    fig1, ax1 = plt.subplots()
+    fig2, ax2 = plt.subplots()
+    draw_horizontal_view(ax1, [])
+    draw_top_down_view(ax2, [])
+    horizontal = TrajectoryRaster(ax1)
+    topDown = TrajectoryRaster(ax2)
+    # Default: one point per horizontal pixel of the plot
+    if points is None:
+        points = max(horizontal.width, 3)
+
+    summary, builder = representative_summary(summaryPath)
+    batch = []
+    count = 0
+
+    def draw_batch():
+        distX = [np.asarray(df['Distance From Start (nmi)']) for df in batch]
+        altY = [np.asarray(df['Alt - Ground Level']) for df in batch]
+        kept = resample.lttb_batch(distX, altY, points)
+        horizontal.add_lines([x[idx] for x, idx in zip(distX, kept)], [y[idx] for y, idx in zip(altY, kept)], count)
+
+        rotated = [rotate(np.asarray(df['Lat']), np.asarray(df['Long'])) for df in batch]
+        newX = [x for x, y in rotated]
+        newY = [y for x, y in rotated]
+        kept = resample.lttb_batch(newX, newY, points)
+        topDown.add_points([x[idx] for x, idx in zip(newX, kept)], [y[idx] for y, idx in zip(newY, kept)], count)
+
+        if builder is not None:
+            for x, y, newx, newy in zip(distX, altY, newX, newY):
+                builder.add(x, {'Alt - Ground Level': y, 'Top Down X': newx, 'Top Down Y': newy})
+        batch.clear()
+
+    for df in instrument.iterate(load_frames(input, ['Distance From Start (nmi)', 'Alt - Ground Level', 'Lat', 'Long']), "load"):
+        batch.append(df)
+        if len(batch) == batchSize:
+            with instrument.stage("draw"):
+                draw_batch()
+            count += batchSize
+    last = len(batch)
+    with instrument.stage("draw"):
+        draw_batch()
+    count += last
+    instrument.count("trajectories", count)
+
+    horizontal.draw(count)
+    topDown.draw(count)
+
+    if builder is not None:
+        summary = builder.summary()
+    if savePath is not None:
+        representative.save(savePath, summary)
+    draw_representative(ax1, ax2, summary)
+
+    paths = []
+    for fmt in formats:
+        for fig, name in [(fig1, 'horizontal_view'), (fig2, 'top_down_view')]:
+            path = os.path.join(directory, name + '.' + fmt)
+            with instrument.stage("save"):
+                fig.savefig(path)
+            paths.append(path)
+    plt.close(fig1)
+    plt.close(fig2)
+    return paths
+
 
 if __name__ == '__main__':
     # if you type --help
-    parser = argparse.ArgumentParser(description="This program pre-processes flight data. It adds two new columns to the .csv file,'Altitude from ground level' and 'Distance from start(nmi)'. The default airport and runway is Boston - Logan International, runway 33. It can also show two separate graphs visualizing the landing patterns of the planes. Either -in or -v is required to run the program, other arguments are optional")
+    parser = argparse.ArgumentParser(description="This program pre-processes flight data. It adds two new columns to the .csv file,'Altitude from ground level' and 'Distance from start(nmi)'. The default airport and runway is Boston - Logan International, runway 33. It can also show two separate graphs visualizing the landing patterns of the planes. Either -in, -v or -listen is required to run the program, other arguments are optional")
 
     # Commands for input, output, lat, long, and alt arguments
     # input or visualize is required, if no output is added the program will create an output directory
@@ -363,9 +938,25 @@ if __name__ == '__main__':
     parser.add_argument('-slong', metavar="LONGITUDE", help="Longitude of starting position")
     parser.add_argument('-alt', metavar="ALTITUDE", help="Altitude above sea level of runway")
     parser.add_argument('-v', metavar="VISUALIZE", nargs="+", help="Shows graph of file or directory of files")
+    parser.add_argument('-render-to', '--render-to', metavar="DIRECTORY", help="With -v, write the graphs as image files to this directory instead of showing them")
+    parser.add_argument('-render-format', '--render-format', metavar="FORMAT", nargs="+", default=["png"], help="Image formats written by -render-to (e.g. png svg)")
+    parser.add_argument('-render-points', metavar="POINTS", type=int, help="Points kept per trajectory by -render-to (default: image width in pixels)")
+    parser.add_argument('-representative', metavar="FILE", help="With -v, draw the median line and percentile band saved in this file instead of the ones of the trajectories shown")
+    parser.add_argument('-save-representative', metavar="FILE", help="With -v, save the median line and percentile band of the trajectories to this .npz file")
+    parser.add_argument('-distance', choices=geodistance.METHODS, default="vincenty", help="Distance engine: vectorized ellipsoidal (vincenty), vectorized spherical (haversine) or per-row geopy")
+    parser.add_argument('-format', choices=["csv", "store"], default="csv", help="Output format: one csv per file or a single columnar trajectory store")
+    parser.add_argument('-chunksize', metavar="ROWS", type=int, help="Stream each file in chunks of this many rows instead of loading it whole")
+    parser.add_argument('-hz', '--hz', metavar="HZ", type=float, help="Resample each file to this data collection frequency (in Hz)")
+    parser.add_argument('-force', action="store_true", help="Process every file again, even if it is unchanged since the last run")
+    parser.add_argument('-j', '--workers', metavar="WORKERS", type=int, default=1, help="Number of worker processes used to pre-process files, 0 uses every core")
+    parser.add_argument('-listen', metavar="PORT", type=int, help="Record FlightGear's generic protocol (flightgear/flightlog.xml) from this UDP port into the store output/live")
+    parser.add_argument('-host', metavar="HOST", default="127.0.0.1", help="Address -listen binds to")
+    parser.add_argument('-idle', metavar="SECONDS", type=float, default=10, help="With -listen, a trajectory ends after this many seconds without packets")
+    instrument.add_arguments(parser)
 
     # Get our arguments from the user
     args = vars(parser.parse_args())
+    instrument.start(args['profile'], args['profile_calls'])
 
     # set input as list of arguments given
     # Below allows the user to input 'output' instead of 'output.csv'... The '.csv' will be added
@@ -384,17 +975,22 @@ if __name__ == '__main__':
     # set output
     output = args['out']
 
+    # set number of worker processes
+    workers = args['workers'] if args['workers'] > 0 else os.cpu_count()
+
     # picks up arguments for new airport/runway
+    params = runway_parameters()
     if args['rlat'] is not None:
-        rlat = args['rlat']
+        params['rLat'] = float(args['rlat'])
     if args['rlong'] is not None:
-        rlong = args['rlong']
+        params['rLong'] = float(args['rlong'])
     if args['alt'] is not None:
-        alt = args['alt']
-    if args['rlat'] is not None:
-        startLat = args['slat']
-    if args['rlong'] is not None:
-        startLong = args['slong']
+        params['alt'] = float(args['alt'])
+    if args['slat'] is not None:
+        params['startLat'] = float(args['slat'])
+    if args['slong'] is not None:
+        params['startLong'] = float(args['slong'])
+    set_runway_parameters(params)
 
     # set visual as list of arguments given
     # Below allows the user to input 'output' instead of 'output.csv'... The '.csv' will be added
@@ -409,16 +1005,28 @@ if __name__ == '__main__':
             else:
                 if not visual[idx].endswith('.csv'):
                     visual[idx] += ".csv"
-        visualize(visual)
+        if args['render_to'] is not None:
+            for path in render(visual, args['render_to'], args['render_format'], args['render_points'],
+                               summaryPath=args['representative'], savePath=args['save_representative']):
+                print(path)
+        else:
+            visualize(visual, args['representative'], args['save_representative'])
     
+    # live ingestion, output defaults to the output folder
+    elif args['listen'] is not None:
+        output = args['out'] if args['out'] is not None else 'output'
+        if not os.path.isdir(output):
+            os.makedirs(output)
+        listen(output, args['host'], args['listen'], args['distance'], args['idle'])
+
     # if output was given
     elif args['out'] is not None:
         if not os.path.isdir(output):
             os.makedirs(output)
-        flight_process(input, output)
+        flight_process(input, output, args['distance'], workers, args['format'], args['force'], args['chunksize'], args['hz'])
     # create output if none was given
     else:
         if not os.path.isdir('output'):
             os.makedirs('output')
         output = 'output'
-        flight_process(input, output)
\ No newline at end of file
+        flight_process(input, output, args['distance'], workers, args['format'], args['force'], args['chunksize'], args['hz'])
\ No newline at end of file
@@ -0,0 +1,95 @@
+import os
+import time
+import socket
+import argparse
+import instrument
+
+# ------------------------------------------------------------------------------------------------------------
+# Replays recorded flight data files (input/RK-*.csv) as FlightGear's generic protocol over UDP, so the live mode of
+# flightprocess.py (-listen) can be run and measured without a simulator.
+#
+# Every row is sent as one line of comma separated values like flightgear/flightlog.xml, paced by its 'Time' column
+# divided by the speed-up. The time the line was sent is added as a last value, which the listener uses to report the
+# end-to-end latency. Files are sent one after the other, 'Time' starting over tells the listener a new landing began.
+# ------------------------------------------------------------------------------------------------------------
+# Replay every recorded file in real time, 10 times faster, or as fast as possible:
+#           python3 flightreplay.py -in ./input -port 5500
+#           python3 flightreplay.py -in ./input -port 5500 -speed 10
+#           python3 flightreplay.py -in ./input/RK-01.csv -port 5500 -speed 0
+# ------------------------------------------------------------------------------------------------------------
+
+
+def list_recordings(input):
+    """
+    Lists the recorded csv files of a list of files and directories (top level of each directory, sorted by name)
+
+    :param input: List of files and directories
+    :return: List of file paths
+    """
+    paths = []
+    for inp in input:
+        if os.path.isdir(inp):
+            paths += [os.path.join(inp, file) for file in sorted(os.listdir(inp)) if file.endswith(".csv")]
+        elif os.path.isfile(inp):
+            paths.append(inp)
+    return paths
+
+
+def replay_file(sock, address, path, speed, rowsPerPacket=1):
+    """
+    Sends the rows of one recorded file, paced by its 'Time' column
+
+    :param sock: UDP socket
+    :param address: (host, port) of the listener
+    :param path: Recorded csv file
+    :param speed: Speed-up of the replay, 0 sends as fast as possible
+    :param rowsPerPacket: Number of rows sent in each datagram
+    :return: Number of rows sent
+    """
+    with open(path, encoding="Latin-1") as f:
+        f.readline()
+        lines = [line.strip() for line in f if line.strip()]
+
+    start = time.perf_counter()
+    t0 = float(lines[0].split(",", 1)[0]) if lines else 0
+    for idx in range(0, len(lines), rowsPerPacket):
+        packet = lines[idx:idx + rowsPerPacket]
+        if speed > 0:
+            # Waits until the recorded time of the first row of the packet
+            delay = (float(packet[0].split(",", 1)[0]) - t0) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        sent = f"{time.time():.6f}"
+        sock.sendto("".join(line + "," + sent + "\n" for line in packet).encode("ascii"), address)
+    return len(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Streams recorded flight data files to flightprocess.py -listen as FlightGear's generic protocol over UDP")
+
+    parser.add_argument('-in', metavar="INPUT", nargs="+", default=["input"], help='recorded file(s) or directories (default: ./input)')
+    parser.add_argument('-host', metavar="HOST", default="127.0.0.1", help="Address of the listener")
+    parser.add_argument('-port', metavar="PORT", type=int, default=5500, help="UDP port of the listener")
+    parser.add_argument('-speed', metavar="SPEEDUP", type=float, default=1, help="Speed-up of the replay, 0 sends as fast as possible")
+    parser.add_argument('-rows', metavar="ROWS", type=int, default=1, help="Rows sent in each datagram")
+    parser.add_argument('-gap', metavar="SECONDS", type=float, default=0, help="Pause between two files")
+    instrument.add_arguments(parser)
+
+    args = vars(parser.parse_args())
+    instrument.start(args['profile'], args['profile_calls'])
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = (args['host'], args['port'])
+    total = 0
+    start = time.perf_counter()
+    for idx, path in enumerate(list_recordings(args['in'])):
+        if idx and args['gap']:
+            time.sleep(args['gap'])
+        with instrument.stage("replay"):
+            rows = replay_file(sock, address, path, args['speed'], args['rows'])
+        total += rows
+        instrument.count("files")
+        instrument.count("rows", rows)
+        print(f"{path}: {rows} rows")
+    elapsed = time.perf_counter() - start
+    print(f"{total} rows sent in {elapsed:.2f} s ({total / max(elapsed, 1e-9):.0f} rows/s)")
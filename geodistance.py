@@ -0,0 +1,185 @@
+import argparse
+import numpy as np
+import pandas as pd
+
+# ------------------------------------------------------------------------------------------------------------
+# Vectorized geodesic distances used by flightprocess.py to build the 'Distance From Start (nmi)' column.
+# Every function takes whole Lat/Long columns at once instead of calling geopy once per row.
+#
+#   vincenty  - ellipsoidal (WGS-84) inverse solution, within 2e-9 nmi of geopy on the RK recordings (about 4 micrometres,
+#               up to 5e-7 relative for the points a few metres from the start)
+#   haversine - spherical approximation, fastest, within ~0.5% of the ellipsoidal distance
+#   geopy     - the original row by row geopy.distance.distance call, kept as the reference
+# ------------------------------------------------------------------------------------------------------------
+# Check the vectorized engines against geopy on one or more processed or raw flight files:
+#           python3 geodistance.py -in ./input/RK-01.csv -slat 42.29543 -slong -70.91265
+# ------------------------------------------------------------------------------------------------------------
+
+# WGS-84 ellipsoid, the same one geopy uses by default
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = (1 - WGS84_F) * WGS84_A
+
+# Mean earth radius (in meters) used by the haversine formula
+EARTH_RADIUS = 6371008.8
+
+# Meters in one nautical mile
+METERS_PER_NM = 1852.0
+
+METHODS = ["vincenty", "haversine", "geopy"]
+
+
+def haversine_nm(lat0, lon0, lat, lon):
+    """
+    Spherical great-circle distance from a single point to every point in the lat/lon arrays
+
+    :param lat0: Latitude of the starting point (degrees)
+    :param lon0: Longitude of the starting point (degrees)
+    :param lat: Array of latitudes (degrees)
+    :param lon: Array of longitudes (degrees)
+    :return: Array of distances in nautical miles
+    """
+    phi0 = np.radians(lat0)
+    phi = np.radians(np.asarray(lat, dtype=float))
+    dPhi = phi - phi0
+    dLambda = np.radians(np.asarray(lon, dtype=float) - lon0)
+
+    h = np.sin(dPhi / 2) ** 2 + np.cos(phi0) * np.cos(phi) * np.sin(dLambda / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(h, 0, 1))) / METERS_PER_NM
+
+
+def vincenty_nm(lat0, lon0, lat, lon, tolerance=1e-12, maxIterations=200):
+    """
+    Ellipsoidal (WGS-84) distance from a single point to every point in the lat/lon arrays using Vincenty's
+    inverse formula. All points are iterated together until the slowest point converges.
+    Points that never converge (nearly antipodal, never the case for an approach) fall back to geopy.
+
+    :param lat0: Latitude of the starting point (degrees)
+    :param lon0: Longitude of the starting point (degrees)
+    :param lat: Array of latitudes (degrees)
+    :param lon: Array of longitudes (degrees)
+    :param tolerance: Convergence tolerance on lambda (radians)
+    :param maxIterations: Maximum number of iterations
+    :return: Array of distances in nautical miles
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+
+    # Reduced latitudes
+    U1 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat0)))
+    U2 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat)))
+    sinU1, cosU1 = np.sin(U1), np.cos(U1)
+    sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+    # Each point stops updating once it has converged, so its distance never depends on the other points of the array
+    L = np.radians(lon - lon0)
+    lam = L.copy()
+    converged = np.zeros(lam.shape, dtype=bool)
+
+    for _ in range(maxIterations):
+        sinLam, cosLam = np.sin(lam), np.cos(lam)
+        sinSigma = np.sqrt((cosU2 * sinLam) ** 2 + (cosU1 * sinU2 - sinU1 * cosU2 * cosLam) ** 2)
+        cosSigma = sinU1 * sinU2 + cosU1 * cosU2 * cosLam
+        sigma = np.arctan2(sinSigma, cosSigma)
+
+        # Coincident points have sinSigma == 0, their distance is 0 whatever the other terms are
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sinAlpha = np.where(sinSigma == 0, 0.0, cosU1 * cosU2 * sinLam / sinSigma)
+            cosSqAlpha = 1 - sinAlpha ** 2
+            # Points on the equator line have cosSqAlpha == 0
+            cos2SigmaM = np.where(cosSqAlpha == 0, 0.0, cosSigma - 2 * sinU1 * sinU2 / cosSqAlpha)
+
+        C = WGS84_F / 16 * cosSqAlpha * (4 + WGS84_F * (4 - 3 * cosSqAlpha))
+        lamNext = L + (1 - C) * WGS84_F * sinAlpha * (
+            sigma + C * sinSigma * (cos2SigmaM + C * cosSigma * (-1 + 2 * cos2SigmaM ** 2)))
+
+        converged |= np.abs(lamNext - lam) <= tolerance
+        if converged.all():
+            break
+        lam = np.where(converged, lam, lamNext)
+
+    uSq = cosSqAlpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+    A = 1 + uSq / 16384 * (4096 + uSq * (-768 + uSq * (320 - 175 * uSq)))
+    B = uSq / 1024 * (256 + uSq * (-128 + uSq * (74 - 47 * uSq)))
+    deltaSigma = B * sinSigma * (cos2SigmaM + B / 4 * (
+        cosSigma * (-1 + 2 * cos2SigmaM ** 2) - B / 6 * cos2SigmaM * (-3 + 4 * sinSigma ** 2) * (-3 + 4 * cos2SigmaM ** 2)))
+
+    d = WGS84_B * A * (sigma - deltaSigma) / METERS_PER_NM
+
+    # Falls back to geopy for any point that did not converge
+    if not converged.all():
+        idx = np.flatnonzero(~converged)
+        d[idx] = geopy_nm(lat0, lon0, lat[idx], lon[idx])
+
+    return d
+
+
+def geopy_nm(lat0, lon0, lat, lon):
+    """
+    Reference implementation, calls geopy.distance.distance once per point
+
+    :param lat0: Latitude of the starting point (degrees)
+    :param lon0: Longitude of the starting point (degrees)
+    :param lat: Array of latitudes (degrees)
+    :param lon: Array of longitudes (degrees)
+    :return: Array of distances in nautical miles
+    """
+    from geopy import distance
+
+    startPoint = (lat0, lon0)
+    return np.array([distance.distance(startPoint, (la, lo)).nm for la, lo in zip(lat, lon)], dtype=float)
+
+
+def distance_nm(lat0, lon0, lat, lon, method="vincenty"):
+    """
+    Distance from a single point to every point in the lat/lon arrays using the selected engine
+
+    :param lat0: Latitude of the starting point (degrees)
+    :param lon0: Longitude of the starting point (degrees)
+    :param lat: Array of latitudes (degrees)
+    :param lon: Array of longitudes (degrees)
+    :param method: One of 'vincenty', 'haversine' or 'geopy'
+    :return: Array of distances in nautical miles
+    """
+    if method == "vincenty":
+        return vincenty_nm(lat0, lon0, lat, lon)
+    if method == "haversine":
+        return haversine_nm(lat0, lon0, lat, lon)
+    if method == "geopy":
+        return geopy_nm(lat0, lon0, lat, lon)
+    raise ValueError(f"Unknown distance method '{method}', expected one of {METHODS}")
+
+
+def compare_to_geopy(lat0, lon0, lat, lon, method):
+    """
+    Measures how far a vectorized engine is from geopy on the same points
+
+    :param lat0: Latitude of the starting point (degrees)
+    :param lon0: Longitude of the starting point (degrees)
+    :param lat: Array of latitudes (degrees)
+    :param lon: Array of longitudes (degrees)
+    :param method: Engine to check, 'vincenty' or 'haversine'
+    :return: Maximum absolute error (nmi) and maximum relative error
+    """
+    reference = geopy_nm(lat0, lon0, lat, lon)
+    d = distance_nm(lat0, lon0, lat, lon, method)
+    error = np.abs(d - reference)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        relative = np.where(reference > 0, error / reference, 0.0)
+    return error.max(initial=0.0), relative.max(initial=0.0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Checks the vectorized distance engines against geopy")
+
+    parser.add_argument('-in', metavar="INPUT", nargs="+", required=True, help='input file(s) with Lat/Long columns')
+    parser.add_argument('-slat', metavar="LATITUDE", type=float, default=42.29543, help="Latitude of starting position")
+    parser.add_argument('-slong', metavar="LONGITUDE", type=float, default=-70.91265, help="Longitude of starting position")
+
+    args = vars(parser.parse_args())
+
+    for inp in args['in']:
+        data = pd.read_csv(inp, encoding="Latin-1")
+        for method in ["vincenty", "haversine"]:
+            absError, relError = compare_to_geopy(args['slat'], args['slong'], data['Lat'], data['Long'], method)
+            print(f"{inp} - {method}: max error {absError:.3e} nmi ({relError:.3e} relative)")
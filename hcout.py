@@ -1,6 +1,8 @@
 import sys
 import numpy as np
 import pandas as pd
+import features
+import instrument
 from matplotlib import pyplot as plt
 from scipy.cluster.hierarchy import dendrogram, linkage, fcluster
 
@@ -13,46 +15,33 @@ def dendro(file, clusterCount, isCCPassed):
     :return:
     """
 
-    dataframe = pd.read_csv(file)
-    dataframe = dataframe.dropna()
-
-    # Get data for column 'Degree = 4 Coefficients' The column contains the points in a string '[ .. ]',
-    # so we will have to parse that string to remove the brackets and extract the float values
-
-    pointsRaw = dataframe.iloc[:, [1]].to_numpy()  # extract values and convert to numpy
-    # Now, take each row, remove first and last characters ( [] ), and split
-
-    X = None
-
-    # Loop through each raw sample
-    for i, points_str in enumerate(pointsRaw):
-        # Convert to float
-        points_i = list(map(float, [x for x in points_str[0].split(",")]))
-
-        if i == 0:
-            X = np.zeros((pointsRaw.shape[0], len(points_i)))  # Matrix to store all trajectories
-        # Add to matrix
-        X[i, :] = points_i
+    # Get the coefficients of the first group of the file (e.g. 'Degree=1' of polycoef.py) as a float matrix,
+    # rows without a trajectory name or with missing coefficients are left out
+    with instrument.stage("load"):
+        dataframe, _, X = features.load_features(file)
+    instrument.count("trajectories", len(X))
 
     # Hierarchical Clustering
-    Z = linkage(X, method='ward', metric='euclidean')
+    with instrument.stage("linkage"):
+        Z = linkage(X, method='ward', metric='euclidean')
 
     # Dendrogram
     # creating label dictionary based on index and 'Trajectories' column for x-axis tick labels 
     label_dict = dict(zip(dataframe['Trajectories'].index, dataframe['Trajectories']))
 
-    # Create figure
-    plt.figure(figsize=(15, 10))
-    # Create dendrogram
-    dn = dendrogram(
-        Z,
-        leaf_rotation=90.,  # rotates the x-axis labels
-        leaf_font_size=8,  # font size for the x-axis labels
-        leaf_label_func=lambda x: label_dict[x]
-    )
-
-    plt.xticks()
-    plt.savefig('dendrogram.png')
+    with instrument.stage("dendrogram"):
+        # Create figure
+        plt.figure(figsize=(15, 10))
+        # Create dendrogram
+        dn = dendrogram(
+            Z,
+            leaf_rotation=90.,  # rotates the x-axis labels
+            leaf_font_size=8,  # font size for the x-axis labels
+            leaf_label_func=lambda x: label_dict[x]
+        )
+
+        plt.xticks()
+        plt.savefig('dendrogram.png')
     plt.show()
 
     if isCCPassed:
@@ -71,6 +60,9 @@ if __name__ == '__main__':
     file = None
     isCCPassed = False
 
+    # --profile[=FILE] and --profile-calls time the stages of the run (see instrument.py)
+    instrument.start(*instrument.parse_argv(sys.argv))
+
     if len(sys.argv) == 1:
         raise Exception("Please Pass Input CSV")
     elif len(sys.argv) == 2:
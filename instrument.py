@@ -0,0 +1,396 @@
+import os
+import sys
+import json
+import time
+import atexit
+import pstats
+import cProfile
+import resource
+import threading
+from datetime import datetime
+from functools import partial
+
+# ------------------------------------------------------------------------------------------------------------
+# Stage timers, counters and memory sampling shared by the scripts, enabled with --profile
+#
+# A script calls start() with its --profile arguments; until then (and without --profile) every call below does nothing,
+# so the instrumented code runs as fast as before. Once started:
+#   stage(name)       - context manager timing a part of the run (reading, distance, fitting, plotting ...). Stages
+#                       opened inside another stage are recorded as 'outer/inner'
+#   iterate(it, name) - times every step of an iterator (chunked readers)
+#   count(name, n)    - adds to a counter (rows, files, fits, failures ...)
+#   memory            - a background thread samples the resident memory, every stage records the peak seen while it ran
+#   --profile-calls   - the whole run of the main process is also captured with cProfile
+# Worker processes record their own stages and counters: tasks submitted to a pool are wrapped with worker_task() and
+# their results passed through unwrap(), which adds the worker's stages and counters to the report. Worker stage times
+# are summed over every worker process (they overlap in wall time), so they are reported apart from the main stages.
+#
+# When the script ends a JSON report is written (profile-<script>-<time>.json unless a file is given) and a short
+# summary printed, a cProfile capture is written next to it as <report>.prof (open it with python3 -m pstats).
+# ------------------------------------------------------------------------------------------------------------
+# Profile a run:
+#           python3 polycoef.py -in ./output -out ./fits --profile
+# --------------------------------------------------------------------------------------------------------------
+# Write the report to a given file and capture every function call (scripts without options take --profile=FILE):
+#           python3 meanshift.py ./fits/polycoef-20260101-120000.csv --profile=meanshift.json --profile-calls
+# --------------------------------------------------------------------------------------------------------------
+
+# Seconds between two memory samples
+SAMPLE_INTERVAL = 0.05
+
+# Functions listed in the report of a cProfile capture
+TOP_CALLS = 30
+
+# Active profiler of this process, None when profiling is off
+_profiler = None
+
+
+class _NoStage:
+    """
+    Stage returned while profiling is off
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+def rss_mb():
+    """
+    Current resident memory of this process, read from /proc where available (peak resident memory otherwise)
+
+    :return: Resident memory in MB
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb(resource.RUSAGE_SELF)
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """
+    Peak resident memory of this process or of its finished child processes
+
+    :param who: resource.RUSAGE_SELF or resource.RUSAGE_CHILDREN
+    :return: Peak resident memory in MB
+    """
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return resource.getrusage(who).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+class Stage:
+    """
+    Times one run of a stage, see Profiler.stage
+    """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        profiler = self.profiler
+        self.path = "/".join(profiler.open + [self.name])
+        profiler.open.append(self.name)
+        self.peak = profiler.rss
+        profiler.running.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        profiler = self.profiler
+        profiler.open.pop()
+        profiler.running.remove(self)
+        profiler.add_stage(profiler.stages, self.path, 1, seconds, max(self.peak, profiler.rss))
+        return False
+
+
+class Profiler:
+    """
+    Stages, counters and memory samples of one process
+    """
+
+    def __init__(self, script=None, calls=False, interval=SAMPLE_INTERVAL):
+        self.script = script
+        self.started = datetime.now()
+        self.start = time.perf_counter()
+        # Stage name to [calls, seconds, peak RSS in MB]
+        self.stages = {}
+        self.workerStages = {}
+        self.counters = {}
+        self.workerPeak = 0.0
+        self.open = []
+        self.running = []
+        # Last memory sample, stages never read /proc themselves so timing many short stages stays cheap
+        self.rss = rss_mb()
+        self.calls = cProfile.Profile() if calls else None
+        self.stopped = threading.Event()
+        self.sampler = None
+        if interval:
+            self.sampler = threading.Thread(target=self._sample, args=(interval,), daemon=True)
+            self.sampler.start()
+        if self.calls is not None:
+            self.calls.enable()
+
+    def _sample(self, interval):
+        while not self.stopped.wait(interval):
+            self.rss = rss_mb()
+            for stage in list(self.running):
+                stage.peak = max(stage.peak, self.rss)
+
+    def stage(self, name):
+        return Stage(self, name)
+
+    @staticmethod
+    def add_stage(stages, name, calls, seconds, peak):
+        entry = stages.setdefault(name, [0, 0.0, 0.0])
+        entry[0] += calls
+        entry[1] += seconds
+        entry[2] = max(entry[2], peak)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        """
+        Stages & counters of a worker process, sent back to the main process with a task result
+
+        :return: Dictionary of plain values
+        """
+        return {"stages": self.stages, "counters": self.counters, "peakRssMB": peak_rss_mb()}
+
+    def merge(self, snapshot):
+        """
+        Adds the stages & counters of a worker task
+
+        :param snapshot: Result of the worker's snapshot()
+        """
+        for name, (calls, seconds, peak) in snapshot["stages"].items():
+            self.add_stage(self.workerStages, name, calls, seconds, peak)
+        for name, n in snapshot["counters"].items():
+            self.count(name, n)
+        self.workerPeak = max(self.workerPeak, snapshot["peakRssMB"])
+
+    def stop(self):
+        self.stopped.set()
+        if self.calls is not None:
+            self.calls.disable()
+
+    def report(self):
+        """
+        Report of the run
+
+        :return: Dictionary written as JSON
+        """
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        def stage_table(stages):
+            return {name: {"calls": calls, "seconds": round(seconds, 6), "peakRssMB": round(peak, 1)}
+                    for name, (calls, seconds, peak) in stages.items()}
+
+        return {
+            "script": self.script,
+            "argv": sys.argv,
+            "started": self.started.isoformat(timespec="seconds"),
+            "seconds": round(time.perf_counter() - self.start, 6),
+            "cpuSeconds": round(usage.ru_utime + usage.ru_stime, 3),
+            "childCpuSeconds": round(children.ru_utime + children.ru_stime, 3),
+            "peakRssMB": round(peak_rss_mb(), 1),
+            "workerPeakRssMB": round(max(self.workerPeak, peak_rss_mb(resource.RUSAGE_CHILDREN)), 1),
+            "stages": stage_table(self.stages),
+            "workerStages": stage_table(self.workerStages),
+            "counters": self.counters,
+        }
+
+
+def top_calls(calls, limit=TOP_CALLS):
+    """
+    Functions of a cProfile capture taking the most cumulative time
+
+    :param calls: cProfile.Profile
+    :param limit: Number of functions listed
+    :return: List of dictionaries
+    """
+    stats = pstats.Stats(calls)
+    rows = []
+    for (file, line, function), (_, calls, total, cumulative, _) in stats.stats.items():
+        rows.append({"function": f"{os.path.basename(file)}:{line}({function})", "calls": calls,
+                     "totalSeconds": round(total, 6), "cumulativeSeconds": round(cumulative, 6)})
+    rows.sort(key=lambda row: row["cumulativeSeconds"], reverse=True)
+    return rows[:limit]
+
+
+def add_arguments(parser):
+    """
+    Adds --profile and --profile-calls to the options of a script
+
+    :param parser: argparse.ArgumentParser
+    """
+    parser.add_argument('--profile', metavar="FILE", nargs="?", const="", help="Time the stages of the run and write a JSON report to this file (default: profile-<script>-<time>.json)")
+    parser.add_argument('--profile-calls', action="store_true", help="With --profile, also capture every function call of the main process with cProfile")
+
+
+def parse_argv(argv):
+    """
+    Removes --profile[=FILE] and --profile-calls from the arguments of a script without argparse options
+
+    :param argv: sys.argv, modified in place
+    :return: Report path (None without --profile, '' for the default name) & whether calls are captured
+    """
+    path = None
+    calls = False
+    for arg in list(argv[1:]):
+        if arg == "--profile" or arg.startswith("--profile="):
+            path = arg.partition("=")[2]
+            argv.remove(arg)
+        elif arg == "--profile-calls":
+            calls = True
+            argv.remove(arg)
+    return path, calls
+
+
+def start(path, calls=False, script=None):
+    """
+    Starts profiling the process, the report is written when the script ends
+
+    :param path: Report path, '' for the default name, None leaves profiling off
+    :param calls: Also capture every function call with cProfile
+    :param script: Script name written in the report (name of the running script if None)
+    :return: The Profiler, or None when profiling is off
+    """
+    global _profiler
+    if path is None:
+        return None
+    script = script or os.path.basename(sys.argv[0])
+    if not path:
+        path = f"profile-{os.path.splitext(script)[0]}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    _profiler = Profiler(script, calls)
+    atexit.register(finish, path)
+    return _profiler
+
+
+def finish(path):
+    """
+    Stops profiling, writes the report and prints a summary
+
+    :param path: Report path
+    """
+    global _profiler
+    profiler = _profiler
+    if profiler is None:
+        return
+    _profiler = None
+    profiler.stop()
+    report = profiler.report()
+    if profiler.calls is not None:
+        callPath = os.path.splitext(path)[0] + ".prof"
+        profiler.calls.dump_stats(callPath)
+        report["callProfile"] = callPath
+        report["calls"] = top_calls(profiler.calls)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"\nProfile of {report['script']}: {report['seconds']:.2f} s, peak {report['peakRssMB']:.1f} MB")
+    for title, stages in (("", report["stages"]), (" (summed over workers)", report["workerStages"])):
+        for name, stage in stages.items():
+            print(f"    {name + title:<40} {stage['seconds']:10.3f} s {stage['calls']:>8} calls {stage['peakRssMB']:9.1f} MB")
+    for name, n in report["counters"].items():
+        print(f"    {name:<40} {n:>10}")
+    print(f"Profile written to {path}")
+
+
+def active():
+    """
+    :return: True while profiling is on
+    """
+    return _profiler is not None
+
+
+def stage(name):
+    """
+    Times a stage of the run: with instrument.stage("fit"): ...
+
+    :param name: Stage name
+    :return: Context manager
+    """
+    return _NO_STAGE if _profiler is None else _profiler.stage(name)
+
+
+def iterate(iterable, name):
+    """
+    Times every step of an iterator as a stage, e.g. the chunks of pd.read_csv(chunksize=...)
+
+    :param iterable: Iterable
+    :param name: Stage name
+    :return: Generator of the items of iterable
+    """
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            item = next(iterator, _NO_STAGE)
+        if item is _NO_STAGE:
+            return
+        yield item
+
+
+def count(name, n=1):
+    """
+    Adds to a counter of the run
+
+    :param name: Counter name
+    :param n: Amount added
+    """
+    if _profiler is not None:
+        _profiler.count(name, n)
+
+
+def run_worker(task, *args):
+    """
+    Runs a task in a worker process with profiling on, see worker_task
+
+    :param task: Function run
+    :param args: Arguments of task
+    :return: Dictionary with the task result and the worker's stages & counters
+    """
+    global _profiler
+    _profiler = Profiler()
+    try:
+        result = task(*args)
+        return {"instrumentResult": result, "instrumentSnapshot": _profiler.snapshot()}
+    finally:
+        _profiler.stop()
+        _profiler = None
+
+
+def worker_task(task):
+    """
+    Task submitted to a pool of worker processes: while profiling is on the workers record their own stages & counters,
+    which unwrap() adds to the report
+
+    :param task: Function defined at the top level of a module
+    :return: task itself when profiling is off, otherwise a wrapped task
+    """
+    return task if _profiler is None else partial(run_worker, task)
+
+
+def unwrap(result):
+    """
+    Result of a task submitted with worker_task()
+
+    :param result: Value returned by the pool
+    :return: Result of the task
+    """
+    if _profiler is not None and isinstance(result, dict) and "instrumentSnapshot" in result:
+        _profiler.merge(result["instrumentSnapshot"])
+        return result["instrumentResult"]
+    return result
@@ -1,97 +1,434 @@
 import pandas as pd
 import numpy as np
-from sklearn.metrics import silhouette_score
-from sklearn.cluster import KMeans
-from sklearn.model_selection import train_test_split
+import features
+import trajstore
+import instrument
+import pickle
+from sklearn.metrics import pairwise_distances, pairwise_distances_chunked
+from sklearn.cluster import KMeans, MiniBatchKMeans, kmeans_plusplus
+from threadpoolctl import threadpool_limits
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
-import sys
+import argparse
 import os
 
-#parsing of arguments
-
-if len(sys.argv) != 4:
-    print("please use below command to execute code")
-    print("python kmeans.py -cc num_clusters input_dataset_file")
-    sys.exit(0)
-
-if sys.argv[1] != '-cc':
-    print("cc option and num clusters must be defined")
-    sys.exit(0)
-
-if sys.argv[2].strip().isdigit() == False:
-    print("cluster count value must be numeric only")
-    sys.exit(0)
-
-if os.path.exists(sys.argv[3]) == False:
-    print("Given dataset file does not exists")
-    sys.exit(0)
-
-#getting cc value from command line
-cc = int(sys.argv[2].strip())
-
-inputFile = sys.argv[3] #getting input file
-outputFile = inputFile.replace(".csv","_kmeans.csv") #renaming input file to output file
-
-trajectory = []
-points = []
-dataset = pd.read_csv(inputFile) #dataset reading
-df = dataset.values
-for i in range(len(df)):
-    t = df[i,0] #extracting trajectory
-    p = df[i,1] #extracting points
-    arr = p.split(",")
-    temp = []
-    for j in range(len(arr)): #converting points in string to float
-        temp.append(float(arr[j].strip()))
-    points.append(temp)
-    trajectory.append(t)
-
-points = np.asarray(points)
-trajectory = np.asarray(trajectory)
-
-kmeans = KMeans(n_clusters=cc, init='k-means++') #kmeans clustering object
-kmeans.fit_predict(points) #start kmeans training
-centers = kmeans.cluster_centers_ #get centers
-dataset['Cluster_ID'] = pd.Series(kmeans.labels_, index=dataset.index)
-inertia = kmeans.inertia_
-dataset.to_csv(outputFile,index=False)
-
-for i in range(0,cc):
-    output = dataset.loc[dataset['Cluster_ID'] == i, 'Trajectories']
-    print(str(i)+" : "+str(', '.join(output.tolist()))+"\n")
-        
-
-scores = []
-cluster = []
-
-inertias = []
-cluster_num = []
-for i in range(1,10): #generate elbow value with various K
-    kmean = KMeans(n_clusters=i, init='k-means++')
-    kmean = kmean.fit(points)
-    inertias.append(kmean.inertia_)
-    cluster_num.append(i)
-
-for i in range(0,cc): #find silhoute score
-    X_train, X_test, y_train, y_test = train_test_split(points, points, test_size=0.2)
-    score = silhouette_score(X_test, kmeans.predict(X_test))
-    scores.append(score)
-    cluster.append(i)
-
-fig, axs = plt.subplots(1,2)
-axs[0].barh(cluster, scores, color='maroon')
-  
-axs[0].set_xlabel("Silhouette Score") #plot silhoutte graph
-axs[0].set_ylabel("Number of Clusters")
-axs[0].set_title("KMEANS Silhouette Score Graph")
-
-
-axs[1].plot(cluster_num, inertias, 'bx-')
-axs[1].set_xlabel('Cluster Number')
-axs[1].set_ylabel('Inertia')
-axs[1].set_title('Kmeans Elbow Graph')
-plt.show()
+# ------------------------------------------------------------------------------------------------------------
+# Cluster the trajectories of a coefficient file (polycoef.py, sigmoid.py ...) in cc clusters, writes <input>_kmeans.csv
+#           python3 kmeans.py -cc 3 ./output/polycoef-20260101-120000.csv
+# --------------------------------------------------------------------------------------------------------------
+# The elbow and silhouette graphs come from one sweep over K = 1 ... -kmax (see sweep): every K is fitted from k-means++
+# centers and again from the centroids of K - 1 plus a new center, keeping the better fit. Every K > 1 is therefore
+# fitted twice, about twice the fitting time of one k-means++ fit per K: the warm start alone can stay in a poor solution,
+# the second fit makes the elbow at least as good as the cold sweep. With -j the fits are spread across worker processes
+# (the result is the same for any -j). The silhouette of every K is computed once, on a
+# distance matrix shared by every K, or on a sample stratified by cluster (-sample trajectories) for large files
+#           python3 kmeans.py -cc 3 ./output/polycoef-20260101-120000.csv -kmax 15 -j 4
+# --------------------------------------------------------------------------------------------------------------
+# Mini-batch mode for files too large for memory: the coefficients are read -chunk rows at a time and fed to
+# MiniBatchKMeans.partial_fit for -epochs passes, then a second pass over the file labels every trajectory and appends
+# it to the output. The model is saved to a checkpoint (<output>.checkpoint) after every -checkpoint-every chunks, a run
+# that was stopped resumes from it, and running again once it finished only labels (or fits the added -epochs). A trajectory store or folder of out*.csv files is clustered on the altitude profile
+# of every trajectory resampled to -points points (written to <store>_kmeans.csv). No elbow or silhouette graph
+#           python3 kmeans.py -cc 5 ./output/polycoef-20260101-120000.csv -minibatch -chunk 50000 -epochs 3
+#           python3 kmeans.py -cc 5 ./output/trajectories -minibatch -points 100
+# --------------------------------------------------------------------------------------------------------------
 
+# Largest number of clusters of the elbow and silhouette sweep
+MAX_CLUSTERS = 9
 
+# Trajectories above which the silhouette is computed on a stratified sample instead of every pair of trajectories
+SILHOUETTE_SAMPLE = 5000
 
+# Points of every resampled altitude profile clustered in mini-batch mode
+PROFILE_POINTS = 100
 
+# Chunks fed to the mini-batch model between two checkpoints
+CHECKPOINT_CHUNKS = 10
+
+
+def add_centers(points, centers, count, rng):
+    """
+    Picks new centers like k-means++: each point is chosen with a probability proportional to its squared distance to
+    the nearest center already chosen
+
+    :param points: Points (n, d)
+    :param centers: Centers already chosen (k, d)
+    :param count: Number of centers added
+    :param rng: Random generator
+    :return: New centers (count, d)
+    """
+    nearest = pairwise_distances(points, centers, metric="sqeuclidean").min(axis=1)
+    added = []
+    for _ in range(count):
+        total = nearest.sum()
+        idx = rng.choice(len(points), p=nearest / total) if total > 0 else rng.integers(len(points))
+        added.append(points[idx])
+        nearest = np.minimum(nearest, ((points - points[idx]) ** 2).sum(axis=1))
+    return np.array(added).reshape(count, points.shape[1])
+
+
+def k_seed(seed, k):
+    """
+    Seed of the fits of one K, the same whatever the number of workers
+
+    :param seed: Seed of the sweep
+    :param k: Number of clusters
+    :return: Integer seed
+    """
+    return int(np.random.SeedSequence([seed, k]).generate_state(1)[0])
+
+
+def fit_k(points, k, seed=0, threads=None, previous=None):
+    """
+    Fits K-means for one K: from k-means++ centers, or warm-started from the centroids of K - 1 plus one center picked
+    like k-means++ (add_centers). Run by each worker process of the sweep
+
+    :param points: Points (n, d)
+    :param k: Number of clusters
+    :param seed: Seed of the sweep
+    :param threads: Threads used by the fit (every core if None)
+    :param previous: Centroids of K - 1 to warm-start from, None for a k-means++ start
+    :return: (K, labels, centroids, inertia, iterations)
+    """
+    with threadpool_limits(limits=threads):
+        if previous is None:
+            model = KMeans(n_clusters=k, init='k-means++', n_init=1, random_state=k_seed(seed, k)).fit(points)
+        else:
+            init = np.vstack([previous, add_centers(points, previous, k - len(previous), np.random.default_rng([seed, k]))])
+            model = KMeans(n_clusters=k, init=init, n_init=1).fit(points)
+    return k, model.labels_, model.cluster_centers_, model.inertia_, model.n_iter_
+
+
+def sweep(points, maxClusters=MAX_CLUSTERS, workers=1, seed=0):
+    """
+    Fits K-means for K = 1 ... maxClusters. Every K is fitted from k-means++ centers, then every K > 1 again warm-started
+    from the first fit of K - 1, and the fit of lower inertia is kept: a warm start alone can stay in the poor solution
+    of K - 1 (a cluster split in two while two others stay merged). The fits of each round run in parallel, every fit
+    has its own seed so the result does not depend on the number of workers
+
+    :param points: Points (n, d)
+    :param maxClusters: Largest K, at most the number of points
+    :param workers: Number of worker processes
+    :param seed: Seed of the fits
+    :return: Dictionary of K to (labels, centroids, inertia, iterations)
+    """
+    ks = list(range(1, min(maxClusters, len(points)) + 1))
+    workers = min(workers, len(ks))
+
+    def run(tasks):
+        if workers <= 1:
+            return [fit_k(points, k, seed, None, previous) for k, previous in tasks]
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(instrument.worker_task(fit_k), points, k, seed, threads, previous) for k, previous in tasks]
+            return [instrument.unwrap(future.result()) for future in futures]
+
+    cold = {result[0]: result for result in run([(k, None) for k in ks])}
+    warm = run([(k, cold[k - 1][2]) for k in ks[1:]])
+    best = dict(cold)
+    for result in warm:
+        if result[3] < best[result[0]][3]:
+            best[result[0]] = result
+    return {k: (labels, centers, inertia, iterations) for k, (_, labels, centers, inertia, iterations) in sorted(best.items())}
+
+
+def stratified_sample(labels, size, rng):
+    """
+    Indices of a sample with as many members of every cluster as its share of the points (at least one per cluster)
+
+    :param labels: Cluster of every point
+    :param size: Number of points sampled
+    :param rng: Random generator
+    :return: Sorted indices
+    """
+    sample = []
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        take = min(len(members), max(1, round(size * len(members) / len(labels))))
+        sample.append(rng.choice(members, take, replace=False))
+    return np.sort(np.concatenate(sample))
+
+
+def silhouette_from_distances(distances, labels):
+    """
+    Mean silhouette score from a precomputed distance matrix, the same value as silhouette_score(metric="precomputed").
+    The distances of every point to every cluster come from a single product with the cluster indicator matrix
+
+    :param distances: Distances between every pair of points (m, m)
+    :param labels: Cluster of every point
+    :return: Score, NaN with fewer than 2 or as many clusters as points
+    """
+    clusters, labels = np.unique(labels, return_inverse=True)
+    if len(clusters) < 2 or len(clusters) >= len(labels):
+        return np.nan
+    indicator = np.zeros((len(labels), len(clusters)), dtype=distances.dtype)
+    indicator[np.arange(len(labels)), labels] = 1
+    sums = (distances @ indicator).astype(np.float64)
+    counts = np.bincount(labels, minlength=len(clusters))
+    own = counts[labels]
+    rows = np.arange(len(labels))
+
+    # Mean distance to the other members of the own cluster, and to the nearest other cluster
+    inner = sums[rows, labels] / np.maximum(own - 1, 1)
+    outer = sums / counts
+    outer[rows, labels] = np.inf
+    nearest = outer.min(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scores = (nearest - inner) / np.maximum(inner, nearest)
+    # A point alone in its cluster scores 0
+    scores[own == 1] = 0
+    return float(np.nan_to_num(scores).mean())
+
+
+def silhouette_scores(points, labelsByK, sampleSize=SILHOUETTE_SAMPLE, seed=0):
+    """
+    Silhouette score of every K, computed once per K on one distance matrix shared by every K: between every pair of
+    points up to sampleSize points, otherwise between the points of a sample stratified by the clusters of the largest K
+
+    :param points: Points (n, d)
+    :param labelsByK: Dictionary of K to the cluster of every point
+    :param sampleSize: Largest number of points scored
+    :param seed: Seed of the sample
+    :return: Dictionary of K to score (NaN when undefined, e.g. K = 1)
+    """
+    sample = np.arange(len(points))
+    if len(points) > sampleSize:
+        sample = stratified_sample(labelsByK[max(labelsByK)], sampleSize, np.random.default_rng(seed))
+    # Single precision halves the memory of the matrix, the scores are averages over many distances. The matrix is filled
+    # a block of rows at a time, so no float64 copy of it is ever held
+    sampled = points[sample]
+    distances = np.empty((len(sample), len(sample)), dtype=np.float32)
+    start = 0
+    for block in pairwise_distances_chunked(sampled):
+        distances[start:start + len(block)] = block
+        start += len(block)
+    return {k: silhouette_from_distances(distances, labels[sample]) for k, labels in labelsByK.items()}
+
+
+def output_path(inputPath):
+    """
+    Output file of an input file (<input>_kmeans.csv), or of a store or folder (<store>_kmeans.csv next to it)
+
+    :param inputPath: Coefficient file, store or folder
+    :return: Path of the output csv
+    """
+    if os.path.isdir(inputPath):
+        return os.path.normpath(inputPath) + "_kmeans.csv"
+    return inputPath.replace(".csv", "_kmeans.csv")
+
+
+def iter_chunks(inputPath, chunkRows=features.CHUNK_ROWS, points=PROFILE_POINTS):
+    """
+    Rows & features of an input a chunk at a time: the coefficients of a file, or the resampled altitude profiles of the
+    trajectories of a store or folder
+
+    :param inputPath: Coefficient file, store or folder
+    :param chunkRows: Rows (trajectories) per chunk
+    :param points: Points of every resampled profile
+    :return: Generator of (dataset rows, names, feature matrix)
+    """
+    if os.path.isdir(inputPath):
+        return features.iter_resampled(inputPath, points, chunkRows)
+    return features.iter_features(inputPath, chunkRows=chunkRows)
+
+
+def input_version(inputPath):
+    """
+    Size & modification time of an input, a checkpoint of another version of the input is not resumed
+
+    :param inputPath: Coefficient file, store or folder
+    :return: List of values
+    """
+    path = os.path.join(inputPath, trajstore.META) if trajstore.is_store(inputPath) else inputPath
+    info = os.stat(path)
+    return [os.path.abspath(inputPath), info.st_size, info.st_mtime_ns]
+
+
+def load_checkpoint(path, settings):
+    """
+    Reads a mini-batch checkpoint
+
+    :param path: Checkpoint file
+    :param settings: Settings of the run, the checkpoint is only used if it was written with the same ones
+    :return: Model, epoch & chunk to resume from, or None
+    """
+    if not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        checkpoint = pickle.load(f)
+    if checkpoint["settings"] != settings:
+        print(f"Ignoring checkpoint {path}, it was written with other settings or another version of the input")
+        return None
+    return checkpoint["model"], checkpoint["epoch"], checkpoint["chunk"]
+
+
+def save_checkpoint(path, model, settings, epoch, chunk):
+    """
+    Writes a mini-batch checkpoint, replaced in one step so a stopped run never leaves a partly written one
+
+    :param path: Checkpoint file
+    :param model: MiniBatchKMeans being fitted
+    :param settings: Settings of the run
+    :param epoch: Epoch to resume from
+    :param chunk: First chunk of that epoch not fitted yet
+    """
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump({"model": model, "settings": settings, "epoch": epoch, "chunk": chunk}, f)
+    os.replace(path + ".tmp", path)
+
+
+def fit_minibatch(chunks, clusters, epochs=1, seed=0, checkpointPath=None, settings=None, checkpointChunks=CHECKPOINT_CHUNKS):
+    """
+    Fits MiniBatchKMeans one chunk at a time, resuming from the checkpoint of an earlier run with the same settings
+
+    :param chunks: Function returning a new generator of (rows, names, features) chunks for every epoch
+    :param clusters: Number of clusters
+    :param epochs: Passes over the input
+    :param seed: Seed of the model
+    :param checkpointPath: Checkpoint file, None to run without checkpoints
+    :param settings: Settings of the run saved with the checkpoint
+    :param checkpointChunks: Chunks fitted between two checkpoints
+    :return: Fitted model
+    """
+    model = MiniBatchKMeans(n_clusters=clusters, random_state=seed, n_init=3)
+    startEpoch, startChunk = 0, 0
+    resumed = load_checkpoint(checkpointPath, settings) if checkpointPath else None
+    if resumed is not None:
+        model, startEpoch, startChunk = resumed
+        print(f"Resuming from {checkpointPath}: epoch {startEpoch + 1}, chunk {startChunk + 1}")
+
+    for epoch in range(startEpoch, epochs):
+        for idx, (_, _, X) in enumerate(instrument.iterate(chunks(), "read")):
+            # Chunks fitted before the checkpoint are read again but not fitted
+            if (epoch == startEpoch and idx < startChunk) or len(X) == 0:
+                continue
+            with instrument.stage("partial fit"):
+                model.partial_fit(X)
+            instrument.count("rows fitted", len(X))
+            if checkpointPath and (idx + 1) % checkpointChunks == 0:
+                with instrument.stage("checkpoint"):
+                    save_checkpoint(checkpointPath, model, settings, epoch, idx + 1)
+        if checkpointPath:
+            save_checkpoint(checkpointPath, model, settings, epoch + 1, 0)
+    return model
+
+
+def label_chunks(chunks, model, outputFile):
+    """
+    Labels every trajectory with the fitted model and appends the rows with their 'Cluster_ID' to the output a chunk at a
+    time
+
+    :param chunks: Generator of (rows, names, features) chunks
+    :param model: Fitted model
+    :param outputFile: Output csv
+    :return: Number of trajectories of every cluster & sum of the squared distances to the centroids
+    """
+    counts = np.zeros(model.n_clusters, dtype=np.int64)
+    inertia = 0.0
+    header = True
+    for dataset, _, X in instrument.iterate(chunks, "read"):
+        if len(X) == 0:
+            continue
+        with instrument.stage("predict"):
+            labels = model.predict(X)
+            inertia += ((X - model.cluster_centers_[labels]) ** 2).sum()
+        counts += np.bincount(labels, minlength=model.n_clusters)
+        with instrument.stage("write"):
+            dataset.assign(Cluster_ID=labels).to_csv(outputFile, index=False, header=header, mode='w' if header else 'a')
+        header = False
+    return counts, inertia
+
+
+if __name__ == '__main__':
+    #parsing of arguments
+    parser = argparse.ArgumentParser(description="K-means clustering of the trajectories of a coefficient file, with an elbow and silhouette sweep")
+    parser.add_argument('-cc', metavar="CLUSTERS", type=int, required=True, help="Number of clusters")
+    parser.add_argument('input', metavar="INPUT", help="Coefficient file (e.g. polycoef-<time>.csv), or with -minibatch a trajectory store or folder of out*.csv files")
+    parser.add_argument('-kmax', metavar="CLUSTERS", type=int, default=MAX_CLUSTERS, help="Largest number of clusters of the elbow and silhouette graphs, every K > 1 is fitted twice (k-means++ and warm started)")
+    parser.add_argument('-sample', metavar="TRAJECTORIES", type=int, default=SILHOUETTE_SAMPLE, help="Score the silhouette on a stratified sample of this many trajectories beyond it")
+    parser.add_argument('-seed', metavar="SEED", type=int, default=0, help="Seed of the initial centers")
+    parser.add_argument('-j', '--workers', metavar="WORKERS", type=int, default=1, help="Number of worker processes of the sweep, 0 uses every core")
+    parser.add_argument('-minibatch', action="store_true", help="Stream the input in chunks through MiniBatchKMeans instead of loading it whole")
+    parser.add_argument('-chunk', metavar="ROWS", type=int, default=features.CHUNK_ROWS, help="With -minibatch, trajectories read at a time")
+    parser.add_argument('-epochs', metavar="EPOCHS", type=int, default=1, help="With -minibatch, passes over the input before labelling")
+    parser.add_argument('-points', metavar="POINTS", type=int, default=PROFILE_POINTS, help="With -minibatch and a store or folder input, points of every resampled altitude profile")
+    parser.add_argument('-checkpoint', metavar="FILE", help="With -minibatch, checkpoint file (default: <output>.checkpoint)")
+    parser.add_argument('-checkpoint-every', metavar="CHUNKS", type=int, default=CHECKPOINT_CHUNKS, help="With -minibatch, chunks fitted between two checkpoints")
+    instrument.add_arguments(parser)
+    args = vars(parser.parse_args())
+    instrument.start(args['profile'], args['profile_calls'])
+
+    if os.path.exists(args['input']) == False:
+        print("Given dataset file does not exists")
+        raise SystemExit(0)
+
+    cc = args['cc']
+    workers = args['workers'] if args['workers'] > 0 else os.cpu_count()
+
+    inputFile = args['input'] #getting input file
+    outputFile = output_path(inputFile) #renaming input file to output file
+
+    if args['minibatch']:
+        chunkRows = max(args['chunk'], cc)
+        checkpointPath = args['checkpoint'] or os.path.splitext(outputFile)[0] + ".checkpoint"
+        # More epochs continue from the checkpoint, any other change starts over
+        settings = {"input": input_version(inputFile), "clusters": cc, "chunk": chunkRows, "points": args['points'], "seed": args['seed']}
+
+        #fitting pass(es), then a labelling pass over the same chunks
+        model = fit_minibatch(lambda: iter_chunks(inputFile, chunkRows, args['points']), cc, max(1, args['epochs']), args['seed'],
+                              checkpointPath, settings, max(1, args['checkpoint_every']))
+        counts, inertia = label_chunks(iter_chunks(inputFile, chunkRows, args['points']), model, outputFile)
+        instrument.count("trajectories", int(counts.sum()))
+
+        for i in range(0,cc):
+            print(str(i)+" : "+str(counts[i])+" trajectories")
+        print(f"Inertia: {inertia:.6g}, labels written to {outputFile}")
+    elif os.path.isdir(inputFile):
+        print("A trajectory store or folder is clustered with -minibatch")
+    else:
+        #dataset reading, the coefficients are loaded as a float matrix (from the .npz saved next to the csv when there is one)
+        with instrument.stage("load"):
+            dataset, trajectory, points = features.load_features(inputFile)
+        instrument.count("trajectories", len(points))
+
+        #elbow sweep
+        with instrument.stage("sweep"):
+            models = sweep(points, args['kmax'], workers, args['seed'])
+        instrument.count("fits", len(models))
+        print("Iterations per K: " + ", ".join(f"{k}: {iterations}" for k, (_, _, _, iterations) in models.items()))
+
+        kmeans = KMeans(n_clusters=cc, init='k-means++', random_state=args['seed']) #kmeans clustering object
+        with instrument.stage("kmeans"):
+            labels = kmeans.fit_predict(points) #start kmeans training
+        dataset['Cluster_ID'] = pd.Series(labels, index=dataset.index)
+        with instrument.stage("write"):
+            dataset.to_csv(outputFile,index=False)
+
+        for i in range(0,cc):
+            output = dataset.loc[dataset['Cluster_ID'] == i, 'Trajectories']
+            print(str(i)+" : "+str(', '.join(output.tolist()))+"\n")
+
+        #silhouette score of every K
+        with instrument.stage("silhouette"):
+            scores = silhouette_scores(points, {k: model[0] for k, model in models.items()}, args['sample'], args['seed'])
+        scored = {k: score for k, score in scores.items() if np.isfinite(score)}
+        if scored:
+            best = max(scored, key=scored.get)
+            print(f"Highest silhouette score: {scored[best]:.3f} with {best} clusters")
+
+        cluster_num = list(models)
+        inertias = [models[k][2] for k in cluster_num]
+
+        fig, axs = plt.subplots(1,2)
+        axs[0].barh(list(scored), list(scored.values()), color='maroon')
+
+        axs[0].set_xlabel("Silhouette Score") #plot silhoutte graph
+        axs[0].set_ylabel("Number of Clusters")
+        axs[0].set_title("KMEANS Silhouette Score Graph")
+
+
+        axs[1].plot(cluster_num, inertias, 'bx-')
+        axs[1].set_xlabel('Cluster Number')
+        axs[1].set_ylabel('Inertia')
+        axs[1].set_title('Kmeans Elbow Graph')
+        plt.show()
@@ -0,0 +1,118 @@
+import os
+import json
+import hashlib
+import trajstore
+
+# ------------------------------------------------------------------------------------------------------------
+# Manifest of the files pre-processed by flightprocess.py, kept as manifest.json in the output directory
+#
+# Every input file has an entry with its content hash, the parameters used to process it (runway/starting
+# point coordinates, runway altitude, distance engine) and where its output was written. A file whose hash and
+# parameters are unchanged and whose output still exists (its trajectory is still in the store for -format store) does
+# not need to be processed again.
+# ------------------------------------------------------------------------------------------------------------
+
+MANIFEST_NAME = "manifest.json"
+
+
+def file_digest(path, blockSize=1 << 20):
+    """
+    SHA-256 hash of a file's content, read in blocks so large recordings are never fully loaded
+
+    :param path: File path
+    :param blockSize: Number of bytes read at a time
+    :return: Hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(blockSize), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    Input file entries of an output directory, loaded from and saved to manifest.json
+    """
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self.entries = {}
+        # Trajectory names of the stores checked by is_current, read once per store
+        self.storeNames = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f).get("files", {})
+
+    @staticmethod
+    def key(path):
+        return os.path.abspath(path)
+
+    def digest(self, path):
+        """
+        Content hash of an input file. The stored hash is reused when the file size and modification time have not
+        changed since it was recorded, so unchanged files are not read again
+
+        :param path: Input file path
+        :return: Hex digest
+        """
+        stat = os.stat(path)
+        entry = self.entries.get(self.key(path))
+        if entry is not None and entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime_ns:
+            return entry["hash"]
+        return file_digest(path)
+
+    def is_current(self, path, digest, params):
+        """
+        Checks if an input file was already processed with the same content and parameters
+
+        :param path: Input file path
+        :param digest: Current content hash of the file
+        :param params: Parameters the file would be processed with
+        :return: True if the recorded output can be reused
+        """
+        entry = self.entries.get(self.key(path))
+        if entry is None or entry["hash"] != digest or entry["params"] != params:
+            return False
+        if "trajectory" in entry:
+            return entry["trajectory"] in self.store_names(entry["output"])
+        return os.path.exists(entry["output"])
+
+    def store_names(self, storePath):
+        """
+        Trajectory names of a store, empty if it does not exist
+
+        :param storePath: Store path
+        :return: Set of names
+        """
+        if storePath not in self.storeNames:
+            self.storeNames[storePath] = set(trajstore.TrajectoryStore(storePath).names) if trajstore.is_store(storePath) else set()
+        return self.storeNames[storePath]
+
+    def is_recorded(self, path):
+        return self.key(path) in self.entries
+
+    def record(self, path, digest, params, output, **extra):
+        """
+        Records an input file after it was processed
+
+        :param path: Input file path
+        :param digest: Content hash of the file
+        :param params: Parameters it was processed with
+        :param output: Path of the output written for it, stored as an absolute path like the keys so the entry does not
+                       depend on the directory the run was started from
+        :param extra: Additional values stored with the entry
+        """
+        stat = os.stat(path)
+        entry = {"hash": digest, "size": stat.st_size, "mtime": stat.st_mtime_ns, "params": params, "output": os.path.abspath(output)}
+        entry.update(extra)
+        self.entries[self.key(path)] = entry
+
+    def save(self):
+        """
+        Writes manifest.json, through a temporary file so an interrupted run never leaves a truncated manifest
+        """
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, "w") as f:
+            json.dump({"files": self.entries}, f, indent=2, sort_keys=True)
+        os.replace(tmpPath, self.path)
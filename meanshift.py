@@ -1,52 +1,134 @@
 import pandas as pd
 import numpy as np
-from sklearn.cluster import MeanShift
-import sys
+import features
+import instrument
+from sklearn.cluster import MeanShift, estimate_bandwidth
+import argparse
+import json
 import os
 
-#parsing of arguments
+# ------------------------------------------------------------------------------------------------------------
+# MeanShift clustering of the trajectories of a coefficient file (polycoef.py, sigmoid.py ...), writes <input>_meanshift.csv
+#           python3 meanshift.py ./output/polycoef-20260101-120000.csv
+# --------------------------------------------------------------------------------------------------------------
+# The bandwidth is estimated from the distance of every trajectory to its nearest -quantile of the trajectories, which is
+# quadratic in the number of trajectories; -sample estimates it on that many trajectories drawn at random instead. The
+# estimate is saved next to the input (<input>_meanshift-bandwidth.json) and reused by the next runs on the same file
+# with the same -quantile, -sample and -seed, -bandwidth skips the estimate altogether
+#           python3 meanshift.py ./output/polycoef-20260101-120000.csv -sample 10000
+# --------------------------------------------------------------------------------------------------------------
+# Every trajectory is a seed of the mean shift unless -bin-seeding starts from the centers of a grid of bandwidth sized
+# bins instead (bins of fewer than -min-bin-freq trajectories are left out), and -j spreads the seeds across processes.
+# Together they make files of 100,000+ trajectories practical
+#           python3 meanshift.py ./output/polycoef-20260101-120000.csv -sample 10000 -bin-seeding -j 0
+# --------------------------------------------------------------------------------------------------------------
 
-if len(sys.argv) != 2:
-    print("please use below command to execute code")
-    print("python meanshift.py input_dataset_file")
-    sys.exit(0)
+# Share of the trajectories whose distance gives the bandwidth (default of sklearn's estimate_bandwidth)
+QUANTILE = 0.3
 
-if os.path.exists(sys.argv[1]) == False:
-    print("Given dataset file does not exists")
-    sys.exit(0)
 
-inputFile = sys.argv[1] #getting input file
-outputFile = inputFile.replace(".csv","_meanshift.csv") #renaming input file to output file
+def bandwidth_path(inputFile):
+    """
+    File of the bandwidth estimates of an input, saved next to it
 
-trajectory = []
-points = []
-dataset = pd.read_csv(inputFile) #dataset reading
-df = dataset.values
-for i in range(len(df)):
-    t = df[i,0] #extracting trajectory
-    p = df[i,1] #extracting points
-    arr = p.split(",")
-    temp = []
-    for j in range(len(arr)): #converting points in string to float
-        temp.append(float(arr[j].strip()))
-    points.append(temp)
-    trajectory.append(t)
+    :param inputFile: Coefficient file
+    :return: Path of the JSON file
+    """
+    return os.path.splitext(inputFile)[0] + "_meanshift-bandwidth.json"
 
-points = np.asarray(points)
-trajectory = np.asarray(trajectory)
 
-mean_shift = MeanShift() #meahshift clustering object
-mean_shift.fit_predict(points) #start meanshift training
-centers = mean_shift.cluster_centers_ #get centers
-dataset['Cluster_ID'] = pd.Series(mean_shift.labels_, index=dataset.index)
-dataset.to_csv(outputFile,index=False)
-print("\nMeanShift Clustering Output\n")
-for i in range(0,len(centers)):
-    output = dataset.loc[dataset['Cluster_ID'] == i, 'Trajectories']
-    print(str(i)+" : "+str(', '.join(output.tolist()))+"\n")
-        
+def cached_bandwidth(inputFile, points, quantile=QUANTILE, sample=None, seed=0, workers=1):
+    """
+    Bandwidth of the input, estimated once per version of the file and settings and then read from bandwidth_path
 
+    :param inputFile: Coefficient file
+    :param points: Coefficients of the trajectories (n, d)
+    :param quantile: Share of the trajectories whose distance gives the bandwidth
+    :param sample: Number of trajectories the bandwidth is estimated on, None for every trajectory
+    :param seed: Seed of the sample
+    :param workers: Number of parallel jobs of the neighbor searches
+    :return: Bandwidth
+    :raises ValueError: When the sample and quantile give fewer than 2 neighbors or the estimate is not positive
+    """
+    info = os.stat(inputFile)
+    sample = None if sample is None or sample >= len(points) else sample
+    key = {"size": info.st_size, "mtime": info.st_mtime_ns, "quantile": quantile, "sample": sample,
+           "seed": seed if sample else None}
+    path = bandwidth_path(inputFile)
+    estimates = []
+    if os.path.isfile(path):
+        try:
+            with open(path) as f:
+                estimates = json.load(f)
+        except (OSError, ValueError):
+            estimates = []
+        # Estimates of an older version of the file are dropped
+        estimates = [entry for entry in estimates if entry.get("size") == key["size"] and entry.get("mtime") == key["mtime"]]
+        for entry in estimates:
+            if all(entry.get(name) == value for name, value in key.items()):
+                instrument.count("bandwidth cache hits")
+                return entry["bandwidth"]
 
+    # With fewer than 2 neighbors every trajectory is only compared with itself and the bandwidth is 0
+    if (sample or len(points)) * quantile < 2:
+        raise ValueError(f"-sample * -quantile must give at least 2 neighbors ({sample or len(points)} trajectories * {quantile})")
+    with instrument.stage("bandwidth"):
+        bandwidth = float(estimate_bandwidth(points, quantile=quantile, n_samples=sample, random_state=seed, n_jobs=workers))
+    # Not saved, a later run would fail the same way without estimating again
+    if not bandwidth > 0:
+        raise ValueError(f"The estimated bandwidth is {bandwidth}, increase -sample or -quantile or give -bandwidth")
+    estimates.append(dict(key, bandwidth=bandwidth))
+    with open(path + ".tmp", "w") as f:
+        json.dump(estimates, f, indent=2)
+    os.replace(path + ".tmp", path)
+    return bandwidth
 
 
+if __name__ == '__main__':
+    #parsing of arguments
+    parser = argparse.ArgumentParser(description="MeanShift clustering of the trajectories of a coefficient file")
+    parser.add_argument('input', metavar="INPUT", help="Coefficient file (e.g. polycoef-<time>.csv)")
+    parser.add_argument('-bandwidth', metavar="BANDWIDTH", type=float, help="Kernel bandwidth (default: estimated, see -quantile & -sample)")
+    parser.add_argument('-quantile', metavar="SHARE", type=float, default=QUANTILE, help="Share of the trajectories whose distance gives the bandwidth")
+    parser.add_argument('-sample', metavar="TRAJECTORIES", type=int, help="Estimate the bandwidth on this many trajectories drawn at random (default: every trajectory)")
+    parser.add_argument('-seed', metavar="SEED", type=int, default=0, help="Seed of the bandwidth sample")
+    parser.add_argument('-bin-seeding', action="store_true", help="Seed the mean shift from a grid of bins instead of every trajectory")
+    parser.add_argument('-min-bin-freq', metavar="TRAJECTORIES", type=int, default=1, help="With -bin-seeding, smallest number of trajectories of a seeded bin")
+    parser.add_argument('-j', '--workers', metavar="WORKERS", type=int, default=1, help="Number of parallel jobs, 0 uses every core")
+    instrument.add_arguments(parser)
+    args = vars(parser.parse_args())
+    instrument.start(args['profile'], args['profile_calls'])
+    workers = args['workers'] if args['workers'] > 0 else os.cpu_count()
 
+    if os.path.exists(args['input']) == False:
+        print("Given dataset file does not exists")
+        raise SystemExit(0)
+
+    inputFile = args['input'] #getting input file
+    outputFile = inputFile.replace(".csv","_meanshift.csv") #renaming input file to output file
+
+    #dataset reading, the coefficients are loaded as a float matrix (from the .npz saved next to the csv when there is one)
+    with instrument.stage("load"):
+        dataset, trajectory, points = features.load_features(inputFile)
+    instrument.count("trajectories", len(points))
+
+    bandwidth = args['bandwidth']
+    if bandwidth is None:
+        try:
+            bandwidth = cached_bandwidth(inputFile, points, args['quantile'], args['sample'], args['seed'], workers)
+        except ValueError as e:
+            parser.error(str(e))
+    elif bandwidth <= 0:
+        parser.error("-bandwidth must be positive")
+
+    mean_shift = MeanShift(bandwidth=bandwidth, bin_seeding=args['bin_seeding'], min_bin_freq=args['min_bin_freq'], n_jobs=workers) #meahshift clustering object
+    with instrument.stage("meanshift"):
+        mean_shift.fit_predict(points) #start meanshift training
+    centers = mean_shift.cluster_centers_ #get centers
+    dataset['Cluster_ID'] = pd.Series(mean_shift.labels_, index=dataset.index)
+    with instrument.stage("write"):
+        dataset.to_csv(outputFile,index=False)
+    print("\nMeanShift Clustering Output\n")
+    for i in range(0,len(centers)):
+        output = dataset.loc[dataset['Cluster_ID'] == i, 'Trajectories']
+        print(str(i)+" : "+str(', '.join(output.tolist()))+"\n")
@@ -0,0 +1,360 @@
+import os
+import argparse
+import trajstore
+import features
+import instrument
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from datetime import datetime
+from polycoef import calculate_mean_msr
+
+# ------------------------------------------------------------------------------------------------------------
+# Accept a input directory. If output directory is not passed output will be saved in input directory
+#           python3 piecewise.py -in ./input
+# -------------------------------------------------------------------------------------------------------------
+# Accept a input & output directory. Output directory will be created if it doesn't exist
+#           python3 piecewise.py -in ./input -out ./output
+# --------------------------------------------------------------------------------------------------------------
+# The input can also be a trajectory store written by flightprocess.py -format store
+#           python3 piecewise.py -in ./output/trajectories -out ./output -j 8
+# --------------------------------------------------------------------------------------------------------------
+# Every trajectory is fitted with straight segments (glide slopes). A segment grows sample by sample until the RMS of
+# its residuals exceeds -tolerance feet, then a knot is placed and the next segment starts. Only running sums are kept
+# per segment, so new samples update the fit without refitting (see PiecewiseLinear) and -chunk feeds every trajectory
+# a number of rows at a time, like samples arriving from flightprocess.py -listen. The knots are the same, the
+# coefficients are equal up to rounding (the running sums are added in a different order):
+#           python3 piecewise.py -in ./output/trajectories -out ./output -tolerance 20 -segments 6 -chunk 100
+# --------------------------------------------------------------------------------------------------------------
+# Writes piecewise-<time>.csv in the layout of polycoef.py: for every segment its coefficients ('Segment=1 x^1' is the
+# glide slope in ft/nmi, 'Segment=1 x^0' the intercept), where it starts & ends ('Segment=1 Start', 'Segment=1 End',
+# distance in nmi) and its MSR. Trajectories with fewer segments have empty cells for the others. The matrix is also
+# saved as piecewise-<time>.npz (see features.py)
+# --------------------------------------------------------------------------------------------------------------
+# Time the reading, fitting and writing stages and write a JSON report (see instrument.py)
+#           python3 piecewise.py -in ./output/trajectories -out ./output --profile
+# --------------------------------------------------------------------------------------------------------------
+
+# RMS of the residuals (ft) above which a segment is ended
+TOLERANCE = 30.0
+
+# Largest number of segments of a trajectory, the two neighbouring segments that fit best together are merged beyond it
+MAX_SEGMENTS = 8
+
+# Number of trajectories read by a worker at a time
+BATCH_SIZE = 1000
+
+# Samples looked ahead of the open segment at first, doubled while the segment keeps fitting
+WINDOW = 64
+
+# Values of every segment, the first two are its coefficients highest power first like np.polyfit
+SEGMENT_VALUES = ["x^1", "x^0", "Start", "End"]
+
+
+def segment_columns(maxSegments=MAX_SEGMENTS):
+    """
+    Names of the value columns of every segment (e.g. 'Segment=2 x^1')
+
+    :param maxSegments: Number of segments
+    :return: List of the column names
+    """
+    return [f"Segment={segment} {value}" for segment in range(1, maxSegments + 1) for value in SEGMENT_VALUES]
+
+
+def generate_csv(maxSegments=MAX_SEGMENTS):
+    """
+    Creates a Dataframe with all the column names, the values of every segment followed by its MSR
+
+    :param maxSegments: Number of segments
+    :return: Returns a dataframe with all the necessary column names
+    """
+    columns = ["Trajectories"]
+    for segment in range(1, maxSegments + 1):
+        columns += [f"Segment={segment} {value}" for value in SEGMENT_VALUES]
+        columns.append("MSR")
+    return pd.DataFrame(columns=columns)
+
+
+def segment_ssr(stats):
+    """
+    Sum of squared residuals of the least squares line of segments given their running sums
+
+    :param stats: Array of shape (..., 6) holding n, sum x, sum y, sum x^2, sum xy, sum y^2
+    :return: SSR of every segment
+    """
+    n = np.maximum(stats[..., 0], 1)
+    cxx = stats[..., 3] - stats[..., 1] ** 2 / n
+    cxy = stats[..., 4] - stats[..., 1] * stats[..., 2] / n
+    cyy = stats[..., 5] - stats[..., 2] ** 2 / n
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ssr = np.where(cxx > 0, cyy - cxy * cxy / np.where(cxx > 0, cxx, 1), cyy)
+    return np.maximum(ssr, 0)
+
+
+class PiecewiseLinear:
+    """
+    Piecewise linear fit of a trajectory that grows as samples arrive.
+    Every segment is held as the running sums of its samples (n, x, y, x^2, xy, y^2, relative to the first sample), so its
+    least squares line and SSR are known in closed form at any time. A chunk of new samples is added with cumulative sums:
+    the SSR the open segment would have after each of the next samples is computed at once (over a window that doubles
+    while the segment keeps fitting, so a segment costs about its own length), and the first sample that takes its RMS
+    above the tolerance starts a new segment. Ended segments are never refitted; beyond maxSegments the neighbouring pair
+    whose merged SSR grows the least is merged by adding their sums. The knots only depend on the samples, not on how
+    they were split into chunks; the coefficients and SSR are equal up to rounding, since the sums are added in another
+    order.
+    """
+
+    def __init__(self, tolerance=TOLERANCE, maxSegments=MAX_SEGMENTS):
+        self.tolerance = tolerance
+        self.maxSegments = maxSegments
+        self.origin = None
+        # Ended segments, each [sums, start, end]
+        self.segments = []
+        self.open = None
+
+    def extend(self, x, y):
+        """
+        Adds samples to the fit
+
+        :param x: Distance From Start (nmi) of the new samples
+        :param y: Alt - Ground Level of the new samples
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        keep = np.isfinite(x) & np.isfinite(y)
+        x, y = x[keep], y[keep]
+        if not len(x):
+            return
+        if self.origin is None:
+            self.origin = (x[0], y[0])
+
+        dx = x - self.origin[0]
+        dy = y - self.origin[1]
+        cumulative = np.zeros((len(x) + 1, 6))
+        np.cumsum(np.column_stack([np.ones(len(x)), dx, dy, dx * dx, dx * dy, dy * dy]), axis=0, out=cumulative[1:])
+        limit = self.tolerance ** 2
+
+        first = 0
+        window = WINDOW
+        while first < len(x):
+            base = self.open[0] if self.open is not None else np.zeros(6)
+            # Sums of the open segment after each of the next samples
+            stop = min(first + window, len(x))
+            stats = base + cumulative[first + 1:stop + 1] - cumulative[first]
+            exceeded = np.flatnonzero(segment_ssr(stats) > limit * stats[:, 0])
+            if not len(exceeded):
+                start = self.open[1] if self.open is not None else x[first]
+                self.open = [stats[-1], start, x[stop - 1]]
+                first = stop
+                window *= 2
+                continue
+
+            # Sample first + exceeded[0] does not fit the open segment, it ends on the sample before
+            broken = first + exceeded[0]
+            if broken > first:
+                start = self.open[1] if self.open is not None else x[first]
+                self.segments.append([stats[exceeded[0] - 1], start, x[broken - 1]])
+            else:
+                self.segments.append(self.open)
+            self.open = None
+            self.merge()
+            first = broken
+            window = WINDOW
+
+    def merge(self):
+        """
+        Merges ended segments until there are at most maxSegments with the open one
+        """
+        while len(self.segments) > self.maxSegments - 1:
+            sums = np.array([segment[0] for segment in self.segments])
+            ssr = segment_ssr(sums)
+            increase = segment_ssr(sums[:-1] + sums[1:]) - ssr[:-1] - ssr[1:]
+            idx = int(np.argmin(increase))
+            left, right = self.segments[idx], self.segments.pop(idx + 1)
+            self.segments[idx] = [left[0] + right[0], left[1], right[2]]
+
+    def result(self):
+        """
+        Segments fitted so far, the open one last
+
+        :return: List of (coefficients [slope, intercept] in ft/nmi & ft, SSR, number of samples, start, end) per segment
+        """
+        result = []
+        for sums, start, end in self.segments + ([self.open] if self.open is not None else []):
+            n, sx, sy, sxx, sxy, _ = sums
+            cxx = sxx - sx * sx / n
+            slope = (sxy - sx * sy / n) / cxx if cxx > 0 else 0.0
+            # Back from coordinates relative to the first sample
+            intercept = self.origin[1] + (sy - slope * sx) / n - slope * self.origin[0]
+            result.append((np.array([slope, intercept]), float(segment_ssr(sums)), int(n), start, end))
+        return result
+
+
+def fit_trajectory(x, y, tolerance=TOLERANCE, maxSegments=MAX_SEGMENTS, chunkRows=None):
+    """
+    Piecewise linear fit of a whole trajectory
+
+    :param x: Distance From Start (nmi)
+    :param y: Alt - Ground Level
+    :param tolerance: RMS of the residuals (ft) above which a segment is ended
+    :param maxSegments: Largest number of segments
+    :param chunkRows: Feeds the samples this many at a time (all at once if None)
+    :return: Segments, see PiecewiseLinear.result
+    """
+    fit = PiecewiseLinear(tolerance, maxSegments)
+    chunkRows = chunkRows or max(len(x), 1)
+    for start in range(0, len(x), chunkRows):
+        fit.extend(x[start:start + chunkRows], y[start:start + chunkRows])
+    return fit.result()
+
+
+def calculate_segments(segments, maxSegments=MAX_SEGMENTS):
+    """
+    Values & MSR of every segment of a trajectory, padded with NaN up to maxSegments
+
+    :param segments: Segments, see PiecewiseLinear.result
+    :param maxSegments: Number of segments written
+    :return: Array of the segment values (see segment_columns) & array of the MSR per segment
+    """
+    values = np.full((maxSegments, len(SEGMENT_VALUES)), np.nan)
+    msr = np.full(maxSegments, np.nan)
+    for idx, (coefficients, ssr, n, start, end) in enumerate(segments):
+        values[idx] = [coefficients[0], coefficients[1], start, end]
+        # Same rounding as polycoef.py
+        msr[idx] = round(ssr / n, 2)
+    return values.ravel(), msr
+
+
+def fit_range(inputDirectory, start, stop, tolerance=TOLERANCE, maxSegments=MAX_SEGMENTS, chunkRows=None):
+    """
+    Fits the trajectories start to stop - 1 of a folder or store, run by each worker process
+
+    :param inputDirectory: Folder of out*.csv files or trajectory store
+    :param start: Index of the first trajectory
+    :param stop: Index after the last trajectory
+    :param tolerance: RMS of the residuals (ft) above which a segment is ended
+    :param maxSegments: Largest number of segments
+    :param chunkRows: Feeds every trajectory this many rows at a time
+    :return: Names, segment values & MSR of the trajectories in order
+    """
+    names = []
+    values = []
+    msr = []
+    for name, data in instrument.iterate(trajstore.iter_trajectories(inputDirectory, start, stop), "read"):
+        with instrument.stage("segments"):
+            segments = fit_trajectory(np.asarray(data["Distance From Start (nmi)"]), np.asarray(data["Alt - Ground Level"]),
+                                      tolerance, maxSegments, chunkRows)
+            segmentValues, segmentMsr = calculate_segments(segments, maxSegments)
+        names.append(name)
+        values.append(segmentValues)
+        msr.append(segmentMsr)
+    instrument.count("fits", len(names))
+    return names, values, msr
+
+
+def fit_directory(inputDirectory, workers=1, tolerance=TOLERANCE, maxSegments=MAX_SEGMENTS, chunkRows=None):
+    """
+    Fits every trajectory of a folder or store, in a pool of worker processes when workers > 1
+
+    :param inputDirectory: Folder of out*.csv files or trajectory store
+    :param workers: Number of worker processes
+    :param tolerance: RMS of the residuals (ft) above which a segment is ended
+    :param maxSegments: Largest number of segments
+    :param chunkRows: Feeds every trajectory this many rows at a time
+    :return: Names (n,), segment values (n, 4 * maxSegments, see segment_columns) & MSR (n, maxSegments)
+    """
+    count = trajstore.count_trajectories(inputDirectory)
+    names = np.empty(count, dtype=object)
+    values = np.empty((count, len(SEGMENT_VALUES) * maxSegments))
+    msr = np.empty((count, maxSegments))
+
+    for start, (rangeNames, rangeValues, rangeMsr) in trajstore.map_trajectories(inputDirectory, fit_range, workers, BATCH_SIZE,
+                                                                                 tolerance, maxSegments, chunkRows):
+        stop = start + len(rangeNames)
+        names[start:stop] = rangeNames
+        values[start:stop] = rangeValues
+        msr[start:stop] = rangeMsr
+    return names, values, msr
+
+
+def build_dataframe(names, values, msr):
+    """
+    Builds the final Dataframe from the fitted arrays in one go & appends the Mean-MSR row
+
+    :param names: Names of the trajectories
+    :param values: Segment values of every trajectory
+    :param msr: MSR of every segment of every trajectory
+    :return: Final Dataframe
+    """
+    maxSegments = msr.shape[1]
+    columns = generate_csv(maxSegments).columns
+    valueIndex = {column: idx for idx, column in enumerate(segment_columns(maxSegments))}
+    columnData = {0: names}
+    segment = 0
+    for position, column in enumerate(columns[1:], start=1):
+        if column == "MSR":
+            columnData[position] = msr[:, segment]
+            segment += 1
+        else:
+            columnData[position] = values[:, valueIndex[column]]
+    dataframe = pd.DataFrame(columnData, index=range(1, len(names) + 1))
+    dataframe.columns = columns
+
+    # Calculates the MEAN of MSR of every segment
+    calculate_mean_msr(dataframe, len(names) + 1)
+    return dataframe
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-in', metavar="INPUT", help='input file/directory')
+    parser.add_argument('-out', metavar="OUTPUT", help='output directory')
+    parser.add_argument('-j', '--workers', metavar="WORKERS", type=int, default=1, help="Number of worker processes fitting trajectories, 0 uses every core")
+    parser.add_argument('-tolerance', metavar="FEET", type=float, default=TOLERANCE, help="RMS of the residuals (ft) above which a segment is ended")
+    parser.add_argument('-segments', metavar="SEGMENTS", type=int, default=MAX_SEGMENTS, help="Largest number of segments per trajectory")
+    parser.add_argument('-chunk', metavar="ROWS", type=int, help="Feed every trajectory to the fit this many rows at a time")
+    instrument.add_arguments(parser)
+
+    args = vars(parser.parse_args())
+    instrument.start(args['profile'], args['profile_calls'])
+
+    # Raises an Exception if input path is not specified
+    if not args["in"]:
+        raise Exception("Please pass input directory")
+    else:
+        inputDirectory = args['in']
+
+    # If output path is not specified final csv will be saved in the input path
+    if not args["out"]:
+        outputDirectory = inputDirectory
+    else:
+        outputDirectory = args["out"]
+
+    # Number of worker processes
+    workers = args['workers'] if args['workers'] > 0 else os.cpu_count()
+
+    # Fits every out*.csv file of the folder, or every trajectory of a store written by flightprocess.py -format store
+    with instrument.stage("fit"):
+        names, values, msr = fit_directory(inputDirectory, workers, args['tolerance'], max(1, args['segments']), args['chunk'])
+    print(f"Segments per trajectory: {np.isfinite(msr).sum(axis=1).mean():.2f}")
+
+    # Final Dataframe with every trajectory & the MEAN of MSR
+    dataframe = build_dataframe(names, values, msr)
+
+    # Retrieve Current time
+    currentTime = datetime.now()
+    currentTime = currentTime.strftime("%Y%m%d-%H%M%S")
+
+    # Creates file Path
+    filePath = Path(outputDirectory + f"/piecewise-{currentTime}.csv")
+
+    # Creates Directory if output path does not exist
+    filePath.parent.mkdir(parents=True, exist_ok=True)
+
+    # Saves the csv to output directory
+    with instrument.stage("write"):
+        dataframe.to_csv(filePath, index=False)
+
+        # Saves the segment matrix next to it, loaded directly by the clustering scripts
+        features.save_features(filePath, names, values, segment_columns(msr.shape[1]))
@@ -1,9 +1,15 @@
 import os
 import random
 import argparse
+import trajstore
+import features
+import fitcache
+import instrument
 import numpy as np
 import pandas as pd
 from pathlib import Path
+from functools import partial
+from scipy.linalg import solve_triangular
 from datetime import datetime
 from matplotlib import pyplot as plt
 
@@ -14,30 +20,304 @@ from matplotlib import pyplot as plt
 # Accept a input & output directory. Output directory will be created if it doesn't exist
 #           python3 polycoef.py -in ./input -out ./output
 # --------------------------------------------------------------------------------------------------------------
+# The input can also be a trajectory store written by flightprocess.py -format store
+#           python3 polycoef.py -in ./output/trajectories -out ./output
+# --------------------------------------------------------------------------------------------------------------
+# Fit the trajectories in a pool of worker processes (-j 0 uses every core)
+#           python3 polycoef.py -in ./output/trajectories -out ./output -j 8
+# --------------------------------------------------------------------------------------------------------------
+# Choose one degree per trajectory by leave-one-out (or k-fold) cross-validation, computed in closed form from the fit.
+# Higher degrees are only tried while the validation error keeps improving. Writes polycoef-loo-<time>.csv holding the
+# degree, CV MSR, MSR & the selected coefficients padded to degree 9 ('Selected x^9' ... 'Selected x^0')
+#           python3 polycoef.py -in ./input -out ./output -select loo
+#           python3 polycoef.py -in ./input -out ./output -select kfold -folds 10 -patience 2
+# --------------------------------------------------------------------------------------------------------------
+# Keep the results in a cache (fitcache.sqlite in the output directory, or the given file) so trajectories that did not
+# change since a previous run with the same settings are not fitted again. -cache-size sets its size limit in MB
+#           python3 polycoef.py -in ./output/trajectories -out ./output -cache
+#           python3 polycoef.py -in ./input -out ./output -cache ~/fits.sqlite -cache-size 100
+# --------------------------------------------------------------------------------------------------------------
+# Time the reading, fitting and writing stages and write a JSON report (see instrument.py)
+#           python3 polycoef.py -in ./output/trajectories -out ./output --profile
+# --------------------------------------------------------------------------------------------------------------
+# Every coefficient is written as its own float column ('Degree=3 x^2' ...) and the coefficient matrix is also saved
+# next to the csv as polycoef-<time>.npz (see features.py), which kmeans.py, meanshift.py, som.py and hcout.py load
+# --------------------------------------------------------------------------------------------------------------
+
+# Highest degree fitted, every degree from 1 to MAX_DEGREE is written to the output
+MAX_DEGREE = 9
+
+# Number of trajectories fitted together, trajectories of a batch that share the same x values are solved at once
+BATCH_SIZE = 1000
+
+
+def coefficient_columns():
+    """
+    Names of the coefficient columns, highest power first for every degree like np.polyfit (e.g. 'Degree=2 x^2')
+
+    :return: List of the column names, degree 1 to 9
+    """
+    return [f"Degree={degree} x^{power}" for degree in range(1, MAX_DEGREE + 1) for power in range(degree, -1, -1)]
 
 
 def generate_csv():
     """
-    Creates a Dataframe with all the column names
+    Creates a Dataframe with all the column names, a float column per coefficient followed by the MSR of every degree
 
     :return: Returns a dataframe with all the necessary column names
     """
     columns = ["Trajectories"]
     for idx in range(1, 10):
-        columns.append(f"Degree={idx} Coefficients")
+        columns += [column for column in coefficient_columns() if features.group_of(column) == f"Degree={idx}"]
         columns.append("MSR")
     df = pd.DataFrame(columns=columns)
     return df
 
 
-def visualize_trajectory(x, y):
+def factor_design(x, maxDegree=MAX_DEGREE):
+    """
+    QR factorization of the degree maxDegree design matrix (columns 1, x, ..., x^maxDegree, scaled like np.polyfit)
+
+    :param x: Distance to Runway
+    :param maxDegree: Highest degree
+    :return: Q, R, column scale & the highest degree that is neither under-determined nor rank deficient
+    """
+    n = len(x)
+    design = np.vander(x, maxDegree + 1, increasing=True)
+    scale = np.sqrt((design * design).sum(axis=0))
+    scale[scale == 0] = 1
+    Q, R = np.linalg.qr(design / scale)
+
+    # Same rank tolerance as np.polyfit, a degree is usable while every leading diagonal entry of R is above it
+    diagonal = np.abs(np.diag(R))
+    tolerance = n * np.finfo(float).eps * diagonal.max(initial=0)
+    good = diagonal > tolerance
+    rank = len(good) if good.all() else int(np.argmin(good))
+    return Q, R, scale, min(n - 2, rank - 1)
+
+
+def fit_polynomials(x, ys, maxDegree=MAX_DEGREE):
+    """
+    Least squares polynomial fits of every degree from 1 to maxDegree for one or more trajectories sharing the same x values.
+    A single QR factorization of the degree maxDegree design matrix (columns 1, x, ..., x^maxDegree, scaled like np.polyfit)
+    gives every lower degree: the first d + 1 columns of Q span the polynomials of degree d, so the degree d coefficients
+    solve the leading (d + 1) x (d + 1) block of R and the residual drops one Q column at a time.
+    Degrees that are under-determined or rank deficient fall back to np.polyfit so the result is the same as before.
+
+    :param x: Distance to Runway, shared by every trajectory
+    :param ys: Alt - Ground level, array of shape (len(x),) for one trajectory or (len(x), trajectories)
+    :param maxDegree: Highest degree fitted
+    :return: List of (coefficients, SSR) per degree from 1 to maxDegree. Coefficients are highest power first like
+             np.polyfit, of shape (degree + 1,) or (degree + 1, trajectories); SSR is a float or an array per trajectory
+    """
+    x = np.asarray(x, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    single = ys.ndim == 1
+    Y = ys[:, None] if single else ys
+
+    Q, R, scale, highest = factor_design(x, maxDegree)
+    Z = Q.T @ Y
+
+    fits = []
+    residual = Y - np.outer(Q[:, 0], Z[0])
+    for degree in range(1, maxDegree + 1):
+        if degree > highest:
+            results = [np.polyfit(x, Y[:, k], degree, full=True)[:2] for k in range(Y.shape[1])]
+            coefficients = np.column_stack([c for c, _ in results])
+            ssr = np.array([r[0] if len(r) else 0.0 for _, r in results])
+        else:
+            residual -= np.outer(Q[:, degree], Z[degree])
+            coefficients = solve_triangular(R[:degree + 1, :degree + 1], Z[:degree + 1]) / scale[:degree + 1, None]
+            coefficients = coefficients[::-1]
+            ssr = (residual * residual).sum(axis=0)
+        fits.append((coefficients[:, 0], ssr[0]) if single else (coefficients, ssr))
+    return fits
+
+
+def shared_x_groups(xs):
+    """
+    Groups the trajectories of a batch that have exactly the same x values
+
+    :param xs: List of Distance to Runway arrays, one per trajectory
+    :return: List of groups, each a list of trajectory indices
+    """
+    groups = {}
+    for idx, x in enumerate(xs):
+        x = np.asarray(x, dtype=float)
+        groups.setdefault((len(x), x.tobytes()), []).append(idx)
+    return list(groups.values())
+
+
+def fit_trajectories(xs, ys, maxDegree=MAX_DEGREE):
+    """
+    Fits every trajectory of a batch. Trajectories with the same x values (e.g. resampled on a common grid) are stacked and
+    solved together with a single factorization
+
+    :param xs: List of Distance to Runway arrays, one per trajectory
+    :param ys: List of Alt - Ground level arrays
+    :param maxDegree: Highest degree fitted
+    :return: List with the fits of each trajectory, see fit_polynomials
+    """
+    result = [None] * len(xs)
+    for members in shared_x_groups(xs):
+        x = np.asarray(xs[members[0]], dtype=float)
+        fits = fit_polynomials(x, np.column_stack([np.asarray(ys[idx], dtype=float) for idx in members]), maxDegree)
+        for k, idx in enumerate(members):
+            result[idx] = [(coefficients[:, k], ssr[k]) for coefficients, ssr in fits]
+    return result
+
+
+def selected_columns():
+    """
+    Names of the coefficient columns of the selected degree, padded with zeros up to MAX_DEGREE so every trajectory has the
+    same features whatever its degree (e.g. 'Selected x^9' ... 'Selected x^0')
+
+    :return: List of the column names, highest power first
+    """
+    return [f"Selected x^{power}" for power in range(MAX_DEGREE, -1, -1)]
+
+
+def cross_validation_error(Q, leverage, residual, folds=None):
+    """
+    Cross-validation mean squared error of a least squares fit in closed form, without refitting.
+    With the hat matrix H = Q Q^T of the fit, the residual of the points of a fold F predicted by a fit of every other
+    point is (I - H_FF)^-1 e_F. Leave-one-out (folds is None) only needs the diagonal of H: e_i / (1 - h_ii).
+    k-fold uses (I - Q_F Q_F^T)^-1 = I + Q_F (I - Q_F^T Q_F)^-1 Q_F^T, a (d + 1) x (d + 1) solve per fold.
+
+    :param Q: First d + 1 columns of the Q factor of the design matrix, shape (n, d + 1)
+    :param leverage: Diagonal of the hat matrix (row sums of Q ** 2)
+    :param residual: Residuals of the degree d fit, shape (n, trajectories)
+    :param folds: List of index arrays, one per fold, or None for leave-one-out
+    :return: Cross-validation MSE per trajectory, infinite when a fold leaves the fit under-determined
+    """
+    n = len(residual)
+    if folds is None:
+        denominator = 1 - leverage
+        if denominator.min() <= 1e-10:
+            return np.full(residual.shape[1], np.inf)
+        return ((residual / denominator[:, None]) ** 2).sum(axis=0) / n
+
+    errors = np.zeros(residual.shape[1])
+    for fold in folds:
+        Qf = Q[fold]
+        M = np.eye(Q.shape[1]) - Qf.T @ Qf
+        if np.linalg.cond(M) > 1e10:
+            return np.full(residual.shape[1], np.inf)
+        e = residual[fold] + Qf @ np.linalg.solve(M, Qf.T @ residual[fold])
+        errors += (e * e).sum(axis=0)
+    return errors / n
+
+
+def select_polynomials(x, Y, folds=None, patience=1, maxDegree=MAX_DEGREE):
+    """
+    Chooses the degree of one or more trajectories sharing the same x values by cross-validation.
+    Degrees are tried from 1 upwards on the factorization of fit_polynomials, each adding one Q column to the residual
+    and to the leverage; a trajectory stops once its cross-validation error has not improved for patience degrees, and
+    the whole group stops when every trajectory has. Only the chosen degree is solved for its coefficients.
+
+    :param x: Distance to Runway, shared by every trajectory
+    :param Y: Alt - Ground level, array of shape (len(x), trajectories)
+    :param folds: Number of folds of k-fold cross-validation, None for leave-one-out
+    :param patience: Number of degrees without improvement before stopping
+    :param maxDegree: Highest degree tried
+    :return: Chosen degree, cross-validation MSE, SSR, coefficients (maxDegree + 1, trajectories) highest power first
+             padded with zeros & number of degrees evaluated, every array with one value per trajectory
+    """
+    x = np.asarray(x, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    n, count = Y.shape
+
+    Q, R, scale, highest = factor_design(x, maxDegree)
+    Z = Q.T @ Y
+
+    # Interleaved folds, x is ordered along the approach so every fold covers all of it
+    foldIndex = None if folds is None else [np.arange(f, n, folds) for f in range(min(folds, n))]
+
+    degrees = np.zeros(count, dtype=int)
+    best = np.full(count, np.inf)
+    waited = np.zeros(count, dtype=int)
+    evaluated = np.zeros(count, dtype=int)
+    active = np.ones(count, dtype=bool)
+
+    residual = Y - np.outer(Q[:, 0], Z[0])
+    leverage = Q[:, 0] ** 2
+    for degree in range(1, min(maxDegree, highest) + 1):
+        columns = np.flatnonzero(active)
+        if not len(columns):
+            break
+        residual[:, columns] -= np.outer(Q[:, degree], Z[degree, columns])
+        leverage += Q[:, degree] ** 2
+
+        error = cross_validation_error(Q[:, :degree + 1], leverage, residual[:, columns], foldIndex)
+        evaluated[columns] += 1
+
+        better = error < best[columns]
+        improved = columns[better]
+        best[improved] = error[better]
+        degrees[improved] = degree
+        waited[improved] = 0
+
+        stale = columns[~better]
+        waited[stale] += 1
+        active[stale[waited[stale] >= patience]] = False
+
+    # No degree could be validated (too few points), degree 1 is kept like the smallest fit of fit_polynomials
+    best[degrees == 0] = np.nan
+    degrees[degrees == 0] = 1
+
+    coefficients = np.zeros((maxDegree + 1, count))
+    ssr = np.empty(count)
+    for degree in np.unique(degrees):
+        members = np.flatnonzero(degrees == degree)
+        if degree > highest:
+            for k in members:
+                c, r = np.polyfit(x, Y[:, k], degree, full=True)[:2]
+                coefficients[maxDegree - degree:, k] = c
+                ssr[k] = r[0] if len(r) else 0.0
+        else:
+            solved = solve_triangular(R[:degree + 1, :degree + 1], Z[:degree + 1, members]) / scale[:degree + 1, None]
+            coefficients[maxDegree - degree:, members] = solved[::-1]
+            fitted = Y[:, members] - Q[:, :degree + 1] @ Z[:degree + 1, members]
+            ssr[members] = (fitted * fitted).sum(axis=0)
+    return degrees, best, ssr, coefficients, evaluated
+
+
+def select_trajectories(xs, ys, folds=None, patience=1):
+    """
+    Chooses the degree of every trajectory of a batch, see select_polynomials. Trajectories with the same x values are
+    selected together
+
+    :param xs: List of Distance to Runway arrays, one per trajectory
+    :param ys: List of Alt - Ground level arrays
+    :param folds: Number of folds of k-fold cross-validation, None for leave-one-out
+    :param patience: Number of degrees without improvement before stopping
+    :return: Degree, CV MSE, SSR, coefficients (trajectories, MAX_DEGREE + 1) & degrees evaluated of every trajectory
+    """
+    count = len(xs)
+    degrees = np.empty(count, dtype=int)
+    cv = np.empty(count)
+    ssr = np.empty(count)
+    coefficients = np.empty((count, MAX_DEGREE + 1))
+    evaluated = np.empty(count, dtype=int)
+    for members in shared_x_groups(xs):
+        x = np.asarray(xs[members[0]], dtype=float)
+        result = select_polynomials(x, np.column_stack([np.asarray(ys[idx], dtype=float) for idx in members]), folds, patience)
+        degrees[members], cv[members], ssr[members], coefficients[members], evaluated[members] = \
+            result[0], result[1], result[2], result[3].T, result[4]
+    return degrees, cv, ssr, coefficients, evaluated
+
+
+def visualize_trajectory(x, y, fits=None):
     """
     Visualizes all the trajectories from Degree 1 to 9 & plots them in a single figure
 
     :param x: Distance to Runway
     :param y: Alt - Ground level
+    :param fits: Fits already calculated for the trajectory (see fit_polynomials), calculated if not given
     :return: Visualizes the plot
     """
+    if fits is None:
+        fits = fit_polynomials(x, y)
     fig, axs = plt.subplots(3, 3, figsize=(3, 3))
     degree = 1
     for i in range(3):
@@ -46,55 +326,266 @@ def visualize_trajectory(x, y):
                 axs[i, j].set_xlabel("Distance to Runway (nmi)")
             axs[i, j].set_ylabel("Alt - Ground Level")
             axs[i, j].set_title(f"Degree-{degree}")
-            coefficients, residual, _, _, _ = np.polyfit(x, y, degree, full=True)
+            coefficients, residual = fits[degree - 1]
             poly1d_fn = np.poly1d(coefficients)
             axs[i, j].plot(x, y, 'yo', x, poly1d_fn(x))
             degree += 1
     plt.show()
 
 
-def calculate_coefficients(fileName, dataframe, data, trajectoriesCount, randomTrajectory):
+def calculate_coefficients(data, fits=None):
     """
-    Calculates the coefficients & MSR for all the data & appends it to the final dataframe
+    Calculates the coefficients & MSR of a trajectory for every degree
 
-    :param dataframe: Final Dataframe
     :param data: Landing Data
-    :param trajectoriesCount: Number of trajectories
-    :param randomTrajectory: Randomly selected trajectory to visualize the data
-    :return:
+    :param fits: Fits already calculated for the trajectory (see fit_trajectories), calculated if not given
+    :return: Array of the coefficients (see coefficient_columns) & list of the MSR, from degree 1 to 9
     """
 
     x = np.array(data["Distance From Start (nmi)"])
     y = np.array(data["Alt - Ground Level"])
 
     # Getting the number of rows in the dataframe
-    numberOfRows = data.shape[0]
+    numberOfRows = len(x)
 
-    # Visualising random trajectory
-    if trajectoriesCount == randomTrajectory:
-        # Un-comment to visualize the trajectories
-        visualize_trajectory(x, y)
+    # Every degree from a single factorization
+    if fits is None:
+        fits = fit_polynomials(x, y)
 
-    # Appending file name to the rows in the dataframe
-    rowData = [fileName]
+    coefficientsData = []
+    msrData = []
 
     for degree in range(1, 10):
 
-        # Calculate coefficients & SSR for X, Y
-        coefficients, residual, _, _, _ = np.polyfit(x, y, degree, full=True)
-
-        # Checking if the residual is Empty
-        residual = 0 if len(residual) == 0 else residual[0]
+        # Coefficients & SSR for X, Y
+        coefficients, residual = fits[degree - 1]
 
         # Calculating MSR (SSR / Number of rows in dataframe)
         residualMSR = round((residual / numberOfRows), 2)
 
-        # Appends coefficients & MSR to the rowData list
-        rowData.append(np.array2string(coefficients, separator=",")[1:-1])
-        rowData.append(residualMSR)
+        # Appends coefficients & MSR to the lists
+        coefficientsData.append(coefficients)
+        msrData.append(residualMSR)
 
-    # Appends the calculated coefficients & MSR of a trajectory to the final Dataframe
-    dataframe.loc[trajectoriesCount] = rowData
+    return np.concatenate(coefficientsData), msrData
+
+
+def fit_batch(batch):
+    """
+    Fits a batch of trajectories together, so the ones sharing the same x values are solved at once
+
+    :param batch: List of (name, trajectory)
+    :return: Names, coefficients & MSR of the trajectories in order
+    """
+    with instrument.stage("least squares"):
+        fits = fit_trajectories([data["Distance From Start (nmi)"] for _, data in batch],
+                                [data["Alt - Ground Level"] for _, data in batch])
+
+        names = [name for name, _ in batch]
+        coefficients = []
+        msr = []
+        for (name, data), trajectoryFits in zip(batch, fits):
+            coefficientsData, msrData = calculate_coefficients(data, trajectoryFits)
+            coefficients.append(coefficientsData)
+            msr.append(msrData)
+    instrument.count("fits", len(batch))
+    return names, coefficients, msr
+
+
+def fit_range(inputDirectory, start, stop):
+    """
+    Fits the trajectories start to stop - 1 of a folder or store, run by each worker process
+
+    :param inputDirectory: Folder of out*.csv files or trajectory store
+    :param start: Index of the first trajectory
+    :param stop: Index after the last trajectory
+    :return: Names, coefficients & MSR of the trajectories in order
+    """
+    with instrument.stage("read"):
+        batch = list(trajstore.iter_trajectories(inputDirectory, start, stop))
+    return fit_batch(batch)
+
+
+def fit_values(batch):
+    """
+    Results of a batch as stored in the fit cache (see fitcache.py), the coefficients of every degree followed by the MSR
+
+    :param batch: List of (name, trajectory)
+    :return: Matrix with one result per trajectory & no notes
+    """
+    _, coefficients, msr = fit_batch(batch)
+    return np.hstack([np.reshape(coefficients, (len(batch), -1)), np.reshape(msr, (len(batch), -1))]), None
+
+
+def select_range(inputDirectory, start, stop, folds=None, patience=1):
+    """
+    Chooses the degree of the trajectories start to stop - 1 of a folder or store, run by each worker process
+
+    :param inputDirectory: Folder of out*.csv files or trajectory store
+    :param start: Index of the first trajectory
+    :param stop: Index after the last trajectory
+    :param folds: Number of folds of k-fold cross-validation, None for leave-one-out
+    :param patience: Number of degrees without improvement before stopping
+    :return: Names, (Degree, CV MSR, MSR) rows, selected coefficients & degrees evaluated of the trajectories in order
+    """
+    with instrument.stage("read"):
+        batch = list(trajstore.iter_trajectories(inputDirectory, start, stop))
+    return select_batch(batch, folds, patience)
+
+
+def select_batch(batch, folds=None, patience=1):
+    """
+    Chooses the degree of a batch of trajectories
+
+    :param batch: List of (name, trajectory)
+    :param folds: Number of folds of k-fold cross-validation, None for leave-one-out
+    :param patience: Number of degrees without improvement before stopping
+    :return: Names, (Degree, CV MSR, MSR) rows, selected coefficients & degrees evaluated of the trajectories in order
+    """
+    with instrument.stage("select"):
+        degrees, cv, ssr, coefficients, evaluated = select_trajectories([data["Distance From Start (nmi)"] for _, data in batch],
+                                                                        [data["Alt - Ground Level"] for _, data in batch],
+                                                                        folds, patience)
+    instrument.count("fits", len(batch))
+    rows = np.array([len(data["Alt - Ground Level"]) for _, data in batch])
+
+    # Same rounding as the MSR of calculate_coefficients
+    scores = np.column_stack([degrees, np.round(cv, 2), np.round(ssr / rows, 2)])
+    return [name for name, _ in batch], scores, coefficients, evaluated
+
+
+def select_values(batch, folds=None, patience=1):
+    """
+    Results of a batch as stored in the fit cache: degree, CV MSR, MSR, selected coefficients & degrees evaluated
+
+    :param batch: List of (name, trajectory)
+    :param folds: Number of folds of k-fold cross-validation, None for leave-one-out
+    :param patience: Number of degrees without improvement before stopping
+    :return: Matrix with one result per trajectory & no notes
+    """
+    _, scores, coefficients, evaluated = select_batch(batch, folds, patience)
+    return np.hstack([scores, coefficients, evaluated[:, None]]), None
+
+
+def select_directory(inputDirectory, workers=1, folds=None, patience=1, cache=None):
+    """
+    Chooses the degree of every trajectory of a folder or store, in a pool of worker processes when workers > 1
+
+    :param inputDirectory: Folder of out*.csv files or trajectory store
+    :param workers: Number of worker processes
+    :param folds: Number of folds of k-fold cross-validation, None for leave-one-out
+    :param patience: Number of degrees without improvement before stopping
+    :param cache: FitCache, unchanged trajectories are read from it instead of being fitted
+    :return: Names (n,), (Degree, CV MSR, MSR) scores (n, 3), coefficients (n, 10, see selected_columns) & degrees evaluated
+    """
+    count = trajstore.count_trajectories(inputDirectory)
+    names = np.empty(count, dtype=object)
+    scores = np.empty((count, 3))
+    coefficients = np.empty((count, MAX_DEGREE + 1))
+    evaluated = np.empty(count, dtype=int)
+
+    if cache is not None:
+        params = {"maxDegree": MAX_DEGREE, "folds": folds, "patience": patience}
+        for start, (rangeNames, results, _) in fitcache.map_cached(cache, inputDirectory, workers, BATCH_SIZE, "polycoef-select",
+                                                                   params, partial(select_values, folds=folds, patience=patience)):
+            stop = start + len(rangeNames)
+            names[start:stop] = rangeNames
+            scores[start:stop] = results[:, :3]
+            coefficients[start:stop] = results[:, 3:-1]
+            evaluated[start:stop] = results[:, -1]
+        return names, scores, coefficients, evaluated
+
+    for start, (rangeNames, rangeScores, rangeCoefficients, rangeEvaluated) in \
+            trajstore.map_trajectories(inputDirectory, select_range, workers, BATCH_SIZE, folds, patience):
+        stop = start + len(rangeNames)
+        names[start:stop] = rangeNames
+        scores[start:stop] = rangeScores
+        coefficients[start:stop] = rangeCoefficients
+        evaluated[start:stop] = rangeEvaluated
+    return names, scores, coefficients, evaluated
+
+
+def fit_directory(inputDirectory, workers=1, cache=None):
+    """
+    Fits every trajectory of a folder or store, in a pool of worker processes when workers > 1.
+    Results are written into arrays allocated for every trajectory up front, at the trajectory's own position,
+    so the rows are in the same order whatever order the workers finish in
+
+    :param inputDirectory: Folder of out*.csv files or trajectory store
+    :param workers: Number of worker processes
+    :param cache: FitCache, unchanged trajectories are read from it instead of being fitted
+    :return: Names (n,), coefficients (n, 54, see coefficient_columns) & MSR (n, 9) of the n trajectories
+    """
+    count = trajstore.count_trajectories(inputDirectory)
+    names = np.empty(count, dtype=object)
+    coefficients = np.empty((count, len(coefficient_columns())))
+    msr = np.empty((count, MAX_DEGREE))
+
+    if cache is not None:
+        width = coefficients.shape[1]
+        for start, (rangeNames, results, _) in fitcache.map_cached(cache, inputDirectory, workers, BATCH_SIZE, "polycoef",
+                                                                   {"maxDegree": MAX_DEGREE}, fit_values):
+            stop = start + len(rangeNames)
+            names[start:stop] = rangeNames
+            coefficients[start:stop] = results[:, :width]
+            msr[start:stop] = results[:, width:]
+        return names, coefficients, msr
+
+    for start, (rangeNames, rangeCoefficients, rangeMsr) in trajstore.map_trajectories(inputDirectory, fit_range, workers, BATCH_SIZE):
+        stop = start + len(rangeNames)
+        names[start:stop] = rangeNames
+        coefficients[start:stop] = rangeCoefficients
+        msr[start:stop] = rangeMsr
+    return names, coefficients, msr
+
+
+def build_dataframe(names, coefficients, msr):
+    """
+    Builds the final Dataframe from the fitted arrays in one go & appends the Mean-MSR row
+
+    :param names: Names of the trajectories
+    :param coefficients: Coefficients of every trajectory, degree 1 to 9
+    :param msr: MSR of every trajectory, degree 1 to 9
+    :return: Final Dataframe
+    """
+    columns = generate_csv().columns
+    coefficientIndex = {column: idx for idx, column in enumerate(coefficient_columns())}
+    columnData = {0: names}
+    degree = 0
+    for position, column in enumerate(columns[1:], start=1):
+        if column == "MSR":
+            columnData[position] = msr[:, degree]
+            degree += 1
+        else:
+            columnData[position] = coefficients[:, coefficientIndex[column]]
+    dataframe = pd.DataFrame(columnData, index=range(1, len(names) + 1))
+    dataframe.columns = columns
+
+    # Calculates the MEAN of MSR
+    calculate_mean_msr(dataframe, len(names) + 1)
+    return dataframe
+
+
+def build_selected_dataframe(names, scores, coefficients):
+    """
+    Builds the Dataframe of the selected degrees & appends the Mean-MSR row
+
+    :param names: Names of the trajectories
+    :param scores: Degree, CV MSR & MSR of every trajectory
+    :param coefficients: Coefficients of the selected degree of every trajectory, see selected_columns
+    :return: Final Dataframe
+    """
+    columns = ["Trajectories", "Degree", "CV MSR", "MSR"] + selected_columns()
+    columnData = {0: names, 1: scores[:, 0], 2: scores[:, 1], 3: scores[:, 2]}
+    for idx in range(coefficients.shape[1]):
+        columnData[4 + idx] = coefficients[:, idx]
+    dataframe = pd.DataFrame(columnData, index=range(1, len(names) + 1))
+    dataframe.columns = columns
+
+    # Calculates the MEAN of MSR & CV MSR, the degree stays an integer column with an empty Mean-MSR cell
+    calculate_mean_msr(dataframe, len(names) + 1)
+    dataframe["Degree"] = dataframe["Degree"].astype("Int64")
+    return dataframe
 
 
 def calculate_mean_msr(dataframe, trajectoriesCount):
@@ -106,12 +597,12 @@ def calculate_mean_msr(dataframe, trajectoriesCount):
     :return:
     """
     rowData = [""]
-    for idx in range(1, 19):
-        if idx % 2 == 0:
+    for idx in range(1, len(dataframe.columns)):
+        if dataframe.columns[idx] in ("MSR", "CV MSR"):
             # Calculates the Mean of MSR for all the trajectories from degree 1 to degree 9
             rowData.append(dataframe.iloc[:, idx].mean())
         else:
-            rowData.append("")
+            rowData.append(np.nan)
 
     # Appends the calculated MEAN-MSR of a trajectory to the final Dataframe
     dataframe.loc[trajectoriesCount] = rowData
@@ -124,8 +615,16 @@ if __name__ == '__main__':
     # Commands for input and output
     parser.add_argument('-in', metavar="INPUT", help='input file/directory')
     parser.add_argument('-out', metavar="OUTPUT", help='output directory')
+    parser.add_argument('-j', '--workers', metavar="WORKERS", type=int, default=1, help="Number of worker processes fitting trajectories, 0 uses every core")
+    parser.add_argument('-select', choices=["loo", "kfold"], help="Choose the degree of each trajectory by leave-one-out or k-fold cross-validation instead of fitting every degree")
+    parser.add_argument('-folds', metavar="FOLDS", type=int, default=5, help="Number of folds of -select kfold")
+    parser.add_argument('-cache', metavar="FILE", nargs="?", const="", help="Reuse the results of unchanged trajectories from this cache file (default: fitcache.sqlite in the output directory)")
+    parser.add_argument('-cache-size', metavar="MB", type=float, default=fitcache.MAX_MB, help="Size limit of the cache, the least recently used results are removed beyond it")
+    parser.add_argument('-patience', metavar="DEGREES", type=int, default=1, help="Stop trying higher degrees once the cross-validation error has not improved for this many degrees")
+    instrument.add_arguments(parser)
 
     args = vars(parser.parse_args())
+    instrument.start(args['profile'], args['profile_calls'])
 
     # Raises an Exception if input path is not specified
     if not args["in"]:
@@ -139,42 +638,64 @@ if __name__ == '__main__':
     else:
         outputDirectory = args["out"]
 
-    # Generates a CSV with all the required column names
-    dataframe = generate_csv()
-
-    for subdir, dirs, files in os.walk(inputDirectory):
-
-        # Counts the number of trajectories in the folder
-        trajectoriesCount = 1
-
-        # Selecting a random trajectory to visualize
-        randomTrajectory = random.randint(0, len(files))
-
-        for file in files:
-            # Separates file name & file extension
-            fileName = os.path.splitext(file)
-
-            # Checks if the file is CSV
-            if fileName[1] == ".csv" and fileName[0][:3] == "out":
-                # Reads the CSV file
-                data = pd.read_csv(inputDirectory + "/" + file, encoding="Latin-1", engine="python")
-
-                # Calls calculate-coefficients method
-                calculate_coefficients(fileName[0], dataframe, data, trajectoriesCount, randomTrajectory)
-                trajectoriesCount += 1
+    # Number of worker processes
+    workers = args['workers'] if args['workers'] > 0 else os.cpu_count()
+
+    # Cache of the fit results, unchanged trajectories are not fitted again
+    cache = None
+    if args['cache'] is not None:
+        cache = fitcache.FitCache(args['cache'] or os.path.join(outputDirectory, fitcache.CACHE_NAME), int(args['cache_size'] * 1024 * 1024))
+
+    # Selecting a random trajectory to visualize (trajectories are numbered from 1, 0 shows none)
+    randomTrajectory = random.randint(0, trajstore.count_trajectories(inputDirectory))
+
+    # Retrieve Current time
+    currentTime = datetime.now()
+    currentTime = currentTime.strftime("%Y%m%d-%H%M%S")
+
+    if args['select']:
+        # One degree per trajectory chosen by cross-validation
+        folds = args['folds'] if args['select'] == "kfold" else None
+        with instrument.stage("fit"):
+            names, scores, coefficients, evaluated = select_directory(inputDirectory, workers, folds, max(1, args['patience']), cache)
+        print(f"Degrees evaluated per trajectory: {evaluated.mean():.2f} (of {MAX_DEGREE})")
+        for degree, count in zip(*np.unique(scores[:, 0].astype(int), return_counts=True)):
+            print(f"Degree {degree}: {count} trajectories")
+
+        # Final Dataframe with the selected degree of every trajectory & the MEAN of MSR
+        dataframe = build_selected_dataframe(names, scores, coefficients)
+        filePath = Path(outputDirectory + f"/polycoef-{args['select']}-{currentTime}.csv")
+        columns = selected_columns()
+    else:
+        # Fits every out*.csv file of the folder, or every trajectory of a store written by flightprocess.py -format store
+        with instrument.stage("fit"):
+            names, coefficients, msr = fit_directory(inputDirectory, workers, cache)
 
-        # Calculates the MEAN of MSR
-        calculate_mean_msr(dataframe, trajectoriesCount)
+        # Visualising random trajectory
+        if randomTrajectory > 0:
+            for _, data in trajstore.iter_trajectories(inputDirectory, randomTrajectory - 1, randomTrajectory):
+                # Un-comment to visualize the trajectories
+                visualize_trajectory(np.array(data["Distance From Start (nmi)"]), np.array(data["Alt - Ground Level"]))
 
-        # Retrieve Current time
-        currentTime = datetime.now()
-        currentTime = currentTime.strftime("%Y%m%d-%H%M%S")
+        # Final Dataframe with every trajectory & the MEAN of MSR
+        dataframe = build_dataframe(names, coefficients, msr)
 
         # Creates file Path
         filePath = Path(outputDirectory + f"/polycoef-{currentTime}.csv")
+        columns = coefficient_columns()
+
+    # Removes the least recently used results beyond the size limit & reports the hits and misses of the run
+    if cache is not None:
+        cache.evict()
+        print(cache.summary())
+        cache.close()
 
-        # Creates Directory if output path does not exist
-        filePath.parent.mkdir(parents=True, exist_ok=True)
+    # Creates Directory if output path does not exist
+    filePath.parent.mkdir(parents=True, exist_ok=True)
 
-        # Saves the csv to output directory
+    # Saves the csv to output directory
+    with instrument.stage("write"):
         dataframe.to_csv(filePath, index=False)
+
+        # Saves the coefficient matrix next to it, loaded directly by the clustering scripts
+        features.save_features(filePath, names, coefficients, columns)
@@ -0,0 +1,210 @@
+import numpy as np
+import resample
+
+# ------------------------------------------------------------------------------------------------------------
+# Representative trajectory of a set of approaches: pointwise median and percentile band along a common distance grid
+#
+# Every trajectory is interpolated at the points of a distance grid (NaN outside the distance it covers) and the values of
+# each grid point go into a QuantileSketch, so any number of trajectories is summarized in a single pass with a memory
+# use that only depends on the grid size and the sketch capacity, not on the number of trajectories.
+#
+# A summary is saved as an .npz file holding:
+#   grid          - distance grid (nmi)
+#   quantiles     - quantiles computed (e.g. 0.1, 0.5, 0.9)
+#   columns       - name of every summarized column
+#   values        - float64 array of shape (columns, quantiles, grid points)
+#   count         - number of trajectories covering each grid point
+#   trajectories  - number of trajectories summarized
+# ------------------------------------------------------------------------------------------------------------
+
+# Median line and 10th to 90th percentile band
+QUANTILES = (0.1, 0.5, 0.9)
+
+# Values kept per level of a sketch, quantiles are then within about 1% of their true rank
+CAPACITY = 128
+
+# Trajectories interpolated before their values are added to the sketches
+BATCH_SIZE = 256
+
+
+def distance_grid(start=0.0, stop=6.0, step=0.01):
+    """
+    Evenly spaced distance grid, by default the x range of the horizontal view
+
+    :param start: First distance (nmi)
+    :param stop: Last distance (nmi)
+    :param step: Spacing (nmi)
+    :return: Array of distances
+    """
+    return np.linspace(start, stop, int(round((stop - start) / step)) + 1)
+
+
+class QuantileSketch:
+    """
+    Streaming quantile sketches of many independent streams at once (one per grid point), in the style of the KLL sketch.
+    Level h holds sorted values that each stand for 2^h values of the stream. When a level of a stream reaches capacity
+    values they are paired up and every other one, from a random offset, moves up a level, so a stream of n values is
+    held in about capacity * log2(n / capacity) values. Quantiles are exact as long as a stream never filled its first level.
+    Every level is a (streams, width) array padded with NaN, so every operation is vectorized over the streams.
+    """
+
+    def __init__(self, size, capacity=CAPACITY, seed=0):
+        self.size = size
+        self.capacity = capacity
+        self.levels = []
+        self.count = np.zeros(size, dtype=np.int64)
+        self.rng = np.random.default_rng(seed)
+
+    def update(self, values):
+        """
+        Adds values to the streams
+
+        :param values: Array of shape (streams, k), NaN values are not added
+        """
+        values = np.asarray(values, dtype=float).reshape(self.size, -1)
+        self.count += np.isfinite(values).sum(axis=1)
+        level = 0
+        while values is not None:
+            if level == len(self.levels):
+                self.levels.append(np.empty((self.size, 0)))
+            values = self._insert(level, values)
+            level += 1
+
+    def _insert(self, level, values):
+        # NaN sort last, the values of every stream are at the start of its row in order
+        buffer = np.sort(np.concatenate([self.levels[level], values], axis=1), axis=1)
+        sizes = np.isfinite(buffer).sum(axis=1)
+        full = sizes >= self.capacity
+        promoted = None
+        if full.any():
+            rows = buffer[full]
+            n = sizes[full][:, None]
+            even = n - n % 2
+            position = np.arange(buffer.shape[1])[None, :]
+            offset = self.rng.integers(0, 2, (len(rows), 1))
+            promoted = np.full_like(buffer, np.nan)
+            promoted[full] = np.where((position < even) & ((position - offset) % 2 == 0), rows, np.nan)
+            # The largest value of an odd number of values waits for the next compaction
+            buffer[full] = np.where((position >= even) & (position < n), rows, np.nan)
+            buffer = np.sort(buffer, axis=1)
+            promoted = np.sort(promoted, axis=1)[:, :(buffer.shape[1] + 1) // 2]
+        width = np.isfinite(buffer).sum(axis=1).max(initial=0)
+        self.levels[level] = buffer[:, :width]
+        return promoted
+
+    def quantiles(self, quantiles):
+        """
+        Quantiles of every stream
+
+        :param quantiles: List of quantiles between 0 and 1
+        :return: Array of shape (quantiles, streams), NaN for empty streams
+        """
+        if not self.levels:
+            return np.full((len(quantiles), self.size), np.nan)
+        values = np.concatenate(self.levels, axis=1)
+        weights = np.concatenate([np.full(level.shape, 2.0 ** h) for h, level in enumerate(self.levels)], axis=1)
+        weights[np.isnan(values)] = 0
+
+        order = np.argsort(values, axis=1)
+        values = np.take_along_axis(values, order, axis=1)
+        cumulative = np.cumsum(np.take_along_axis(weights, order, axis=1), axis=1)
+        total = cumulative[:, -1]
+
+        result = np.full((len(quantiles), self.size), np.nan)
+        rows = np.flatnonzero(total > 0)
+        for idx, q in enumerate(quantiles):
+            # First value whose cumulative weight reaches q of the total, like np.quantile(method="inverted_cdf")
+            position = (cumulative[rows] < q * total[rows, None]).sum(axis=1)
+            result[idx, rows] = values[rows, np.minimum(position, values.shape[1] - 1)]
+        return result
+
+
+class RepresentativeTrajectory:
+    """
+    Builds the median line and percentile band of trajectories added one at a time, see the module description
+    """
+
+    def __init__(self, columns, grid=None, capacity=CAPACITY, batchSize=BATCH_SIZE, seed=0):
+        self.columns = list(columns)
+        self.grid = distance_grid() if grid is None else np.asarray(grid, dtype=float)
+        self.batchSize = batchSize
+        self.sketches = [QuantileSketch(len(self.grid), capacity, seed + idx) for idx in range(len(self.columns))]
+        self.pending = []
+        self.trajectories = 0
+
+    def add(self, distance, values):
+        """
+        Adds a trajectory
+
+        :param distance: Distance From Start (nmi) of every row
+        :param values: Dictionary of column name to array of the same length, every column of the summary
+        """
+        distance = np.asarray(distance, dtype=float)
+        # Only the rows moving forward, np.interp needs increasing distances
+        keep = resample.increasing(distance) & np.isfinite(distance)
+        if keep.sum() < 2:
+            return
+        distance = distance[keep]
+        self.pending.append(np.stack([np.interp(self.grid, distance, np.asarray(values[column], dtype=float)[keep],
+                                                left=np.nan, right=np.nan) for column in self.columns]))
+        self.trajectories += 1
+        if len(self.pending) == self.batchSize:
+            self.flush()
+
+    def flush(self):
+        """
+        Adds the interpolated trajectories waiting to the sketches
+        """
+        if not self.pending:
+            return
+        batch = np.stack(self.pending, axis=2)
+        for idx, sketch in enumerate(self.sketches):
+            sketch.update(batch[idx])
+        self.pending = []
+
+    def summary(self, quantiles=QUANTILES):
+        """
+        Median line and percentile band of the trajectories added so far
+
+        :param quantiles: Quantiles to compute
+        :return: Dictionary with the entries of the saved file (see the module description)
+        """
+        self.flush()
+        return {"grid": self.grid, "quantiles": np.asarray(quantiles, dtype=float), "columns": np.asarray(self.columns, dtype=str),
+                "values": np.stack([sketch.quantiles(quantiles) for sketch in self.sketches]),
+                "count": self.sketches[0].count.copy() if self.sketches else np.zeros(len(self.grid), dtype=np.int64),
+                "trajectories": np.int64(self.trajectories)}
+
+
+def save(path, summary):
+    """
+    Saves a summary to an .npz file
+
+    :param path: File path
+    :param summary: Summary returned by RepresentativeTrajectory.summary
+    """
+    np.savez(path, **summary)
+
+
+def load(path):
+    """
+    Loads a summary saved by save
+
+    :param path: File path
+    :return: Summary dictionary
+    """
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+
+def band(summary, column):
+    """
+    Lowest quantile, median & highest quantile of a column along the grid
+
+    :param summary: Summary dictionary
+    :param column: Column name
+    :return: Arrays of the low, median & high values
+    """
+    values = summary["values"][list(summary["columns"]).index(column)]
+    median = int(np.argmin(np.abs(summary["quantiles"] - 0.5)))
+    return values[0], values[median], values[-1]
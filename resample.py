@@ -0,0 +1,240 @@
+import numpy as np
+import pandas as pd
+
+# ------------------------------------------------------------------------------------------------------------
+# Resampling of flight data to a given data collection frequency (in Hz)
+#
+# FlightGear logs at whatever rate the simulator runs, so the 'Time' column is not evenly spaced. resample_frame puts
+# a trajectory on an even grid (t0, t0 + 1/hz, t0 + 2/hz, ...) by linear interpolation of every column at once.
+# Resampler does the same for a trajectory that arrives in chunks, the grid and values are identical to resampling
+# the whole trajectory at once.
+# resample_batch puts many trajectories on a common grid of a fixed number of points (e.g. for time series clustering).
+# lttb_batch downsamples many lines to a given number of points (e.g. screen resolution) while keeping their shape.
+# ------------------------------------------------------------------------------------------------------------
+
+
+def increasing(t):
+    """
+    Mask keeping only the samples where time strictly increases (FlightGear sometimes logs the same time twice)
+
+    :param t: Array of sample times
+    :return: Boolean mask
+    """
+    keep = np.ones(len(t), dtype=bool)
+    if len(t) > 1:
+        keep[1:] = t[1:] > np.maximum.accumulate(t)[:-1]
+    return keep
+
+
+def interpolate_rows(t, values, grid):
+    """
+    Linearly interpolates every column of a 2D array at the grid times, one searchsorted for all columns
+
+    :param t: Strictly increasing sample times, length n
+    :param values: Array of shape (n, columns)
+    :param grid: Times to interpolate at, all within [t[0], t[-1]]
+    :return: Array of shape (len(grid), columns)
+    """
+    if len(t) == 1:
+        return np.repeat(values[:1], len(grid), axis=0)
+    hi = np.clip(np.searchsorted(t, grid, side="right"), 1, len(t) - 1)
+    lo = hi - 1
+    weight = ((grid - t[lo]) / (t[hi] - t[lo]))[:, None]
+    return values[lo] * (1 - weight) + values[hi] * weight
+
+
+class Resampler:
+    """
+    Resamples a trajectory that is read in chunks. The last row of every chunk is kept so the interval between two
+    chunks is interpolated exactly like any other interval.
+    """
+
+    def __init__(self, hz, timeColumn="Time"):
+        self.hz = float(hz)
+        self.timeColumn = timeColumn
+        self.t0 = None
+        self.nextStep = 0
+        self.previous = None
+
+    def push(self, frame):
+        """
+        Adds the next chunk of the trajectory
+
+        :param frame: Dataframe with the next rows
+        :return: Dataframe with the resampled rows that fall within the data received so far
+        """
+        if self.previous is not None:
+            frame = pd.concat([self.previous, frame], ignore_index=True)
+        if len(frame) == 0:
+            return frame
+
+        t = frame[self.timeColumn].to_numpy(dtype=float)
+        keep = increasing(t)
+        frame = frame[keep]
+        t = t[keep]
+        if self.t0 is None:
+            self.t0 = t[0]
+
+        # Grid times are computed from their step number so they never drift with the chunk boundaries. The last step is
+        # the last grid time within the data: the product can round either way, and a grid time a rounding error after the
+        # last row would be extrapolated here but interpolated once the next chunk arrives
+        lastStep = int(np.floor((t[-1] - self.t0) * self.hz))
+        while self.t0 + (lastStep + 1) / self.hz <= t[-1]:
+            lastStep += 1
+        while lastStep >= self.nextStep and self.t0 + lastStep / self.hz > t[-1]:
+            lastStep -= 1
+        steps = np.arange(self.nextStep, lastStep + 1)
+        grid = self.t0 + steps / self.hz
+        self.nextStep = lastStep + 1
+        self.previous = frame.iloc[-1:]
+
+        values = interpolate_rows(t, frame.to_numpy(dtype=float), grid)
+        resampled = pd.DataFrame(values, columns=frame.columns)
+        resampled[self.timeColumn] = grid
+        return resampled
+
+
+def resample_frame(frame, hz, timeColumn="Time"):
+    """
+    Resamples a whole trajectory to an even grid at the given frequency
+
+    :param frame: Dataframe of the trajectory, every column numeric
+    :param hz: Target data collection frequency in Hz
+    :param timeColumn: Name of the time column (seconds)
+    :return: Resampled dataframe with the same columns
+    """
+    return Resampler(hz, timeColumn).push(frame)
+
+
+def resample_batch(times, values, points):
+    """
+    Resamples many trajectories to the same number of evenly spaced points over each trajectory's own duration.
+    The trajectories are concatenated and offset by their index so a single searchsorted interpolates all of them.
+
+    :param times: List of arrays of sample times, one per trajectory
+    :param values: List of arrays of values (same lengths as times)
+    :param points: Number of points of the common grid
+    :return: Array of shape (number of trajectories, points)
+    """
+    lengths = np.array([len(t) for t in times])
+    if len(lengths) == 0:
+        return np.empty((0, points))
+    if lengths.min() == 0:
+        raise ValueError("Cannot resample an empty trajectory")
+
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    series = np.repeat(np.arange(len(times)), lengths)
+    t = np.concatenate([np.asarray(x, dtype=float) for x in times])
+    v = np.concatenate([np.asarray(x, dtype=float) for x in values])
+
+    # Normalizes each trajectory's time to [0, 1]
+    start = t[offsets[:-1]]
+    span = t[offsets[1:] - 1] - start
+    span[span == 0] = 1
+    tNorm = (t - start[series]) / span[series]
+
+    # Key of trajectory i is i + tNorm / 2, so keys of different trajectories never overlap and are increasing overall
+    keys = series + tNorm / 2
+    grid = np.linspace(0, 1, points)
+    query = (np.arange(len(times))[:, None] + grid[None, :] / 2).ravel()
+    querySeries = np.repeat(np.arange(len(times)), points)
+
+    # Interval of each grid point, kept within its own trajectory
+    first = offsets[:-1][querySeries]
+    last = offsets[1:][querySeries] - 1
+    hi = np.clip(np.searchsorted(keys, query, side="right"), first + 1, np.maximum(last, first + 1))
+    hi = np.minimum(hi, last)
+    lo = np.maximum(hi - 1, first)
+
+    denominator = keys[hi] - keys[lo]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        weight = np.where(denominator > 0, (query - keys[lo]) / denominator, 0.0)
+    weight = np.clip(weight, 0, 1)
+    return (v[lo] * (1 - weight) + v[hi] * weight).reshape(len(times), points)
+
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling of a single line, see lttb_batch
+
+    :param x: Array of x values
+    :param y: Array of y values
+    :param threshold: Number of points to keep
+    :return: Indices of the kept points
+    """
+    return lttb_batch([x], [y], threshold)[0]
+
+
+def lttb_batch(xs, ys, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling of many lines at once. The first and last points are always kept and
+    the points in between are split into threshold - 2 buckets; each bucket keeps the point forming the largest triangle
+    with the point kept in the previous bucket and the average of the next bucket, which preserves peaks and the overall
+    shape of the line. Lines with more than threshold points are processed together one bucket at a time, so the python
+    loop runs threshold times whatever the number of lines.
+
+    :param xs: List of x arrays, one per line
+    :param ys: List of y arrays (same lengths as xs)
+    :param threshold: Number of points to keep per line (at least 3)
+    :return: List of index arrays, one per line
+    """
+    if threshold < 3:
+        raise ValueError("LTTB needs a threshold of at least 3 points")
+
+    result = [np.arange(len(x)) for x in xs]
+    long = [i for i, x in enumerate(xs) if len(x) > threshold]
+    if not long:
+        return result
+
+    lengths = np.array([len(xs[i]) for i in long])
+    offsets = np.concatenate([[0], np.cumsum(lengths)])[:-1]
+    x = np.concatenate([np.asarray(xs[i], dtype=float) for i in long])
+    y = np.concatenate([np.asarray(ys[i], dtype=float) for i in long])
+
+    # Prefix sums give the average of any bucket without a loop
+    xSum = np.concatenate([[0], np.cumsum(x)])
+    ySum = np.concatenate([[0], np.cumsum(y)])
+
+    buckets = threshold - 2
+    every = (lengths - 2) / buckets
+
+    def bucket_bounds(j):
+        start = np.floor(j * every).astype(int) + 1
+        end = np.floor((j + 1) * every).astype(int) + 1
+        return offsets + start, offsets + np.maximum(end, start + 1)
+
+    selected = np.empty((len(long), threshold), dtype=int)
+    selected[:, 0] = offsets
+    selected[:, -1] = offsets + lengths - 1
+
+    a = offsets.copy()
+    start, end = bucket_bounds(0)
+    for j in range(buckets):
+        # Average of the next bucket, the last point for the last bucket
+        if j + 1 < buckets:
+            nextStart, nextEnd = bucket_bounds(j + 1)
+        else:
+            nextStart, nextEnd = offsets + lengths - 1, offsets + lengths
+        count = nextEnd - nextStart
+        avgX = (xSum[nextEnd] - xSum[nextStart]) / count
+        avgY = (ySum[nextEnd] - ySum[nextStart]) / count
+
+        # Triangle area of every point of the current bucket, for every line
+        sizes = end - start
+        line = np.repeat(np.arange(len(long)), sizes)
+        idx = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes) + start[line]
+        area = np.abs((x[a][line] - avgX[line]) * (y[idx] - y[a][line]) - (x[a][line] - x[idx]) * (avgY[line] - y[a][line]))
+
+        # First point with the largest area in each bucket
+        segmentStarts = np.cumsum(sizes) - sizes
+        maxima = np.maximum.reduceat(area, segmentStarts)
+        candidates = np.flatnonzero(area == maxima[line])
+        _, first = np.unique(line[candidates], return_index=True)
+        a = idx[candidates[first]]
+        selected[:, j + 1] = a
+
+        start, end = nextStart, nextEnd
+
+    for k, i in enumerate(long):
+        result[i] = selected[k] - offsets[k]
+    return result
@@ -1,10 +1,15 @@
 import os
 import argparse
+import warnings
+import trajstore
+import features
+import fitcache
+import instrument
 import numpy as np
 import pandas as pd
 from pathlib import Path
 from datetime import datetime
-from scipy.optimize import curve_fit
+from scipy.optimize import curve_fit, OptimizeWarning
 
 
 # ------------------------------------------------------------------------------------------------------------
@@ -14,6 +19,44 @@ from scipy.optimize import curve_fit
 # Accept a input & output directory. Output directory will be created if it doesn't exist
 #           python3 sigmoid.py -in ./input -out ./output
 # --------------------------------------------------------------------------------------------------------------
+# The input can also be a trajectory store written by flightprocess.py -format store
+#           python3 sigmoid.py -in ./output/trajectories -out ./output
+# --------------------------------------------------------------------------------------------------------------
+# Fit the trajectories in a pool of worker processes (-j 0 uses every core), the coefficients are the same for any -j
+#           python3 sigmoid.py -in ./output/trajectories -out ./output -j 8
+# --------------------------------------------------------------------------------------------------------------
+# Trajectories are fitted a batch at a time with a vectorized Levenberg-Marquardt (see fit_sigmoids). A trajectory
+# that cannot be fitted is written with empty coefficients and the reason in the 'Status' column, the run goes on
+# --------------------------------------------------------------------------------------------------------------
+# Keep the results in a cache (fitcache.sqlite in the output directory, or the given file) so trajectories that did not
+# change since a previous run with the same settings are not fitted again, see polycoef.py. A range of RANGE_SIZE
+# trajectories is cached as a whole (the warm starts carry from one trajectory to the next), so the coefficients are the
+# same as without -cache and a changed trajectory fits its whole range again
+#           python3 sigmoid.py -in ./output/trajectories -out ./output -cache
+# --------------------------------------------------------------------------------------------------------------
+# Time the reading, fitting and writing stages and write a JSON report (see instrument.py)
+#           python3 sigmoid.py -in ./output/trajectories -out ./output --profile
+# --------------------------------------------------------------------------------------------------------------
+# Every coefficient is written as its own float column ('Coefficient a' ...) and the coefficient matrix is also saved
+# next to the csv as sigmoidCoef-<time>.npz (see features.py), which kmeans.py, meanshift.py, som.py and hcout.py load
+# --------------------------------------------------------------------------------------------------------------
+
+# Number of trajectories fitted together by the vectorized Levenberg-Marquardt
+BATCH_SIZE = 256
+
+# Trajectories fitted by each task (see trajstore.map_trajectories). The warm start is carried from batch to batch within
+# a range, so the ranges stay the same whatever the number of workers and -j never changes the coefficients
+RANGE_SIZE = 1000
+
+# Initial guess & solver settings a cached result depends on (see fitcache.py), change them with fit_sigmoids
+CACHE_PARAMS = {"initial": "initial_parameters", "warmStart": "previous", "batchSize": BATCH_SIZE, "rangeSize": RANGE_SIZE, "maxIterations": 200,
+                "ftol": 1e-10, "xtol": 1e-10, "fallback": "curve_fit lm"}
+
+# Status of a trajectory that was fitted
+STATUS_OK = "ok"
+
+# Float column of every sigmoid coefficient, sigmoid(x) = a / (1 + exp(-c (x - d))) + b
+COEFFICIENT_COLUMNS = ["Coefficient a", "Coefficient b", "Coefficient c", "Coefficient d"]
 
 
 def generate_csv():
@@ -23,7 +66,7 @@ def generate_csv():
     :return:
     """
     # Adding the column names to the dataframe
-    columns = ["Trajectories", "Coefficients"]
+    columns = ["Trajectories"] + COEFFICIENT_COLUMNS + ["Status"]
     return pd.DataFrame(columns=columns)
 
 
@@ -31,21 +74,334 @@ def sigmoid(x, a, b, c, d):
     return a / (1. + np.exp(-c * (x - d))) + b
 
 
-def calculate_sigmoid_coefficients(fileName, dataframe, data, trajectoriesCount):
-    x = np.array(data["Distance From Start (nmi)"])
-    y = np.array(data["Alt - Ground Level"])
+def logistic(x, c, d):
+    """
+    Logistic part of the sigmoid, 1 / (1 + exp(-c (x - d))), with the exponent clipped so it never overflows
+
+    :param x: Distance to Runway
+    :param c: Steepness
+    :param d: Midpoint distance
+    :return: Values between 0 and 1
+    """
+    return 1. / (1. + np.exp(np.clip(-c * (x - d), -700, 700)))
+
+
+def sigmoid_jacobian(x, a, b, c, d):
+    """
+    Analytic partial derivatives of the sigmoid with respect to a, b, c and d
+
+    :param x: Distance to Runway
+    :return: Array of shape x.shape + (4,)
+    """
+    s = logistic(x, c, d)
+    slope = a * s * (1 - s)
+    return np.stack([s, np.ones_like(s), slope * (x - d), -slope * c], axis=-1)
+
+
+def initial_parameters(x, y):
+    """
+    Initial sigmoid parameters taken from the data: a is the altitude range, b the lowest altitude, d the distance
+    where the altitude crosses the middle of its range and c the steepness matching the slope around that point
+
+    :param x: Distance to Runway
+    :param y: Alt - Ground level
+    :return: Array [a, b, c, d]
+    """
+    low, high = y.min(), y.max()
+    a = max(high - low, 1.)
+    b = low
+    middle = low + a / 2
+
+    # Slope of the points in the middle half of the altitude range (all the points if there are too few)
+    central = np.abs(y - middle) <= a / 4
+    if central.sum() < 2 or np.ptp(x[central]) == 0:
+        central = np.ones(len(x), dtype=bool)
+    slope = np.polyfit(x[central], y[central], 1)[0] if np.ptp(x[central]) > 0 else 0.
+
+    # The sigmoid's slope at its midpoint is a * c / 4
+    span = max(np.ptp(x), 1e-6)
+    c = 4 * slope / a if slope != 0 else 4 / span
+    c = np.clip(c, -100 / span, 100 / span)
+
+    # First point where the altitude crosses the middle of its range
+    crossing = np.flatnonzero(np.diff(np.sign(y - middle)) != 0)
+    d = x[crossing[0]] if len(crossing) else np.median(x)
+    return np.array([a, b, c, d])
+
+
+def pad(xs, ys):
+    """
+    Stacks trajectories of different lengths into padded arrays
+
+    :param xs: List of Distance to Runway arrays
+    :param ys: List of Alt - Ground level arrays
+    :return: X, Y and the mask of the real points, all of shape (trajectories, longest length)
+    """
+    length = max((len(x) for x in xs), default=0)
+    X = np.zeros((len(xs), length))
+    Y = np.zeros((len(xs), length))
+    mask = np.zeros((len(xs), length), dtype=bool)
+    for idx, (x, y) in enumerate(zip(xs, ys)):
+        X[idx, :len(x)] = x
+        Y[idx, :len(y)] = y
+        mask[idx, :len(x)] = True
+    return X, Y, mask
+
+
+def batch_residuals(X, Y, mask, params):
+    """
+    Residuals of every trajectory, zero on the padding
+
+    :return: Residuals and logistic values (reused by the Jacobian), both of shape X.shape
+    """
+    a, b, c, d = (params[:, k, None] for k in range(4))
+    s = logistic(X, c, d)
+    return np.where(mask, a * s + b - Y, 0.), s
+
+
+def batch_cost(X, Y, mask, params):
+    """
+    Sum of squared residuals of every trajectory
+
+    :return: Array of shape (trajectories,)
+    """
+    residual, _ = batch_residuals(X, Y, mask, params)
+    return (residual * residual).sum(axis=1)
+
+
+def levenberg_marquardt(X, Y, mask, params, maxIterations=200, ftol=1e-10, xtol=1e-10):
+    """
+    Vectorized Levenberg-Marquardt, every trajectory takes its own steps with its own damping but all of them are computed
+    together: the normal equations of the whole batch are built with one batched matrix product and solved with one
+    batched solve. A trajectory stops updating once it has converged
+
+    :param X: Padded Distance to Runway, shape (trajectories, points)
+    :param Y: Padded Alt - Ground level
+    :param mask: Real points of X and Y
+    :param params: Initial parameters, shape (trajectories, 4)
+    :param maxIterations: Maximum number of iterations
+    :param ftol: Relative decrease of the cost under which a trajectory has converged
+    :param xtol: Relative step size under which a trajectory has converged
+    :return: Parameters, cost and convergence of every trajectory
+    """
+    params = params.copy()
+    residual, s = batch_residuals(X, Y, mask, params)
+    cost = (residual * residual).sum(axis=1)
+    damping = np.full(len(params), 1e-3)
+    converged = np.zeros(len(params), dtype=bool)
+
+    for _ in range(maxIterations):
+        active = np.flatnonzero(~converged & np.isfinite(cost))
+        if len(active) == 0:
+            break
+        x, y, m, p = X[active], Y[active], mask[active], params[active]
+        a, c, d = p[:, 0, None], p[:, 2, None], p[:, 3, None]
 
-    # Append the fileName to the list
-    rowData = [fileName]
+        # Analytic Jacobian from the logistic values already computed for the residuals
+        sa = s[active]
+        slope = np.where(m, a * sa * (1 - sa), 0.)
+        jacobian = np.stack([np.where(m, sa, 0.), m.astype(float), slope * (x - d), -slope * c], axis=1)
+        normal = jacobian @ jacobian.transpose(0, 2, 1)
+        gradient = (jacobian @ residual[active][..., None])[..., 0]
 
-    # values = opt.curve_fit(sigmoid, x, y)
-    popt, _ = curve_fit(sigmoid, x, y)
+        # Marquardt's scaling of the damping by the diagonal, kept positive so the damped system is always solvable
+        diagonal = np.maximum(np.einsum('tii->ti', normal), 1e-12)
+        damped = normal + (damping[active, None] * diagonal)[:, :, None] * np.eye(4)
+        step = -np.linalg.solve(damped, gradient[..., None])[..., 0]
 
-    # Append the trajectories to the list
-    rowData.append(np.array2string(popt, separator=",")[1:-1])
+        trial = p + step
+        trialResidual, trialS = batch_residuals(x, y, m, trial)
+        trialCost = (trialResidual * trialResidual).sum(axis=1)
+        better = np.isfinite(trialCost) & (trialCost < cost[active])
 
-    # Appending the list to the dataframe
-    dataframe.loc[trajectoriesCount] = rowData
+        improved = active[better]
+        decrease = cost[improved] - trialCost[better]
+        small = ((decrease <= ftol * cost[improved]) |
+                 (np.abs(step[better]).max(axis=1) <= xtol * (np.abs(p[better]).max(axis=1) + xtol)))
+        params[improved] = trial[better]
+        cost[improved] = trialCost[better]
+        residual[improved] = trialResidual[better]
+        s[improved] = trialS[better]
+        damping[improved] = np.maximum(damping[improved] / 10, 1e-15)
+        converged[improved[small]] = True
+
+        # A trajectory whose damping keeps growing cannot be improved any further, it is at a minimum
+        worse = active[~better]
+        damping[worse] *= 10
+        converged[worse[damping[worse] > 1e10]] = True
+
+    converged &= np.isfinite(cost) & np.isfinite(params).all(axis=1)
+    return params, cost, converged
+
+
+def fit_sigmoids(xs, ys, warmStart=None):
+    """
+    Fits the sigmoid to a batch of trajectories.
+    Every trajectory starts from its data-driven parameters (see initial_parameters), or from warmStart (the solution of the
+    previous trajectory) when that fits it better. Trajectories that do not converge are tried again from the solution of
+    the closest previous trajectory that did, then with scipy's curve_fit and the analytic Jacobian
+
+    :param xs: List of Distance to Runway arrays
+    :param ys: List of Alt - Ground level arrays
+    :param warmStart: Parameters of the previous trajectory, or None
+    :return: Parameters (trajectories, 4) and the status of every trajectory (STATUS_OK or the reason it failed)
+    """
+    xs = [np.asarray(x, dtype=float) for x in xs]
+    ys = [np.asarray(y, dtype=float) for y in ys]
+    params = np.full((len(xs), 4), np.nan)
+    status = [STATUS_OK] * len(xs)
+
+    # Rows that cannot be fitted at all
+    usable = []
+    for idx, (x, y) in enumerate(zip(xs, ys)):
+        finite = np.isfinite(x) & np.isfinite(y)
+        if finite.sum() < 4:
+            status[idx] = f"failed: {finite.sum()} usable points, at least 4 are needed"
+        else:
+            xs[idx], ys[idx] = x[finite], y[finite]
+            usable.append(idx)
+    if not usable:
+        return params, status
+
+    X, Y, mask = pad([xs[idx] for idx in usable], [ys[idx] for idx in usable])
+    start = np.array([initial_parameters(xs[idx], ys[idx]) for idx in usable])
+    if warmStart is not None:
+        warm = np.tile(warmStart, (len(usable), 1))
+        start = np.where((batch_cost(X, Y, mask, warm) < batch_cost(X, Y, mask, start))[:, None], warm, start)
+    fitted, _, converged = levenberg_marquardt(X, Y, mask, start)
+
+    # Warm start of the failed trajectories from the closest previous trajectory that converged
+    failed = np.flatnonzero(~converged)
+    if len(failed) and converged.any():
+        previous = np.maximum.accumulate(np.where(converged, np.arange(len(usable)), -1))[failed]
+        previous = np.where(previous >= 0, previous, np.flatnonzero(converged)[0])
+        retried, _, retryConverged = levenberg_marquardt(X[failed], Y[failed], mask[failed], fitted[previous])
+        fitted[failed[retryConverged]] = retried[retryConverged]
+        converged[failed[retryConverged]] = True
+
+    for k, idx in enumerate(usable):
+        if converged[k]:
+            params[idx] = fitted[k]
+            continue
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", OptimizeWarning)
+                params[idx], _ = curve_fit(sigmoid, xs[idx], ys[idx], p0=start[k], method="lm",
+                                           jac=lambda x, *p: sigmoid_jacobian(x, *p), maxfev=5000)
+            if not np.isfinite(params[idx]).all():
+                raise RuntimeError("non-finite parameters")
+        except (RuntimeError, ValueError, np.linalg.LinAlgError) as e:
+            params[idx] = np.nan
+            status[idx] = f"failed: {e}"
+    return params, status
+
+
+def calculate_sigmoid_coefficients(data, warmStart=None):
+    """
+    Fits the sigmoid function to a trajectory
+
+    :param data: Landing Data
+    :param warmStart: Parameters of the previous trajectory, or None
+    :return: Parameters & status of the fit
+    """
+    params, status = fit_sigmoids([data["Distance From Start (nmi)"]], [data["Alt - Ground Level"]], warmStart)
+    return params[0], status[0]
+
+
+def fit_batches(trajectories):
+    """
+    Fits trajectories BATCH_SIZE at a time, each batch starts warm from the last solution of the previous batch
+
+    :param trajectories: Iterable of (name, trajectory)
+    :return: Names, coefficients (NaN for a failed fit) & status of the trajectories in order
+    """
+    names = []
+    coefficients = []
+    statuses = []
+    warmStart = None
+    batch = []
+
+    def fit_batch():
+        nonlocal warmStart
+        with instrument.stage("levenberg-marquardt"):
+            params, status = fit_sigmoids([data["Distance From Start (nmi)"] for _, data in batch],
+                                          [data["Alt - Ground Level"] for _, data in batch], warmStart)
+        instrument.count("fits", len(batch))
+        instrument.count("failures", sum(s != STATUS_OK for s in status))
+        for (name, _), p, s in zip(batch, params, status):
+            names.append(name)
+            coefficients.append(p)
+            statuses.append(s)
+            if s == STATUS_OK:
+                warmStart = p
+        batch.clear()
+
+    for name, data in instrument.iterate(trajectories, "read"):
+        batch.append((name, data))
+        if len(batch) == BATCH_SIZE:
+            fit_batch()
+    if batch:
+        fit_batch()
+    return names, np.array(coefficients).reshape(-1, 4), statuses
+
+
+def fit_range(inputDirectory, start, stop):
+    """
+    Fits the trajectories start to stop - 1 of a folder or store, run by each worker process
+
+    :param inputDirectory: Folder of out*.csv files or trajectory store
+    :param start: Index of the first trajectory
+    :param stop: Index after the last trajectory
+    :return: Names, coefficients (NaN for a failed fit) & status of the trajectories in order
+    """
+    return fit_batches(trajstore.iter_trajectories(inputDirectory, start, stop))
+
+
+def fit_values(batch):
+    """
+    Results of a batch as stored in the fit cache (see fitcache.py), the coefficients with the status as note
+
+    :param batch: List of (name, trajectory)
+    :return: Matrix of the coefficients & list of the statuses
+    """
+    _, coefficients, statuses = fit_batches(batch)
+    return coefficients, statuses
+
+
+def fit_directory(inputDirectory, workers=1, cache=None):
+    """
+    Fits every trajectory of a folder or store, in a pool of worker processes when workers > 1.
+    Results are written into arrays allocated for every trajectory up front, at the trajectory's own position,
+    so the rows are in the same order whatever order the workers finish in
+
+    :param inputDirectory: Folder of out*.csv files or trajectory store
+    :param workers: Number of worker processes
+    :param cache: FitCache, unchanged trajectories are read from it instead of being fitted
+    :return: Final Dataframe
+    """
+    count = trajstore.count_trajectories(inputDirectory)
+    names = np.empty(count, dtype=object)
+    coefficients = np.empty((count, len(COEFFICIENT_COLUMNS)))
+    statuses = np.empty(count, dtype=object)
+
+    if cache is None:
+        ranges = trajstore.map_trajectories(inputDirectory, fit_range, workers, RANGE_SIZE, fixedRanges=True)
+    else:
+        ranges = fitcache.map_cached(cache, inputDirectory, workers, RANGE_SIZE, "sigmoid", CACHE_PARAMS, fit_values,
+                                     fixedRanges=True, wholeRange=True)
+
+    for start, (rangeNames, rangeCoefficients, rangeStatuses) in ranges:
+        stop = start + len(rangeNames)
+        names[start:stop] = rangeNames
+        coefficients[start:stop] = rangeCoefficients
+        statuses[start:stop] = rangeStatuses
+
+    dataframe = generate_csv()
+    dataframe["Trajectories"] = names
+    dataframe[COEFFICIENT_COLUMNS] = coefficients
+    dataframe["Status"] = statuses
+    dataframe.index = range(1, count + 1)
+    return dataframe
 
 
 if __name__ == '__main__':
@@ -53,8 +409,13 @@ if __name__ == '__main__':
 
     parser.add_argument('-in', metavar="INPUT", help='input file/directory')
     parser.add_argument('-out', metavar="OUTPUT", help='output directory')
+    parser.add_argument('-j', '--workers', metavar="WORKERS", type=int, default=1, help="Number of worker processes fitting trajectories, 0 uses every core")
+    parser.add_argument('-cache', metavar="FILE", nargs="?", const="", help="Reuse the results of unchanged trajectories from this cache file (default: fitcache.sqlite in the output directory)")
+    parser.add_argument('-cache-size', metavar="MB", type=float, default=fitcache.MAX_MB, help="Size limit of the cache, the least recently used results are removed beyond it")
+    instrument.add_arguments(parser)
 
     args = vars(parser.parse_args())
+    instrument.start(args['profile'], args['profile_calls'])
 
     # Raises an Exception if input path is not specified
     if not args["in"]:
@@ -68,37 +429,43 @@ if __name__ == '__main__':
     else:
         outputDirectory = args["out"]
 
-    # Generates a CSV with all the required column names
-    dataframe = generate_csv()
-
-    for subdir, dirs, files in os.walk(inputDirectory):
+    # Number of worker processes
+    workers = args['workers'] if args['workers'] > 0 else os.cpu_count()
 
-        # Counts the number of trajectories in the folder
-        trajectoriesCount = 1
+    # Cache of the fit results, unchanged trajectories are not fitted again
+    cache = None
+    if args['cache'] is not None:
+        cache = fitcache.FitCache(args['cache'] or os.path.join(outputDirectory, fitcache.CACHE_NAME), int(args['cache_size'] * 1024 * 1024))
 
-        for file in files:
-            # Separates file name & file extension
-            fileName = os.path.splitext(file)
+    # Calculates the coefficients for sigmoid function of every out*.csv file of the folder,
+    # or every trajectory of a store written by flightprocess.py -format store
+    with instrument.stage("fit"):
+        dataframe = fit_directory(inputDirectory, workers, cache)
 
-            # Checks if the file is CSV
-            if fileName[1] == ".csv" and fileName[0][:3] == "out":
-                # Reads the CSV file
-                data = pd.read_csv(inputDirectory + "/" + file, encoding="Latin-1", engine="python")
+    # Removes the least recently used results beyond the size limit & reports the hits and misses of the run
+    if cache is not None:
+        cache.evict()
+        print(cache.summary())
+        cache.close()
 
-                # Calculates the coefficients for sigmoid function
-                calculate_sigmoid_coefficients(fileName[0], dataframe, data, trajectoriesCount)
+    # Reports the trajectories that could not be fitted, their rows have empty coefficients
+    failed = dataframe[dataframe["Status"] != STATUS_OK]
+    for name, status in zip(failed["Trajectories"], failed["Status"]):
+        print(f"{name}: {status}")
 
-                trajectoriesCount += 1
+    # Retrieve Current time
+    currentTime = datetime.now()
+    currentTime = currentTime.strftime("%Y%m%d-%H%M%S")
 
-        # Retrieve Current time
-        currentTime = datetime.now()
-        currentTime = currentTime.strftime("%Y%m%d-%H%M%S")
+    # Creates file Path
+    filePath = Path(outputDirectory + f"/sigmoidCoef-{currentTime}.csv")
 
-        # Creates file Path
-        filePath = Path(outputDirectory + f"/sigmoidCoef-{currentTime}.csv")
+    # Creates Directory if output path does not exist
+    filePath.parent.mkdir(parents=True, exist_ok=True)
 
-        # Creates Directory if output path does not exist
-        filePath.parent.mkdir(parents=True, exist_ok=True)
-
-        # Saves the csv to output directory
+    # Saves the csv to output directory
+    with instrument.stage("write"):
         dataframe.to_csv(filePath, index=False)
+
+        # Saves the coefficient matrix next to it, loaded directly by the clustering scripts
+        features.save_features(filePath, dataframe["Trajectories"], dataframe[COEFFICIENT_COLUMNS].to_numpy(), COEFFICIENT_COLUMNS)
@@ -1,14 +1,17 @@
 import pandas as pd
 import numpy as np
+import features
+import instrument
 from sklearn_som.som import SOM
 import sys
 import os
 
-#parsing of arguments
+#parsing of arguments, --profile[=FILE] and --profile-calls time the stages of the run (see instrument.py)
+instrument.start(*instrument.parse_argv(sys.argv))
 
 if len(sys.argv) != 2:
     print("please use below command to execute code")
-    print("python som.py input_dataset_file")
+    print("python som.py input_dataset_file [--profile[=FILE]] [--profile-calls]")
     sys.exit(0)
 
 if os.path.exists(sys.argv[1]) == False:
@@ -18,36 +21,26 @@ if os.path.exists(sys.argv[1]) == False:
 inputFile = sys.argv[1] #getting input file
 outputFile = inputFile.replace(".csv","_som.csv") #renaming input file to output file
 
-trajectory = []
-points = []
-dataset = pd.read_csv(inputFile) #dataset reading
-dataset.fillna(0, inplace = True)
-df = dataset.values
-for i in range(len(df)):
-    t = df[i,0] #extracting trajectory
-    p = df[i,1] #extracting points
-    arr = p.split(",")
-    temp = []
-    for j in range(len(arr)): #converting points in string to float
-        temp.append(float(arr[j].strip()))
-    points.append(temp)
-    trajectory.append(t)
-
-points = np.asarray(points)
-trajectory = np.asarray(trajectory)
+#dataset reading, the coefficients are loaded as a float matrix (from the .npz saved next to the csv when there is one)
+with instrument.stage("load"):
+    dataset, trajectory, points = features.load_features(inputFile)
+instrument.count("trajectories", len(points))
 
 som_cls = SOM(dim=5) #som clustering object
-som_cls.fit(points) #start som training
-predict = som_cls.predict(points)
+with instrument.stage("som"):
+    som_cls.fit(points) #start som training
+    predict = som_cls.predict(points)
 centers = np.unique(predict) #get centers
 dataset['Cluster_ID'] = pd.Series(predict, index=dataset.index)
-dataset.to_csv(outputFile,index=False)
+with instrument.stage("write"):
+    dataset.to_csv(outputFile,index=False)
 print("\nSOM Clustering Output\n")
+clusterColumn = list(dataset.columns).index('Cluster_ID')
 dataset = dataset.values
 for i in range(0,len(centers)):
     output = []
     for j in range(len(dataset)):
-        if dataset[j,2] == centers[i]:
+        if dataset[j,clusterColumn] == centers[i]:
             output.append(dataset[j,0])
     print(str(centers[i])+" : "+str(', '.join(output))+"\n")        
 
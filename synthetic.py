@@ -0,0 +1,207 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import trajstore
+import instrument
+import flightprocess
+from concurrent.futures import ProcessPoolExecutor
+
+# ------------------------------------------------------------------------------------------------------------
+# Synthetic landing trajectories in the schema of the input/RK-*.csv recordings, used by benchmark.py
+#
+# Every approach flies from the starting point towards the runway (flightprocess.py defaults, Logan 33L) at 1 Hz:
+# a short climb, a level segment, a descent of random start and steepness to a touchdown near the runway and a roll
+# out past it, with smooth random altitude and lateral deviations, a varying airspeed and noisy controls.
+# Trajectory i only depends on the seed and on i, so the files are the same whatever the number of workers.
+# ------------------------------------------------------------------------------------------------------------
+# Write 1000 raw recordings (SYN-0000.csv ...) to be pre-processed by flightprocess.py:
+#           python3 synthetic.py -n 1000 -out ./synthetic
+# --------------------------------------------------------------------------------------------------------------
+# Write 1,000,000 pre-processed trajectories straight into a trajectory store (as written by flightprocess.py
+# -format store), read directly by polycoef.py, sigmoid.py and piecewise.py:
+#           python3 synthetic.py -n 1000000 -out ./output/trajectories -format store
+# --------------------------------------------------------------------------------------------------------------
+
+# Columns of a raw recording
+COLUMNS = ['Time', 'Lat', 'Long', 'Alt', 'Throttle', 'Rudder', 'Ailerons', 'Airspeed-kt', 'Vert-Speed-FPS']
+
+# Number of trajectories generated by a worker at a time
+BATCH_SIZE = 1000
+
+
+def smooth_noise(rng, n, scale, width):
+    """
+    Smooth random deviation: white noise averaged over a moving window, normalized to the given standard deviation
+
+    :param rng: Random generator
+    :param n: Number of samples
+    :param scale: Standard deviation of the result
+    :param width: Window in samples
+    :return: Array of n values
+    """
+    noise = rng.normal(size=n + width)
+    smooth = np.convolve(noise, np.ones(width) / width, mode="valid")[:n]
+    return smooth / max(smooth.std(), 1e-9) * scale
+
+
+def generate_trajectory(seed, idx):
+    """
+    Generates one raw approach
+
+    :param seed: Seed of the whole set
+    :param idx: Index of the trajectory
+    :return: Dataframe with the columns of a raw recording
+    """
+    rng = np.random.default_rng([seed, idx])
+    params = flightprocess.runway_parameters()
+
+    # Along track distance flown every second from a varying airspeed (kt)
+    end = rng.uniform(5.3, 5.7)
+    speed = np.clip(rng.uniform(65, 95) + smooth_noise(rng, 600, rng.uniform(3, 10), 30), 40, 140)
+    distance = np.concatenate([[0], np.cumsum(speed / 3600)])
+    n = int(np.searchsorted(distance, end)) + 1
+    distance = distance[:n]
+    speed = np.concatenate([[speed[0]], speed[:n - 1]])
+    time = np.arange(1, n + 1, dtype=float)
+
+    # Altitude above the runway: climb, level, descent to touchdown & roll out
+    start = 1200.0
+    peak = rng.uniform(1250, 1450)
+    climbEnd = rng.uniform(0.15, 0.4)
+    descentStart = rng.uniform(1.0, 3.2)
+    touchdown = rng.uniform(4.85, 5.2)
+    # Bends the descent from convex to concave
+    bend = rng.uniform(-0.25, 0.25)
+    knots = np.linspace(descentStart, touchdown, 6)
+    profile = peak * (1 - (knots - descentStart) / (touchdown - descentStart)) * (1 + bend * np.sin(np.linspace(0, np.pi, 6)))
+    height = np.interp(distance, np.concatenate([[0, climbEnd], knots]), np.concatenate([[start, peak], profile]))
+    taper = np.clip((touchdown - distance) / touchdown, 0, 1)
+    height = np.maximum(height + smooth_noise(rng, n, rng.uniform(10, 40), 30) * taper, 0)
+    height[distance >= touchdown] = 0
+
+    # Lateral deviation (nmi): a few slow weaves, closing in on the runway centre line
+    frequency = rng.uniform(0.3, 2.5, 3)
+    lateral = (rng.uniform(0, 0.05, 3) * np.sin(2 * np.pi * np.outer(distance / end, frequency) + rng.uniform(0, 2 * np.pi, 3))).sum(axis=1)
+    lateral = (lateral - lateral[0]) * np.clip((touchdown - distance) / touchdown, 0, 1)
+
+    # Position along the line from the starting point to the runway
+    latScale = 1 / 60
+    longScale = 1 / (60 * np.cos(np.radians(params['startLat'])))
+    along = np.array([(params['rLat'] - params['startLat']) / latScale, (params['rLong'] - params['startLong']) / longScale])
+    along /= np.linalg.norm(along)
+    across = np.array([-along[1], along[0]])
+    lat = params['startLat'] + (distance * along[0] + lateral * across[0]) * latScale
+    long = params['startLong'] + (distance * along[1] + lateral * across[1]) * longScale
+
+    return pd.DataFrame({
+        'Time': time,
+        'Lat': lat,
+        'Long': long,
+        'Alt': height + params['alt'],
+        'Throttle': np.round(np.clip(0.5 + smooth_noise(rng, n, 0.12, 20), 0, 1), 2),
+        'Rudder': smooth_noise(rng, n, 0.02, 5),
+        'Ailerons': smooth_noise(rng, n, 0.01, 5),
+        'Airspeed-kt': np.where(height > 0, speed, speed * np.clip(1 - (distance - touchdown) * 2, 0.2, 1)),
+        'Vert-Speed-FPS': np.gradient(height, time),
+    }, columns=COLUMNS)
+
+
+def file_name(idx, count):
+    """
+    Name of the file of a trajectory, numbered with as many digits as the largest index
+
+    :param idx: Index of the trajectory
+    :param count: Number of trajectories
+    :return: File name
+    """
+    return f"SYN-{idx:0{max(4, len(str(count - 1)))}d}.csv"
+
+
+def write_csv_range(output, seed, start, stop, count):
+    """
+    Writes the raw recordings start to stop - 1, run by each worker process
+
+    :param output: Output directory
+    :param seed: Seed of the whole set
+    :param start: Index of the first trajectory
+    :param stop: Index after the last trajectory
+    :param count: Number of trajectories of the whole set
+    :return: Number of rows written
+    """
+    rows = 0
+    for idx in range(start, stop):
+        with instrument.stage("generate"):
+            frame = generate_trajectory(seed, idx)
+        with instrument.stage("write"):
+            frame.to_csv(os.path.join(output, file_name(idx, count)), index=False)
+        rows += len(frame)
+    instrument.count("trajectories", stop - start)
+    instrument.count("rows", rows)
+    return rows
+
+
+def generate_csv(output, count, seed=0, workers=1):
+    """
+    Writes count raw recordings to a directory
+
+    :param output: Output directory
+    :param count: Number of trajectories
+    :param seed: Seed of the whole set
+    :param workers: Number of worker processes
+    :return: Number of rows written
+    """
+    os.makedirs(output, exist_ok=True)
+    ranges = [(start, min(start + BATCH_SIZE, count)) for start in range(0, count, BATCH_SIZE)]
+    if workers <= 1:
+        return sum(write_csv_range(output, seed, start, stop, count) for start, stop in ranges)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(instrument.worker_task(write_csv_range), *zip(*[(output, seed, start, stop, count) for start, stop in ranges]))
+        return sum(instrument.unwrap(rows) for rows in results)
+
+
+def generate_store(output, count, seed=0, method="vincenty"):
+    """
+    Writes count pre-processed trajectories to a trajectory store. The two new columns of flightprocess.py are added to a
+    whole batch of trajectories at once, they only depend on each row
+
+    :param output: Store path
+    :param count: Number of trajectories
+    :param seed: Seed of the whole set
+    :param method: Distance engine
+    :return: Number of rows written
+    """
+    rows = 0
+    with trajstore.TrajectoryStoreWriter(output) as store:
+        for start in range(0, count, BATCH_SIZE):
+            with instrument.stage("generate"):
+                frames = [generate_trajectory(seed, idx) for idx in range(start, min(start + BATCH_SIZE, count))]
+            lengths = np.cumsum([0] + [len(frame) for frame in frames])
+            batch = flightprocess.add_columns(pd.concat(frames, ignore_index=True), method)
+            with instrument.stage("write"):
+                for k in range(len(frames)):
+                    store.append('out' + os.path.splitext(file_name(start + k, count))[0], batch.iloc[lengths[k]:lengths[k + 1]])
+            instrument.count("trajectories", len(frames))
+            rows += len(batch)
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generates synthetic landing trajectories in the schema of input/RK-*.csv")
+
+    parser.add_argument('-n', metavar="COUNT", type=int, default=10, help="Number of trajectories")
+    parser.add_argument('-out', metavar="OUTPUT", default="synthetic", help="Output directory (csv) or store path (store)")
+    parser.add_argument('-format', choices=["csv", "store"], default="csv", help="Raw recordings, or pre-processed trajectories in a trajectory store")
+    parser.add_argument('-seed', metavar="SEED", type=int, default=0, help="Seed, the same seed always gives the same trajectories")
+    parser.add_argument('-j', '--workers', metavar="WORKERS", type=int, default=1, help="Number of worker processes writing csv files, 0 uses every core")
+    instrument.add_arguments(parser)
+
+    args = vars(parser.parse_args())
+    instrument.start(args['profile'], args['profile_calls'])
+    workers = args['workers'] if args['workers'] > 0 else os.cpu_count()
+
+    if args['format'] == "store":
+        rows = generate_store(args['out'], args['n'], args['seed'])
+    else:
+        rows = generate_csv(args['out'], args['n'], args['seed'], workers)
+    print(f"{args['n']} trajectories, {rows} rows written to {args['out']}")
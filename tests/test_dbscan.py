@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from sklearn.cluster import DBSCAN
+from sklearn.datasets import make_blobs
+from sklearn.metrics import adjusted_rand_score
+from sklearn.neighbors import NearestNeighbors
+import dbscan
+
+
+@pytest.fixture(scope="module")
+def points():
+    blobs, _ = make_blobs(600, 4, centers=5, cluster_std=1.5, random_state=7)
+    noise = np.random.default_rng(7).uniform(blobs.min(), blobs.max(), (60, 4))
+    return np.vstack([blobs, noise])
+
+
+@pytest.mark.parametrize("algorithm", ["kd_tree", "ball_tree"])
+def test_grid_matches_sklearn(points, algorithm):
+    index = NearestNeighbors(algorithm=algorithm).fit(points)
+    epsValues = [0.8, 1.5, 3.0]
+    minSamplesValues = [1, 4, 10]
+    results = dbscan.dbscan_grid(index, points, epsValues, minSamplesValues)
+    assert set(results) == {(eps, m) for eps in epsValues for m in minSamplesValues}
+
+    for (eps, minSamples), labels in results.items():
+        reference = DBSCAN(eps=eps, min_samples=minSamples).fit(points)
+        core = np.zeros(len(points), dtype=bool)
+        core[reference.core_sample_indices_] = True
+        # Same noise and the same clusters of core points, border points may join another cluster within eps
+        np.testing.assert_array_equal(labels == -1, reference.labels_ == -1)
+        assert labels.max() == reference.labels_.max()
+        assert adjusted_rand_score(labels[core], reference.labels_[core]) == 1.0
+
+        distances = np.linalg.norm(points[:, None] - points[None], axis=2)
+        for border in np.flatnonzero(~core & (labels >= 0)):
+            reachable = core & (distances[border] <= eps)
+            assert labels[border] in set(labels[reachable])
+
+
+def test_k_distances_and_knee(points):
+    index = NearestNeighbors().fit(points)
+    curves = dbscan.k_distances(index, points, [1, 4])
+    expected = np.sort(np.linalg.norm(points[:, None] - points[None], axis=2), axis=1)
+    for k, curve in curves.items():
+        np.testing.assert_allclose(curve, np.sort(expected[:, k])[::-1])
+    eps = dbscan.knee(curves[4])
+    assert curves[4][-1] <= eps <= curves[4][0]
+
+
+def test_no_core_point_is_all_noise(points):
+    index = NearestNeighbors().fit(points)
+    labels = dbscan.dbscan_grid(index, points, [1e-6], [2])[(1e-6, 2)]
+    assert (labels == -1).all()
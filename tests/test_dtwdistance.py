@@ -0,0 +1,92 @@
+import os
+import numpy as np
+import pytest
+from scipy.spatial.distance import squareform
+from tslearn.metrics import cdist_dtw
+from tslearn.utils import to_time_series_dataset
+import dtwdistance
+
+RADIUS = 5
+SLOPE = 2.0
+
+
+def flights(count, length, seed, lengths=None):
+    rng = np.random.default_rng(seed)
+    sizes = lengths if lengths is not None else [length] * count
+    return to_time_series_dataset([1500 - np.cumsum(np.abs(rng.normal(5, 3, n))) for n in sizes])
+
+
+@pytest.fixture(scope="module")
+def equal():
+    return flights(40, 60, 0)
+
+
+@pytest.fixture(scope="module")
+def padded():
+    rng = np.random.default_rng(1)
+    return flights(25, 0, 1, lengths=rng.integers(40, 61, 25))
+
+
+@pytest.mark.parametrize("constraint", dtwdistance.CONSTRAINTS)
+@pytest.mark.parametrize("dataset", ["equal", "padded"])
+def test_condensed_matches_cdist_dtw(constraint, dataset, request, monkeypatch):
+    series = request.getfixturevalue(dataset)
+    # Several blocks of rows
+    monkeypatch.setattr(dtwdistance, "BLOCK_ROWS", 7)
+    condensed = dtwdistance.condensed_dtw(series, constraint, RADIUS, SLOPE)
+    assert condensed.dtype == np.float32
+    assert condensed.shape == (len(series) * (len(series) - 1) // 2,)
+    reference = cdist_dtw(series, **dtwdistance.constraint_args(constraint, RADIUS, SLOPE))
+    np.testing.assert_allclose(squareform(condensed), reference, rtol=1e-6)
+
+
+def test_matrix_is_persisted_and_mapped(tmp_path, equal):
+    path = dtwdistance.matrix_path(str(tmp_path), "a" * 64)
+    first = dtwdistance.condensed_dtw(equal, "sakoe_chiba", RADIUS, SLOPE, path=path)
+    assert os.path.isfile(path) and not os.path.exists(path + ".tmp")
+    assert isinstance(first, np.memmap)
+    first = np.array(first)
+
+    # A second run maps the file instead of computing the matrix again
+    with open(path, "r+b") as f:
+        f.write(np.float32(-1).tobytes())
+    again = dtwdistance.condensed_dtw(equal, "sakoe_chiba", RADIUS, SLOPE, path=path)
+    assert again[0] == -1
+    np.testing.assert_array_equal(again[1:], first[1:])
+
+
+def test_input_key_depends_on_files_and_settings(tmp_path):
+    paths = []
+    for name in ("a.csv", "b.csv"):
+        (tmp_path / name).write_text("Time,Lat,Long,Alt\n")
+        paths.append(str(tmp_path / name))
+    key = dtwdistance.input_key(paths, 300, "none")
+    assert key == dtwdistance.input_key(paths, 300, "none")
+    assert key != dtwdistance.input_key(paths[::-1], 300, "none")
+    assert key != dtwdistance.input_key(paths, 200, "none")
+    assert key != dtwdistance.input_key(paths, 300, "sakoe_chiba")
+    (tmp_path / "a.csv").write_text("Time,Lat,Long,Alt\n1,2,3,4\n")
+    assert key != dtwdistance.input_key(paths, 300, "none")
+
+
+@pytest.mark.parametrize("constraint", dtwdistance.CONSTRAINTS)
+@pytest.mark.parametrize("dataset", ["equal", "padded"])
+def test_nearest_matches_cdist_dtw(constraint, dataset, request, monkeypatch):
+    series = request.getfixturevalue(dataset)
+    monkeypatch.setattr(dtwdistance, "NEIGHBOR_BATCH", 4)
+    queries = flights(3, 60, 2)
+    indices, distances = dtwdistance.nearest(series, queries, 3, constraint, RADIUS, SLOPE)
+    reference = cdist_dtw(queries, series, **dtwdistance.constraint_args(constraint, RADIUS, SLOPE))
+    np.testing.assert_allclose(distances, np.sort(reference, axis=1)[:, :3])
+    np.testing.assert_allclose(np.take_along_axis(reference, indices, axis=1), distances)
+
+
+@pytest.mark.parametrize("constraint", dtwdistance.CONSTRAINTS)
+def test_lower_bounds_never_exceed_dtw(constraint, equal):
+    query = equal[0, :, 0] + 3
+    values = equal[:, :, 0]
+    reference = cdist_dtw(query.reshape(1, -1, 1), equal, **dtwdistance.constraint_args(constraint, RADIUS, SLOPE))[0]
+    sizes = dtwdistance.series_sizes(equal)
+    assert (dtwdistance.lb_kim(query, values[:, 0], values[:, -1], sizes) <= reference + 1e-9).all()
+    radius = dtwdistance.band_radius(len(query), len(query), constraint, RADIUS, SLOPE)
+    assert (dtwdistance.lb_keogh(query, values, radius) <= reference + 1e-9).all()
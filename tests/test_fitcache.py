@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+import fitcache
+import sigmoid
+import trajstore
+
+
+def approach(seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(20, 60))
+    x = np.sort(rng.uniform(0, 10, n))
+    y = rng.uniform(800, 1500) / (1 + np.exp(-rng.uniform(0.5, 2) * (x - rng.uniform(3, 7)))) + rng.normal(0, 150, n)
+    return pd.DataFrame({"Time": np.arange(n, dtype=float), "Alt - Ground Level": y, "Distance From Start (nmi)": x})
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # Several batches per range and several ranges, so the warm starts cross batches
+    monkeypatch.setattr(sigmoid, "BATCH_SIZE", 4)
+    monkeypatch.setattr(sigmoid, "RANGE_SIZE", 12)
+    path = str(tmp_path / "store")
+    with trajstore.TrajectoryStoreWriter(path) as writer:
+        for idx in range(30):
+            writer.append(f"outRK-{idx:02d}", approach(idx))
+    return path
+
+
+def test_partially_cached_sigmoid_run_matches_uncached(tmp_path, store):
+    uncached = sigmoid.fit_directory(store)
+
+    cache = fitcache.FitCache(str(tmp_path / "fitcache.sqlite"))
+    pd.testing.assert_frame_equal(sigmoid.fit_directory(store, cache=cache), uncached, check_exact=True)
+    assert cache.misses == 30
+
+    # Every other result is evicted, the ranges are fitted again as a whole
+    keys = [key for key, in cache.connection.execute("SELECT key FROM fits ORDER BY rowid")]
+    cache.connection.executemany("DELETE FROM fits WHERE key = ?", [(key,) for key in keys[::2]])
+    cache.connection.commit()
+    pd.testing.assert_frame_equal(sigmoid.fit_directory(store, cache=cache), uncached, check_exact=True)
+
+    hits = cache.hits
+    pd.testing.assert_frame_equal(sigmoid.fit_directory(store, cache=cache), uncached, check_exact=True)
+    assert cache.hits == hits + 30
+    cache.close()
+
+
+def test_changed_trajectory_refits_its_range_only(tmp_path, store):
+    cache = fitcache.FitCache(str(tmp_path / "fitcache.sqlite"))
+    sigmoid.fit_directory(store, cache=cache)
+
+    changed = str(tmp_path / "changed")
+    frames = [(name, trajstore.TrajectoryStore(store).trajectory(idx)) for idx, name in enumerate(trajstore.TrajectoryStore(store).names)]
+    frames[15] = (frames[15][0], approach(100))
+    with trajstore.TrajectoryStoreWriter(changed) as writer:
+        for name, frame in frames:
+            writer.append(name, frame)
+    misses, hits = cache.misses, cache.hits
+    pd.testing.assert_frame_equal(sigmoid.fit_directory(changed, cache=cache), sigmoid.fit_directory(changed), check_exact=True)
+    assert cache.misses - misses == 12
+    assert cache.hits - hits == 18
+    cache.close()
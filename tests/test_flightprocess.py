@@ -0,0 +1,133 @@
+import os
+import shutil
+import numpy as np
+import pytest
+from concurrent.futures import as_completed
+import flightprocess
+import trajstore
+from manifest import Manifest
+
+INPUT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "input")
+
+
+@pytest.fixture
+def recordings(tmp_path):
+    folder = tmp_path / "input"
+    shutil.copytree(INPUT, folder)
+    return str(folder)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+@pytest.mark.parametrize("chunksize", [None, 200])
+def test_failed_store_append_is_reported_and_not_recorded(tmp_path, recordings, monkeypatch, workers, chunksize):
+    output = str(tmp_path / "output")
+    os.makedirs(output)
+    failing = "outRK-04"
+    append, appendStore = trajstore.TrajectoryStoreWriter.append, trajstore.TrajectoryStoreWriter.append_store
+
+    # The broken trajectory writes some rows before failing, they must not stay in the store
+    def failing_append(self, name, frame):
+        if name == failing:
+            append(self, name, frame.assign(**{frame.columns[-1]: "x"}))
+        append(self, name, frame)
+
+    def failing_append_store(self, path, chunkRows=100000):
+        if os.path.basename(path) != f".{failing}.tmp":
+            return appendStore(self, path, chunkRows)
+        extend = self.extend
+        calls = []
+
+        def failing_extend(frame):
+            calls.append(len(frame))
+            if len(calls) == 3:
+                raise OSError("disk full")
+            extend(frame)
+
+        self.extend = failing_extend
+        try:
+            appendStore(self, path, 50)
+        finally:
+            del self.extend
+
+    monkeypatch.setattr(trajstore.TrajectoryStoreWriter, "append", failing_append)
+    monkeypatch.setattr(trajstore.TrajectoryStoreWriter, "append_store", failing_append_store)
+    errors = flightprocess.flight_process([recordings], output, workers=workers, fmt="store", chunksize=chunksize)
+    assert [os.path.basename(path) for path, _ in errors] == ["RK-04.csv"]
+    assert not [file for file in os.listdir(output) if file.endswith(".tmp")]
+
+    store = trajstore.TrajectoryStore(os.path.join(output, flightprocess.STORE_NAME))
+    expected = [f"outRK-{idx:02d}" for idx in range(1, 11) if idx != 4]
+    assert store.names == expected
+    assert store.rows == store.bounds[-1]
+    manifest = Manifest(output)
+    assert not manifest.is_recorded(os.path.join(recordings, "RK-04.csv"))
+    assert all(manifest.is_recorded(os.path.join(recordings, name[3:] + ".csv")) for name in expected)
+
+    # The next run only processes the failed file and appends it after the others
+    monkeypatch.undo()
+    assert flightprocess.flight_process([recordings], output, workers=workers, fmt="store", chunksize=chunksize) == []
+    store = trajstore.TrajectoryStore(os.path.join(output, flightprocess.STORE_NAME))
+    assert store.names == expected + [failing]
+    reference = flightprocess.read_file(os.path.join(recordings, "RK-04.csv"))
+    for column in reference.columns:
+        np.testing.assert_array_equal(store.column(column, len(expected)), reference[column].to_numpy())
+
+
+@pytest.mark.parametrize("fmt", ["csv", "store"])
+def test_manifest_does_not_depend_on_the_current_directory(tmp_path, recordings, monkeypatch, capsys, fmt):
+    (tmp_path / "output").mkdir()
+    (tmp_path / "other").mkdir()
+    monkeypatch.chdir(tmp_path)
+    assert flightprocess.flight_process(["input"], "output", fmt=fmt) == []
+
+    # The same files & output from another directory are all current
+    monkeypatch.chdir(tmp_path / "other")
+    capsys.readouterr()
+    assert flightprocess.flight_process(["../input"], "../output", fmt=fmt) == []
+    assert "Skipping 10 unchanged files" in capsys.readouterr().out
+    entries = Manifest(str(tmp_path / "output")).entries.values()
+    assert all(os.path.isabs(entry["output"]) for entry in entries)
+
+
+def read_outputs(output):
+    files = {}
+    for name in sorted(os.listdir(output)):
+        path = os.path.join(output, name)
+        if os.path.isfile(path) and name != "manifest.json":
+            with open(path, "rb") as f:
+                files[name] = f.read()
+    store = os.path.join(output, flightprocess.STORE_NAME)
+    if trajstore.is_store(store):
+        for name in sorted(os.listdir(store)):
+            with open(os.path.join(store, name), "rb") as f:
+                files[os.path.join(flightprocess.STORE_NAME, name)] = f.read()
+    return files
+
+
+@pytest.mark.parametrize("fmt", ["csv", "store"])
+def test_parallel_output_matches_serial(tmp_path, recordings, monkeypatch, fmt):
+    # The files finish in reverse order, the later ones are held until every earlier one is done
+    monkeypatch.setattr(flightprocess, "as_completed", lambda futures: reversed(list(as_completed(futures))))
+    outputs = {}
+    for workers in (1, 2):
+        output = str(tmp_path / f"output{workers}")
+        os.makedirs(output)
+        assert flightprocess.flight_process([recordings], output, workers=workers, fmt=fmt) == []
+        outputs[workers] = read_outputs(output)
+    if fmt == "csv":
+        assert list(outputs[1]) == [f"outRK-{idx:02d}.csv" for idx in range(1, 11)]
+    else:
+        store = trajstore.TrajectoryStore(str(tmp_path / "output2" / flightprocess.STORE_NAME))
+        assert store.names == [f"outRK-{idx:02d}" for idx in range(1, 11)]
+    assert outputs[1] == outputs[2]
+
+
+@pytest.mark.parametrize("fmt", ["csv", "store"])
+def test_chunked_ingestion_matches_whole_files(tmp_path, recordings, fmt):
+    outputs = {}
+    for chunksize in (None, 5, 37):
+        output = str(tmp_path / f"output{chunksize}")
+        os.makedirs(output)
+        assert flightprocess.flight_process([recordings], output, fmt=fmt, chunksize=chunksize) == []
+        outputs[chunksize] = read_outputs(output)
+    assert outputs[None] == outputs[5] == outputs[37]
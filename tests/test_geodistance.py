@@ -0,0 +1,44 @@
+import glob
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import geodistance
+
+INPUTS = sorted(glob.glob(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "input", "RK-*.csv")))
+
+# Starting point of the recordings (flightprocess.py defaults)
+START = (42.29543, -70.91265)
+
+
+@pytest.fixture(scope="module")
+def points():
+    frames = [pd.read_csv(path, encoding="Latin-1") for path in INPUTS]
+    return np.concatenate([frame["Lat"].to_numpy() for frame in frames]), np.concatenate([frame["Long"].to_numpy() for frame in frames])
+
+
+@pytest.mark.skipif(not INPUTS, reason="no input/RK-*.csv recordings")
+def test_vincenty_matches_geopy(points):
+    pytest.importorskip("geopy")
+    lat, lon = points
+    reference = geodistance.geopy_nm(*START, lat, lon)
+    distance = geodistance.vincenty_nm(*START, lat, lon)
+    np.testing.assert_allclose(distance, reference, rtol=1e-6, atol=5e-9)
+
+
+@pytest.mark.skipif(not INPUTS, reason="no input/RK-*.csv recordings")
+def test_haversine_is_within_half_a_percent(points):
+    lat, lon = points
+    reference = geodistance.vincenty_nm(*START, lat, lon)
+    far = reference > 0.1
+    distance = geodistance.haversine_nm(*START, lat, lon)
+    assert np.abs(distance[far] / reference[far] - 1).max() < 0.005
+
+
+def test_vincenty_of_the_start_point_is_zero():
+    assert geodistance.vincenty_nm(*START, np.array([START[0]]), np.array([START[1]]))[0] == pytest.approx(0, abs=1e-12)
+
+
+def test_unknown_method_is_rejected():
+    with pytest.raises(ValueError):
+        geodistance.distance_nm(*START, np.array([START[0]]), np.array([START[1]]), "flat")
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+import sklearn
+from sklearn.datasets import make_blobs
+from sklearn.metrics import silhouette_score
+import kmeans
+
+
+@pytest.fixture(scope="module")
+def blobs():
+    points, _ = make_blobs(400, 5, centers=4, random_state=3)
+    return points
+
+
+def test_silhouette_scores_match_sklearn(blobs):
+    models = kmeans.sweep(blobs, 5)
+    labelsByK = {k: labels for k, (labels, _, _, _) in models.items()}
+    # Blocks of about 30 rows
+    with sklearn.config_context(working_memory=0.1):
+        scores = kmeans.silhouette_scores(blobs, labelsByK)
+    assert np.isnan(scores[1])
+    for k in range(2, 6):
+        assert scores[k] == pytest.approx(silhouette_score(blobs, labelsByK[k]), rel=1e-5)
+
+
+class Stopped(Exception):
+    pass
+
+
+# Chunks of a matrix like kmeans.iter_chunks, the run is stopped after stopAfter chunks
+def chunks_of(points, rows, stopAfter=None):
+    read = [0]
+
+    def chunks():
+        for start in range(0, len(points), rows):
+            if stopAfter is not None and read[0] == stopAfter:
+                raise Stopped()
+            read[0] += 1
+            yield None, None, points[start:start + rows]
+    return chunks
+
+
+@pytest.mark.parametrize("stopAfter", [4, 9, 23])
+def test_minibatch_resumes_to_the_same_model(tmp_path, blobs, stopAfter):
+    # 10 chunks per epoch, a checkpoint every 3 chunks: stopped in the first epoch between checkpoints, right at the end
+    # of it and in the last epoch
+    settings = {"clusters": 4}
+    uninterrupted = kmeans.fit_minibatch(chunks_of(blobs, 40), 4, epochs=3, seed=5)
+
+    checkpoint = str(tmp_path / "run.checkpoint")
+    with pytest.raises(Stopped):
+        kmeans.fit_minibatch(chunks_of(blobs, 40, stopAfter), 4, 3, 5, checkpoint, settings, checkpointChunks=3)
+    resumed = kmeans.fit_minibatch(chunks_of(blobs, 40), 4, 3, 5, checkpoint, settings, checkpointChunks=3)
+    np.testing.assert_array_equal(resumed.cluster_centers_, uninterrupted.cluster_centers_)
+    np.testing.assert_array_equal(resumed.predict(blobs), uninterrupted.predict(blobs))
+
+    # A finished run only loads the model, other settings start over
+    again = kmeans.fit_minibatch(chunks_of(blobs, 40, 0), 4, 3, 5, checkpoint, settings, checkpointChunks=3)
+    np.testing.assert_array_equal(again.cluster_centers_, uninterrupted.cluster_centers_)
+    with pytest.raises(Stopped):
+        kmeans.fit_minibatch(chunks_of(blobs, 40, 0), 4, 3, 5, checkpoint, {"clusters": 5}, checkpointChunks=3)
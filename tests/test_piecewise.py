@@ -0,0 +1,36 @@
+import os
+import numpy as np
+import pytest
+import flightprocess
+import piecewise
+
+INPUT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "input")
+
+
+def recordings():
+    for name in sorted(os.listdir(INPUT)):
+        data = flightprocess.read_file(os.path.join(INPUT, name))
+        yield name, data["Distance From Start (nmi)"].to_numpy(), data["Alt - Ground Level"].to_numpy()
+
+
+def glide(seed, n=3000):
+    # Three glide slopes with noise, and a few samples that cannot be used
+    rng = np.random.default_rng(seed)
+    x = np.sort(rng.uniform(0, 5, n))
+    y = np.interp(x, [0, 1.5, 3.5, 5], [1600, 1200, 300, 0]) + rng.normal(0, 15, n)
+    y[rng.integers(0, n, 5)] = np.nan
+    return f"glide-{seed}", x, y
+
+
+@pytest.mark.parametrize("maxSegments", [piecewise.MAX_SEGMENTS, 3])
+@pytest.mark.parametrize("chunkRows", [1, 7, 100])
+def test_chunked_input_gives_the_same_knots(maxSegments, chunkRows):
+    for name, x, y in list(recordings()) + [glide(0), glide(1)]:
+        whole = piecewise.fit_trajectory(x, y, maxSegments=maxSegments)
+        chunked = piecewise.fit_trajectory(x, y, maxSegments=maxSegments, chunkRows=chunkRows)
+        assert 1 <= len(whole) <= maxSegments
+        # Same segments, the coefficients & SSR only differ by the order the sums were added in
+        assert [(n, start, end) for _, _, n, start, end in chunked] == [(n, start, end) for _, _, n, start, end in whole], name
+        for (coefficients, ssr, _, _, _), (wholeCoefficients, wholeSsr, _, _, _) in zip(chunked, whole):
+            np.testing.assert_allclose(coefficients, wholeCoefficients, rtol=1e-7, atol=1e-9)
+            assert ssr == pytest.approx(wholeSsr, rel=1e-6, abs=1e-6)
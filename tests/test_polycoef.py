@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+import polycoef
+
+
+def approach(n=40, seed=0):
+    """
+    Distance to Runway & altitude of a noisy descent, ordered along the approach like a trajectory
+    """
+    rng = np.random.default_rng(seed)
+    x = np.sort(rng.uniform(0, 5.5, n))
+    y = 1300 - 40 * x ** 2 + 6 * x ** 3 + rng.normal(0, 15, n)
+    return x, y
+
+
+def brute_force_cv(x, y, degree, folds=None):
+    """
+    Cross-validation MSE by refitting np.polyfit without every fold (every point for leave-one-out)
+    """
+    n = len(x)
+    foldIndex = [np.array([i]) for i in range(n)] if folds is None else [np.arange(f, n, folds) for f in range(folds)]
+    error = 0.0
+    for fold in foldIndex:
+        keep = np.setdiff1d(np.arange(n), fold)
+        coefficients = np.polyfit(x[keep], y[keep], degree)
+        error += ((y[fold] - np.polyval(coefficients, x[fold])) ** 2).sum()
+    return error / n
+
+
+def closed_form_cv(x, y, degree, folds=None):
+    Q, _, _, _ = polycoef.factor_design(x)
+    Qd = Q[:, :degree + 1]
+    residual = (y - Qd @ (Qd.T @ y))[:, None]
+    foldIndex = None if folds is None else [np.arange(f, len(x), folds) for f in range(folds)]
+    return polycoef.cross_validation_error(Qd, (Qd ** 2).sum(axis=1), residual, foldIndex)[0]
+
+
+@pytest.mark.parametrize("folds", [None, 5, 10])
+@pytest.mark.parametrize("degree", [1, 2, 3, 5, 7])
+def test_cross_validation_matches_refits(degree, folds):
+    x, y = approach()
+    assert closed_form_cv(x, y, degree, folds) == pytest.approx(brute_force_cv(x, y, degree, folds), rel=1e-6)
+
+
+@pytest.mark.parametrize("folds", [None, 5])
+def test_selected_degree_has_the_lowest_refit_error(folds):
+    xs, ys = zip(*[approach(seed=seed) for seed in range(4)])
+    # Patience over every degree, so the selection sees the whole curve like the brute force
+    degrees, cv, ssr, coefficients, _ = polycoef.select_trajectories(xs, ys, folds, patience=polycoef.MAX_DEGREE)
+    for k, (x, y) in enumerate(zip(xs, ys)):
+        errors = {degree: brute_force_cv(x, y, degree, folds) for degree in range(1, polycoef.MAX_DEGREE + 1)}
+        assert degrees[k] == min(errors, key=errors.get)
+        assert cv[k] == pytest.approx(errors[degrees[k]], rel=1e-6)
+        fitted = np.polyfit(x, y, degrees[k])
+        assert coefficients[k, polycoef.MAX_DEGREE - degrees[k]:] == pytest.approx(fitted, rel=1e-6, abs=1e-6)
+        assert ssr[k] == pytest.approx(((y - np.polyval(fitted, x)) ** 2).sum(), rel=1e-6)
+
+
+def test_shared_x_trajectories_are_selected_like_single_ones():
+    x, y = approach()
+    _, y2 = approach(seed=1)
+    together = polycoef.select_trajectories([x, x], [y, y2])
+    alone = [polycoef.select_trajectories([x], [values]) for values in (y, y2)]
+    for k in range(2):
+        assert together[0][k] == alone[k][0][0]
+        assert together[1][k] == pytest.approx(alone[k][1][0])
@@ -0,0 +1,41 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import resample
+
+INPUT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "input")
+
+
+def recording(n, seed):
+    rng = np.random.default_rng(seed)
+    # Uneven steps, with some times logged twice and one going back
+    t = np.cumsum(rng.choice([0.0, 0.05, 0.11, 0.3], n))
+    t[n // 2] = t[n // 2 - 1] - 0.01
+    return pd.DataFrame({"Time": t, "Alt": rng.normal(1000, 50, n), "Lat": 42.3 + np.cumsum(rng.normal(0, 1e-4, n))})
+
+
+def push_chunks(frame, hz, size):
+    resampler = resample.Resampler(hz)
+    chunks = [resampler.push(frame.iloc[start:start + size]) for start in range(0, len(frame), size)]
+    # An empty chunk changes nothing
+    chunks.append(resampler.push(frame.iloc[:0]))
+    return pd.concat(chunks, ignore_index=True)
+
+
+@pytest.mark.parametrize("hz", [1, 4, 7.5, 50])
+@pytest.mark.parametrize("size", [1, 2, 13, 500])
+def test_chunks_give_the_same_grid_as_one_pass(hz, size):
+    frame = recording(400, 0)
+    whole = resample.resample_frame(frame, hz)
+    assert np.all(np.diff(whole["Time"]) > 0)
+    pd.testing.assert_frame_equal(push_chunks(frame, hz, size), whole, check_exact=True)
+
+
+def test_chunks_of_a_recording(hz=2):
+    frame = pd.read_csv(os.path.join(INPUT, "RK-03.csv"), encoding="Latin-1", dtype=float)
+    whole = resample.resample_frame(frame, hz)
+    assert whole["Time"].iloc[0] == frame["Time"].iloc[0]
+    np.testing.assert_allclose(np.diff(whole["Time"]), 1 / hz)
+    for size in (3, 64):
+        pd.testing.assert_frame_equal(push_chunks(frame, hz, size), whole, check_exact=True)
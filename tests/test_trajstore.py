@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+import pytest
+import trajstore
+
+COLUMNS = ["Time", "Alt - Ground Level", "Distance From Start (nmi)"]
+
+
+def trajectory(n, seed):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({"Time": np.arange(n, dtype=float), "Alt - Ground Level": rng.normal(800, 300, n),
+                         "Distance From Start (nmi)": np.cumsum(rng.uniform(0, 0.03, n))}, columns=COLUMNS)
+
+
+@pytest.fixture
+def frames():
+    # An empty trajectory and a single row one as well as regular ones
+    return {f"outRK-{idx:02d}": trajectory(n, idx) for idx, n in enumerate([50, 0, 1, 137], 1)}
+
+
+def assert_same(store, frames):
+    assert store.names == list(frames)
+    assert len(store) == len(frames)
+    assert store.rows == sum(len(frame) for frame in frames.values())
+    for idx, frame in enumerate(frames.values()):
+        arrays = store.arrays(idx)
+        for column in COLUMNS:
+            np.testing.assert_array_equal(arrays[column], frame[column].to_numpy())
+            np.testing.assert_array_equal(store.column(column, idx), frame[column].to_numpy())
+        pd.testing.assert_frame_equal(store.trajectory(idx), frame.reset_index(drop=True), check_dtype=False)
+
+
+def test_whole_and_chunked_appends_round_trip(tmp_path, frames):
+    with trajstore.TrajectoryStoreWriter(str(tmp_path / "whole")) as writer:
+        for name, frame in frames.items():
+            writer.append(name, frame)
+    with trajstore.TrajectoryStoreWriter(str(tmp_path / "chunked")) as writer:
+        for name, frame in frames.items():
+            writer.begin(name)
+            for start in range(0, len(frame), 7):
+                writer.extend(frame.iloc[start:start + 7])
+            writer.end()
+    assert trajstore.is_store(str(tmp_path / "whole"))
+    assert_same(trajstore.TrajectoryStore(str(tmp_path / "whole")), frames)
+    assert_same(trajstore.TrajectoryStore(str(tmp_path / "chunked")), frames)
+
+
+def test_append_keeps_and_replace_drops_existing_trajectories(tmp_path, frames):
+    path = str(tmp_path / "store")
+    names = list(frames)
+    with trajstore.TrajectoryStoreWriter(path) as writer:
+        for name in names[:2]:
+            writer.append(name, frames[name])
+    with trajstore.TrajectoryStoreWriter(path, append=True) as writer:
+        for name in names[2:]:
+            writer.append(name, frames[name])
+    assert_same(trajstore.TrajectoryStore(path), frames)
+
+    with trajstore.TrajectoryStoreWriter(path) as writer:
+        writer.append(names[3], frames[names[3]])
+    assert_same(trajstore.TrajectoryStore(path), {names[3]: frames[names[3]]})
+
+
+def test_append_store_copies_in_chunks(tmp_path, frames):
+    source = str(tmp_path / "source")
+    with trajstore.TrajectoryStoreWriter(source) as writer:
+        for name, frame in frames.items():
+            writer.append(name, frame)
+    with trajstore.TrajectoryStoreWriter(str(tmp_path / "copy")) as writer:
+        writer.append_store(source, chunkRows=10)
+    assert_same(trajstore.TrajectoryStore(str(tmp_path / "copy")), frames)
+
+
+def test_store_and_csv_folder_read_the_same(tmp_path, frames):
+    folder = tmp_path / "csv"
+    folder.mkdir()
+    store = str(tmp_path / "store")
+    with trajstore.TrajectoryStoreWriter(store) as writer:
+        for name, frame in frames.items():
+            writer.append(name, frame)
+            frame.to_csv(folder / (name + ".csv"), index=False)
+    # Files that are not out*.csv trajectories are ignored
+    (folder / "manifest.json").write_text("{}")
+
+    assert trajstore.count_trajectories(store) == trajstore.count_trajectories(str(folder)) == len(frames)
+    for (storeName, storeData), (csvName, csvData) in zip(trajstore.iter_trajectories(store, 1),
+                                                          trajstore.iter_trajectories(str(folder), 1)):
+        assert storeName == csvName
+        for column in COLUMNS:
+            # round_trip parsing gives back the exact float64 values
+            np.testing.assert_array_equal(storeData[column], csvData[column].to_numpy())
+    assert [name for name, _ in trajstore.read_trajectories(store, [3, 0])] == ["outRK-04", "outRK-01"]
+
+
+def test_failed_append_leaves_the_store_as_it_was(tmp_path, frames, monkeypatch):
+    path = str(tmp_path / "store")
+    source = str(tmp_path / "source")
+    names = list(frames)
+    with trajstore.TrajectoryStoreWriter(source) as other:
+        for name in names[1:]:
+            other.append(name, frames[name])
+
+    # The last column cannot be written, the columns before it already were
+    broken = frames[names[3]].assign(**{COLUMNS[-1]: "x"})
+    with trajstore.TrajectoryStoreWriter(path) as writer:
+        writer.append(names[0], frames[names[0]])
+        with pytest.raises(ValueError):
+            writer.append("outRK-broken", broken)
+
+        # A copy that fails half way drops the trajectories it already copied
+        extend = writer.extend
+        calls = []
+
+        def failing_extend(frame):
+            calls.append(len(frame))
+            if len(calls) == 3:
+                raise OSError("disk full")
+            extend(frame)
+
+        monkeypatch.setattr(writer, "extend", failing_extend)
+        with pytest.raises(OSError):
+            writer.append_store(source, chunkRows=10)
+        monkeypatch.undo()
+        assert writer.names == names[:1] and writer.current is None
+
+        writer.append_store(source, chunkRows=10)
+    assert_same(trajstore.TrajectoryStore(path), frames)
@@ -0,0 +1,361 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import instrument
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# ------------------------------------------------------------------------------------------------------------
+# Columnar binary store for pre-processed trajectories, written by flightprocess.py -format store
+#
+# A store is a directory holding every trajectory of a run:
+#   meta.json    - column names, trajectory names and total number of rows
+#   offsets.npy  - int64 array, trajectory i is rows offsets[i]:offsets[i+1]
+#   colNNN.bin   - one raw little-endian float64 file per column, all trajectories back to back
+#
+# Each column file is opened with np.memmap, so reading a store never parses text and only touches the rows used.
+# ------------------------------------------------------------------------------------------------------------
+
+META = "meta.json"
+OFFSETS = "offsets.npy"
+DTYPE = np.dtype("<f8")
+
+
+def is_store(path):
+    """
+    Checks if a path is a trajectory store directory
+
+    :param path: File or directory path
+    :return: True if the path is a store
+    """
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, META))
+
+
+def column_file(path, idx):
+    return os.path.join(path, f"col{idx:03d}.bin")
+
+
+class TrajectoryStoreWriter:
+    """
+    Appends trajectories to a store. A trajectory is either appended whole with append(), or chunk by chunk with
+    begin(), extend() and end() so very large recordings never have to be held in memory.
+    With append=True an existing store keeps its trajectories and new ones are added after them,
+    otherwise the existing store is replaced.
+    """
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.columns = None
+        self.names = []
+        self.offsets = [0]
+        self.rows = 0
+        self.files = []
+        self.current = None
+
+        os.makedirs(path, exist_ok=True)
+        if is_store(path) and not append:
+            for file in os.listdir(path):
+                if file in (META, OFFSETS) or (file.startswith("col") and file.endswith(".bin")):
+                    os.remove(os.path.join(path, file))
+        if is_store(path):
+            with open(os.path.join(path, META)) as f:
+                meta = json.load(f)
+            self.columns = meta["columns"]
+            self.names = meta["names"]
+            self.rows = meta["rows"]
+            self.offsets = np.load(os.path.join(path, OFFSETS)).tolist()
+            self._open_files("r+b")
+
+    def _open_files(self, mode):
+        self.files = []
+        for idx in range(len(self.columns)):
+            f = open(column_file(self.path, idx), mode)
+            # Drops anything written after the last committed trajectory
+            f.truncate(self.rows * DTYPE.itemsize)
+            f.seek(0, os.SEEK_END)
+            self.files.append(f)
+
+    def begin(self, name):
+        """
+        Starts a new trajectory, rows are then added with extend()
+
+        :param name: Trajectory name (e.g. outRK-01)
+        """
+        if self.current is not None:
+            raise RuntimeError(f"Trajectory '{self.current}' was not ended")
+        self.current = name
+
+    def extend(self, frame):
+        """
+        Adds rows to the current trajectory
+
+        :param frame: Dataframe with the rows to add, every column must be numeric
+        """
+        if self.columns is None:
+            self.columns = list(frame.columns)
+            self._open_files("w+b")
+        elif list(frame.columns) != self.columns:
+            raise ValueError(f"Columns {list(frame.columns)} do not match the store columns {self.columns}")
+
+        for f, column in zip(self.files, self.columns):
+            f.write(np.ascontiguousarray(frame[column].to_numpy(), dtype=DTYPE).tobytes())
+        self.rows += len(frame)
+
+    def end(self):
+        """
+        Ends the current trajectory and records its offset
+        """
+        self.names.append(self.current)
+        self.offsets.append(self.rows)
+        self.current = None
+
+    def truncate(self, count):
+        """
+        Drops every trajectory after the first count ones and the rows of a trajectory that was not ended, the next
+        trajectory is written after the last one kept
+
+        :param count: Number of trajectories kept
+        """
+        self.names = self.names[:count]
+        self.offsets = self.offsets[:count + 1]
+        self.rows = self.offsets[-1]
+        self.current = None
+        for f in self.files:
+            f.truncate(self.rows * DTYPE.itemsize)
+            f.seek(0, os.SEEK_END)
+
+    def append(self, name, frame):
+        """
+        Adds a whole trajectory, nothing is added if it fails
+
+        :param name: Trajectory name (e.g. outRK-01)
+        :param frame: Dataframe holding the trajectory
+        """
+        count = len(self.names)
+        self.begin(name)
+        try:
+            self.extend(frame)
+            self.end()
+        except BaseException:
+            self.truncate(count)
+            raise
+
+    def append_store(self, path, chunkRows=100000):
+        """
+        Copies every trajectory of another store, a chunk of rows at a time. Nothing is added if it fails
+
+        :param path: Path of the store to copy
+        :param chunkRows: Number of rows copied at a time
+        """
+        if self.current is not None:
+            raise RuntimeError(f"Trajectory '{self.current}' was not ended")
+        count = len(self.names)
+        try:
+            other = TrajectoryStore(path)
+            for idx, name in enumerate(other.names):
+                self.begin(name)
+                for start in range(other.bounds[idx], other.bounds[idx + 1], chunkRows):
+                    end = min(start + chunkRows, other.bounds[idx + 1])
+                    self.extend(pd.DataFrame({column: values[start:end] for column, values in other.data.items()}, copy=False))
+                self.end()
+        except BaseException:
+            self.truncate(count)
+            raise
+
+    def flush(self):
+        """
+        Flushes the column files and writes the index of the trajectories ended so far, so readers see them while the
+        writer stays open. Rows of a trajectory that was not ended yet are not part of the index
+        """
+        for f in self.files:
+            f.flush()
+        # Each index file is replaced in one step, a reader never sees a partly written one
+        offsetsPath = os.path.join(self.path, OFFSETS)
+        with open(offsetsPath + ".tmp", "wb") as f:
+            np.save(f, np.asarray(self.offsets, dtype=np.int64))
+        os.replace(offsetsPath + ".tmp", offsetsPath)
+        metaPath = os.path.join(self.path, META)
+        with open(metaPath + ".tmp", "w") as f:
+            json.dump({"columns": self.columns or [], "names": self.names, "rows": self.offsets[-1]}, f)
+        os.replace(metaPath + ".tmp", metaPath)
+
+    def close(self):
+        """
+        Flushes the column files and writes the index
+        """
+        if self.current is not None:
+            raise RuntimeError(f"Trajectory '{self.current}' was not ended")
+        self.flush()
+        for f in self.files:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TrajectoryStore:
+    """
+    Read-only view of a store. Columns are memory-mapped, trajectories are slices of them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META)) as f:
+            meta = json.load(f)
+        self.columns = meta["columns"]
+        self.names = meta["names"]
+        self.rows = meta["rows"]
+        self.offsets = np.load(os.path.join(path, OFFSETS))
+        # Plain python ints and ndarray views of the memmaps keep slicing cheap when iterating over many trajectories
+        self.bounds = self.offsets.tolist()
+        self.data = {}
+        for idx, column in enumerate(self.columns):
+            if self.rows:
+                self.data[column] = np.asarray(np.memmap(column_file(path, idx), dtype=DTYPE, mode="r", shape=(self.rows,)))
+            else:
+                self.data[column] = np.empty(0, dtype=DTYPE)
+
+    def __len__(self):
+        return len(self.names)
+
+    def column(self, name, idx):
+        """
+        Returns one column of one trajectory without copying
+
+        :param name: Column name
+        :param idx: Trajectory index
+        :return: Array view into the memory-mapped column
+        """
+        return self.data[name][self.bounds[idx]:self.bounds[idx + 1]]
+
+    def arrays(self, idx):
+        """
+        Returns one trajectory as a dictionary of column arrays, much cheaper than building a dataframe
+
+        :param idx: Trajectory index
+        :return: Dictionary of column name to array view
+        """
+        start, end = self.bounds[idx], self.bounds[idx + 1]
+        return {column: values[start:end] for column, values in self.data.items()}
+
+    def trajectory(self, idx):
+        """
+        Returns one trajectory as a dataframe
+
+        :param idx: Trajectory index
+        :return: Dataframe with all the store columns
+        """
+        return pd.DataFrame(self.arrays(idx), copy=False)
+
+
+def list_csv_trajectories(directory):
+    """
+    Lists the pre-processed out*.csv files of a directory (top level only, sorted by name)
+
+    :param directory: Input directory
+    :return: List of (trajectory name, file path)
+    """
+    trajectories = []
+    for file in sorted(os.listdir(directory)):
+        fileName = os.path.splitext(file)
+        if fileName[1] == ".csv" and fileName[0][:3] == "out":
+            trajectories.append((fileName[0], os.path.join(directory, file)))
+    return trajectories
+
+
+def read_csv_trajectory(path, columns=None):
+    """
+    Reads a pre-processed csv file with the C parser, round_trip keeps the values identical to the python parser
+
+    :param path: File path
+    :param columns: Only read these columns (all columns if None)
+    :return: Dataframe
+    """
+    return pd.read_csv(path, encoding="Latin-1", float_precision="round_trip", usecols=columns)
+
+
+def count_trajectories(path):
+    """
+    Counts the trajectories of a store or of a directory of out*.csv files
+
+    :param path: Store or directory path
+    :return: Number of trajectories
+    """
+    if is_store(path):
+        with open(os.path.join(path, META)) as f:
+            return len(json.load(f)["names"])
+    return len(list_csv_trajectories(path))
+
+
+def iter_trajectories(path, start=0, stop=None):
+    """
+    Iterates over the trajectories of a store or of a directory of out*.csv files.
+    Trajectories of a store are dictionaries of column arrays, csv files are dataframes; both are indexed by column name
+
+    :param path: Store or directory path
+    :param start: Index of the first trajectory
+    :param stop: Index after the last trajectory (all the remaining trajectories if None)
+    :return: Generator of (trajectory name, trajectory columns)
+    """
+    if is_store(path):
+        store = TrajectoryStore(path)
+        for idx in range(len(store))[start:stop]:
+            yield store.names[idx], store.arrays(idx)
+    else:
+        for name, file in list_csv_trajectories(path)[start:stop]:
+            yield name, read_csv_trajectory(file)
+
+
+def read_trajectories(path, indices):
+    """
+    Reads some trajectories of a store or of a directory of out*.csv files, see iter_trajectories
+
+    :param path: Store or directory path
+    :param indices: Indices of the trajectories
+    :return: Generator of (trajectory name, trajectory columns) in the order of indices
+    """
+    if is_store(path):
+        store = TrajectoryStore(path)
+        for idx in indices:
+            yield store.names[idx], store.arrays(idx)
+    else:
+        files = list_csv_trajectories(path)
+        for idx in indices:
+            name, file = files[idx]
+            yield name, read_csv_trajectory(file)
+
+
+def map_trajectories(path, task, workers=1, batchSize=1000, *args, fixedRanges=False):
+    """
+    Runs task(path, start, stop, *args) over consecutive ranges of the trajectories of a store or directory, in a pool of
+    worker processes when workers > 1. Every worker reads its own trajectories (a store is memory-mapped, nothing is copied
+    to the workers), only the results are sent back. Ranges are small enough to give every worker several of them, so a
+    slow range does not leave the other workers idle at the end, unless fixedRanges is set: tasks whose results depend on
+    the other trajectories of their range (warm starts) keep ranges of batchSize whatever the number of workers.
+
+    :param path: Store or directory path
+    :param task: Function fitting a range of trajectories, must be defined at the top level of a module
+    :param workers: Number of worker processes
+    :param batchSize: Largest number of trajectories in a range
+    :param args: Additional arguments of task
+    :param fixedRanges: Always use ranges of batchSize, so the ranges do not depend on workers
+    :return: Generator of (start, task result) in completion order, every range exactly once
+    """
+    count = count_trajectories(path)
+    if workers > 1 and not fixedRanges:
+        batchSize = max(1, min(batchSize, -(-count // (4 * workers))))
+    starts = range(0, count, batchSize)
+    if workers <= 1:
+        for start in starts:
+            yield start, task(path, start, min(start + batchSize, count), *args)
+        return
+
+    # With --profile the workers send their stages & counters back with every result
+    workerTask = instrument.worker_task(task)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(workerTask, path, start, min(start + batchSize, count), *args): start for start in starts}
+        for future in as_completed(futures):
+            yield futures[future], instrument.unwrap(future.result())